@@ -1,5 +1,4 @@
 import glob
-from io import BytesIO
 import json
 import math
 import re
@@ -16,7 +15,7 @@ directory = os.path.abspath(__file__)
 print(Path(directory).parent.parent.parent.parent)
 sys.path.append(os.path.join(Path(directory).parent.parent.parent.parent, "fedshop")) 
 
-from query import exec_query
+from query import batch_datafiles, dataset_fingerprint, open_query_result, read_query_result
 from utils import load_config, activate_one_container, fedshop_logger
 
 @click.group
@@ -27,6 +26,7 @@ CONFIGFILE = os.environ["RSFB__CONFIGFILE"]
 
 WORKDIR = Path(__file__).parent
 CONFIG = load_config(CONFIGFILE)["generation"]
+RESULT_STORE = CONFIG["virtuoso"].get("result_store")
 SPARQL_COMPOSE_FILE = CONFIG["virtuoso"]["compose_file"]
 SPARQL_SERVICE_NAME = CONFIG["virtuoso"]["service_name"]
 N_BATCH = CONFIG["n_batch"]
@@ -39,10 +39,11 @@ def query(queryfile, batch_id):
         query_text = fp.read()
         print(query_text)
         activate_one_container(batch_id, SPARQL_COMPOSE_FILE, SPARQL_SERVICE_NAME, LOGGER, "/dev/null")
-        _, result = exec_query(configfile=CONFIGFILE, query=query_text, error_when_timeout=True, batch_id=batch_id)
-        with BytesIO(result) as header_stream, BytesIO(result) as data_stream: 
-            header = header_stream.readline().decode().strip().replace('"', '').split(",")
-            result = pd.read_csv(data_stream, parse_dates=[h for h in header if "date" in h])
+        dataset = None
+        if RESULT_STORE is not None:
+            dataset = dataset_fingerprint(batch_datafiles(load_config(CONFIGFILE), batch_id), RESULT_STORE)
+        result_stream = open_query_result(query_text, CONFIG["virtuoso"]["default_endpoint"], result_store=RESULT_STORE, batch_id=batch_id, dataset=dataset)
+        result = read_query_result(result_stream)
     return result
 
 @cli.command()
@@ -1,4 +1,3 @@
-from io import BytesIO
 import math
 import os
 from pathlib import Path
@@ -36,13 +35,14 @@ def cli():
     pass
 
 from utils import load_config
-from query import exec_query
+from query import batch_datafiles, dataset_fingerprint, open_query_result, read_query_result
 
 BATCH_ID = int(os.environ["RSFB__BATCHID"])
 CONFIGFILE = os.environ["RSFB__CONFIGFILE"]
 
 WORKDIR = Path(__file__).parent
 CONFIG = load_config(CONFIGFILE)["generation"]
+RESULT_STORE = CONFIG["virtuoso"].get("result_store")
 SPARQL_ENDPOINT = CONFIG["virtuoso"]["endpoints"]
 STATS_SIGNIFICANCE_LEVEL = 1 - CONFIG["stats"]["confidence_level"]
 
@@ -53,24 +53,20 @@ WATDIV_BOOST_MU = 0.5
 WATDIV_BOOST_SIGMA = 0.5/3.0 
 
 def query(queryfile, cache=True, limit=None):
-    result = None
-    if cache:
-        saveAs = f"{Path(queryfile).parent}/{Path(queryfile).stem}.csv"
-        if os.path.exists(saveAs):
-            with open(saveAs, "r") as fp:
-                header = fp.readline().strip().replace('"', '').split(",")
-                result = pd.read_csv(saveAs, parse_dates=[h for h in header if "date" in h])
-                return result
+    """Run a test query against the current batch. 
+    With cache, the result is shared through the result store for as long as the data of the batch does not change.
+    """
+    result_store = RESULT_STORE if cache else None
+    dataset = None
+    if result_store is not None:
+        dataset = dataset_fingerprint(batch_datafiles(load_config(CONFIGFILE), BATCH_ID), result_store)
     
     with open(queryfile, "r") as fp:
         query_text = fp.read()
         if limit is not None:
             query_text += f"LIMIT {limit}"
-        _, result = exec_query(configfile=CONFIGFILE, query=query_text, error_when_timeout=True, batch_id=BATCH_ID)
-        with BytesIO(result) as header_stream, BytesIO(result) as data_stream: 
-            header = header_stream.readline().decode().strip().replace('"', '').split(",")
-            result = pd.read_csv(data_stream, parse_dates=[h for h in header if "date" in h])
-        if cache: result.to_csv(saveAs, index=False)
+        result_stream = open_query_result(query_text, CONFIG["virtuoso"]["default_endpoint"], result_store=result_store, batch_id=BATCH_ID, dataset=dataset)
+        result = read_query_result(result_stream)
     return result
 
 
@@ -1,5 +1,9 @@
 from itertools import chain
+import operator
 from pprint import pprint
+
+import numpy as np
+import pandas as pd
 from pyparsing import Forward, Group, Literal, Suppress, Word, ZeroOrMore, alphanums, alphas, infixNotation, oneOf, opAssoc, Optional
 from rdflib.plugins.sparql.parserutils import CompValue
 from rdflib.plugins.sparql.algebra import _traverseAgg, traverse
@@ -144,6 +148,71 @@ def translate_query(algebra):
     
     return list(chain(*traverse(algebra, _to_string)))[0]
                     
+COLUMN_OPERATORS = {
+    "!=": operator.ne, ">": operator.gt, "<": operator.lt, ">=": operator.ge, "<=": operator.le, "==": operator.eq,
+    # As in DataFrame.query, a value is "in" a column if it is one of the column's values
+    "in": lambda left, right: pd.Series(left).isin(right).to_numpy()
+}
+
+LOGICAL_OPERATORS = {
+    "and": np.logical_and, "or": np.logical_or, "not": np.logical_not
+}
+
+def compile_query(algebra):
+    """Compile a query into a function that evaluates it on a DataFrame, with the semantics of DataFrame.query.
+    The query is translated once, evaluating it only combines the numpy arrays of the columns into a boolean mask.
+
+    Args:
+        algebra: The query, as returned by parse_expr.
+
+    Raises:
+        NotImplementedError: the query holds a node that cannot be compiled, e.g. a FunctionCondition.
+
+    Returns:
+        callable: evaluate(df, variables=None) returning the boolean mask of the rows of df satisfying the query, 
+        variables giving the values of @var terms.
+    """
+    def _compile(node):
+        if node.name == "Expr":
+            return _compile(node["expr"])
+        
+        elif node.name == "ComparisonCondition":
+            left, right = _compile(node["left"]), _compile(node["right"])
+            op = COLUMN_OPERATORS[node["op"]["op"]]
+            return lambda df, variables: np.asarray(op(left(df, variables), right(df, variables)), dtype=bool)
+        
+        elif node.name == "FunctionCondition":
+            raise NotImplementedError("FunctionCondition compilation not implemented")
+        
+        elif node.name == "BinaryExpr":
+            left, right = _compile(node["left"]), _compile(node["right"])
+            op = LOGICAL_OPERATORS[node["op"]["op"]]
+            return lambda df, variables: op(left(df, variables), right(df, variables))
+        
+        elif node.name == "UnaryExpr":
+            right = _compile(node["right"])
+            op = LOGICAL_OPERATORS[node["op"]["op"]]
+            return lambda df, variables: op(right(df, variables))
+        
+        elif node.name == "Column":
+            column_name = node["column_name"]
+            # Categories are compared by value, whatever the categories of the other side
+            return lambda df, variables: np.asarray(df[column_name])
+        
+        elif node.name == "AccessVariable":
+            var = node["var"]
+            return lambda df, variables: variables[var]
+        
+        else:
+            raise NotImplementedError(f"Compilation for {node.name} not implemented")
+    
+    root = algebra
+    while not isinstance(root, CompValue):
+        root = root[0]
+    evaluate = _compile(root)
+    
+    return lambda df, variables=None: evaluate(df, variables or {})
+
 def parse_expr(input_expr):
     parsed_expr = Expr.parseString(input_expr)
     return parsed_expr
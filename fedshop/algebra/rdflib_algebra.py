@@ -1,9 +1,13 @@
 import ast
 import collections
+from copy import deepcopy
+import copyreg
+import functools
+import hashlib
 from itertools import chain
-import os
 from pprint import pprint
 import re
+from types import MethodType
 from typing import (
     DefaultDict,
     List
@@ -11,18 +15,49 @@ from typing import (
 import typing
 import uuid
 
+import datetime
 import dateutil
+import numpy as np
 import pandas as pd
 from rdflib.plugins.sparql.parserutils import CompValue, Expr
 from rdflib.plugins.sparql.sparql import Query
-from rdflib.plugins.sparql.algebra import ExpressionNotCoveredException, traverse, _traverseAgg, translateQuery
-from rdflib.term import Variable, Literal, URIRef
+from rdflib.plugins.sparql.algebra import ExpressionNotCoveredException, traverse, _traverseAgg, translateQuery, translatePName, translatePrologue
+from rdflib.term import BNode, Variable, Literal, URIRef
+from pyparsing import ParseResults
 
 
 # ---------------------------
 # Some convenience methods
 from rdflib.term import Identifier, URIRef, Variable
 
+XSD_NS = "http://www.w3.org/2001/XMLSchema#"
+XSD_DATE = URIRef(f"{XSD_NS}date")
+XSD_DATETIME = URIRef(f"{XSD_NS}dateTime")
+
+# Copy and pickle support for parse trees.
+# CompValue cannot be rebuilt without its name and Expr holds a method bound to
+# itself, so neither survives deepcopy() or pickle as is.
+
+def _rebuild_compvalue(cls, name, items, attrs, evalfn):
+    node = cls.__new__(cls)
+    collections.OrderedDict.__init__(node)
+    node.name = name
+    node.update(items)
+    node.__dict__.update(attrs)
+    if evalfn is not None:
+        node._evalfn = MethodType(evalfn, node)
+    return node
+
+def _reduce_compvalue(node):
+    attrs = { k: v for k, v in node.__dict__.items() if k not in ["name", "_evalfn"] }
+    evalfn = node.__dict__.get("_evalfn")
+    if evalfn is not None:
+        evalfn = evalfn.__func__
+    return _rebuild_compvalue, (type(node), node.name, list(node.items()), attrs, evalfn)
+
+copyreg.pickle(CompValue, _reduce_compvalue)
+copyreg.pickle(Expr, _reduce_compvalue)
+
 # Some utility methods
 
 def extract_where(node, children):
@@ -103,6 +138,137 @@ def disable_offset(node):
         node.pop("offset", None)
         return node
 
+def normalize_constant(value):
+    """Convert a raw value, e.g. read from a value selection file, to an RDF term.
+
+    Args:
+        value: The value to convert. RDF terms are returned as is.
+
+    Returns:
+        Identifier: URIRef for IRIs and blank node ids, Literal otherwise.
+    """
+    if isinstance(value, Identifier):
+        return value
+    
+    # Typed values, e.g. read from Parquet, need no guessing
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, (bool, int, float, datetime.date)):
+        return Literal(value)
+    
+    if str(value).startswith("http") or str(value).startswith("nodeID"): 
+        return URIRef(value)  
+    else:
+        
+        try: 
+            value = ast.literal_eval(str(value))
+            return Literal(value)
+        except ValueError: pass
+        except SyntaxError: pass
+        
+        try: 
+            dateutil.parser.parse(str(value))
+            return Literal(pd.to_datetime(value))
+        except ValueError: 
+            pass
+            
+    return Literal(value)
+
+def expand_datatype(datatype):
+    """Expand the datatype of a constant, as written in const.json: "iri", an xsd: name or a datatype IRI.
+    """
+    if datatype is None or datatype == "iri":
+        return datatype
+    if datatype.startswith("xsd:"):
+        return URIRef(f"{XSD_NS}{datatype[len('xsd:'):]}")
+    return URIRef(datatype)
+
+def term_converter(column, datatype=None):
+    """Pick, once for a whole column of constants, the function turning each of its values into an RDF term.
+
+    The datatype given in const.json comes first. Otherwise, the kind of term follows the dtype of the column:
+    numbers, booleans and datetimes are literals, text is IRIs if all values look like IRIs. 
+    Columns mixing kinds, e.g. read from CSV, fall back to normalize_constant.
+
+    Args:
+        column (pd.Series): The values of a constant, e.g. a column of the workload value selection.
+        datatype (str, optional): "iri", or the datatype of the literals, e.g. "xsd:date".
+
+    Returns:
+        callable: the converter, for values that are not missing.
+    """
+    datatype = expand_datatype(datatype)
+    if datatype == "iri":
+        return lambda value: URIRef(str(value))
+    if datatype == XSD_DATE:
+        return lambda value: Literal(pd.Timestamp(value).date().isoformat(), datatype=datatype)
+    if datatype == XSD_DATETIME:
+        return lambda value: Literal(pd.Timestamp(value).isoformat(), datatype=datatype)
+    if datatype is not None:
+        return lambda value: Literal(str(value.item() if isinstance(value, np.generic) else value), datatype=datatype)
+    
+    dtype = column.dtype
+    if pd.api.types.is_bool_dtype(dtype):
+        return lambda value: Literal(bool(value))
+    if pd.api.types.is_integer_dtype(dtype):
+        return lambda value: Literal(int(value))
+    if pd.api.types.is_float_dtype(dtype):
+        return lambda value: Literal(float(value))
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return lambda value: Literal(pd.Timestamp(value))
+    
+    values = column.cat.categories.to_series() if isinstance(dtype, pd.CategoricalDtype) else column.dropna()
+    if len(values) > 0 and values.map(lambda value: isinstance(value, str)).all() and values.str.match(r"http|nodeID").all():
+        return URIRef
+    return normalize_constant
+
+def normalize_column(column, datatype=None):
+    """Turn a column of constants into RDF terms, with a single converter for the column, see term_converter.
+    Categories are converted once each. Missing values are left as is.
+
+    Returns:
+        pd.Series: the terms.
+    """
+    convert = term_converter(column, datatype)
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        categories = pd.Series([ convert(value) for value in column.cat.categories ], dtype=object)
+        terms = categories.take(np.where(column.cat.codes < 0, 0, column.cat.codes)).set_axis(column.index)
+        return terms.where(column.notna(), column.astype(object))
+    return pd.Series([ value if pd.isna(value) else convert(value) for value in column.tolist() ], index=column.index, dtype=object)
+
+def column_n3(column, datatype=None):
+    """Serialize a column of constants as N3 terms, as normalize_column(...).n3() would, missing values being UNDEF.
+    
+    IRIs, integers, booleans and datetimes without fractional seconds are serialized by whole columns.
+
+    Args:
+        column (pd.Series): The values.
+        datatype (str, optional): "iri", or the datatype of the literals, see term_converter.
+
+    Returns:
+        pd.Series: the N3 strings.
+    """
+    expanded = expand_datatype(datatype)
+    missing = column.isna()
+    dtype = column.dtype
+    values = column[~missing]
+    
+    if expanded == "iri" or (expanded is None and term_converter(column) is URIRef):
+        n3 = "<" + values.astype(str) + ">"
+    elif expanded is None and pd.api.types.is_integer_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype):
+        n3 = '"' + values.astype(np.int64).astype(str) + f'"^^<{XSD_NS}integer>'
+    elif expanded is None and pd.api.types.is_bool_dtype(dtype):
+        n3 = '"' + values.map({True: "true", False: "false"}) + f'"^^<{XSD_NS}boolean>'
+    elif (
+        expanded is None and pd.api.types.is_datetime64_any_dtype(dtype) and getattr(dtype, "tz", None) is None 
+        and (values.dt.microsecond == 0).all() and (values.dt.nanosecond == 0).all()
+    ):
+        n3 = '"' + values.dt.strftime("%Y-%m-%dT%H:%M:%S") + f'"^^<{XSD_NS}dateTime>'
+    else:
+        n3 = normalize_column(values, datatype).map(lambda term: term.n3())
+    
+    return n3.reindex(column.index).fillna("UNDEF").astype(object)
+
 def inject_constant_into_placeholders(node, injection_dict):
     """
     Recursively inject constant values into placeholders in the query.
@@ -114,35 +280,16 @@ def inject_constant_into_placeholders(node, injection_dict):
     Returns:
         The modified node with constant values injected.
     """
-        
-    def normalize(value):
-        if str(value).startswith("http") or str(value).startswith("nodeID"): 
-            return URIRef(value)  
-        else:
-            
-            try: 
-                value = ast.literal_eval(str(value))
-                return Literal(value)
-            except ValueError: pass
-            except SyntaxError: pass
-            
-            try: 
-                dateutil.parser.parse(str(value))
-                return Literal(pd.to_datetime(value))
-            except ValueError: 
-                pass
-                
-        return Literal(value)
     
     if isinstance(node, Variable):
         var_name = str(node)
         if var_name in injection_dict:
-            return normalize(injection_dict[var_name])
+            return normalize_constant(injection_dict[var_name])
     elif isinstance(node, CompValue):
         if node.name == "vars":
             var_name = str(node["var"])
             if var_name in injection_dict:
-                normalize(injection_dict[var_name])
+                normalize_constant(injection_dict[var_name])
 
 def add_graph_to_triple_pattern(node):
     """
@@ -375,39 +522,247 @@ def remove_filter_with_placeholders(node, consts):
         node.pop("limitoffset", None)
         return node
     
-def add_values_with_placeholders(node, inline_data):
+def values_clause(inline_data, datatypes=None):
+    """Build a VALUES clause with one row per position in the columns of inline_data.
+
+    Columns are serialized at once with column_n3. The cells are kept as N3 strings, that translateAlgebra writes as is.
+
+    Args:
+        inline_data (dict): The values of each variable, as lists of the same length.
+        datatypes (dict, optional): The datatype of some variables, see term_converter.
+
+    Returns:
+        CompValue: the InlineData node.
+    """
+    datatypes = datatypes or {}
+    frame = pd.DataFrame({ 
+        variable: column_n3(pd.Series(values), datatypes.get(variable)) 
+        for variable, values in inline_data.items() 
+    })
+    return CompValue(
+        "InlineData",
+        var = [ Variable(k) for k in inline_data.keys() ],
+        value = frame.values.tolist()
+    )
+    
+def add_values_with_rows(node, inline_data, datatypes=None):
+    """Insert a VALUES clause with one row per position in the columns of inline_data, whatever their number.
+
+    Args:
+        node: The node visited.
+        inline_data (dict): The values of each variable, as lists of the same length.
+        datatypes (dict, optional): The datatype of some variables, see term_converter.
+    """
     if isinstance(node, CompValue):
         if node.name == "SelectQuery":
-            inline_data_keys = [ Variable(k) for k in inline_data.keys() ] 
-            inline_data_values = [ 
-                [ URIRef(v) if str(v).startswith("http") else Literal(v) for v in values ]
-                for values in inline_data.values()
-            ]
-            if len(inline_data_keys) == 1:
-                inline_data_values = inline_data_values[0]
-                
-            values_clause = CompValue(
-                "InlineData",
-                var = inline_data_keys,
-                value = inline_data_values
-            )
-            
-            node["where"]["part"].insert(0, values_clause)
+            node["where"]["part"].insert(0, values_clause(inline_data, datatypes))
             return node
-        
-def add_service_to_triple_blocks(node, inline_data):
-    if isinstance(node, "CompValue"):
+
+def add_projection_variables(node, variables):
+    """Project additional variables, unless the query projects all of them with *.
+    """
+    if isinstance(node, CompValue):
+        if node.name == "SelectQuery" and node.get("projection"):
+            node["projection"] = list(node["projection"]) + [ CompValue("vars", var=Variable(v)) for v in variables ]
+            return node
+
+def structural_hash(node):
+    """Hash a sub-algebra by its structure, so that identical subtrees share the same hash.
+
+    The hash is taken over the sequence of nodes and terms, blank nodes being named by first appearance,
+    so that it does not depend on the parse nor on the process, unlike repr().
+
+    Args:
+        node: The sub-algebra.
+
+    Returns:
+        str: the sha256 hex digest.
+    """
+    bnodes = {}
+    def token(term):
+        if isinstance(term, tuple):
+            return "\x00".join(map(str, term))
+        if isinstance(term, BNode):
+            return bnodes.setdefault(term, f"_:b{len(bnodes)}")
+        if isinstance(term, Identifier):
+            return f"{type(term).__name__}:{term.n3()}"
+        return f"{type(term).__name__}:{term}"
+    
+    canonical = "\x1f".join(map(token, _iter_terms(node, structure=True)))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+def _iter_terms(node, structure=False):
+    """Yield the leaves of a parse tree, in the order they are written.
+    
+    With structure, also yield a marker tuple when entering and leaving each node and container, 
+    with the names of nodes and keys. Unordered containers are yielded in a sorted order.
+    """
+    if isinstance(node, CompValue):
+        if structure: yield ("node", node.name)
+        for key, value in node.items():
+            if structure: yield ("key", key)
+            yield from _iter_terms(value, structure)
+        if structure: yield ("end",)
+    elif isinstance(node, (list, tuple, ParseResults)):
+        if structure: yield ("list",)
+        for value in node:
+            yield from _iter_terms(value, structure)
+        if structure: yield ("end",)
+    elif isinstance(node, (set, frozenset)):
+        if structure: yield ("set",)
+        for value in sorted(node, key=repr):
+            yield from _iter_terms(value, structure)
+        if structure: yield ("end",)
+    elif isinstance(node, dict):
+        if structure: yield ("dict",)
+        for key in sorted(node, key=repr):
+            if structure: yield ("key", key)
+            yield from _iter_terms(node[key], structure)
+        if structure: yield ("end",)
+    else:
+        yield node
+
+def canonical_fingerprint(algebra, options=None):
+    """Fingerprint a parsed query so that equivalent queries share the same fingerprint.
+
+    The fingerprint does not depend on prefix declarations, on the order of triple patterns within a block,
+    nor on the names of variables that are not projected. Projected variables are kept as is, since they name
+    the columns of the result.
+
+    Args:
+        algebra (ParseResults): The query, as returned by ``parseQuery``. It is left untouched.
+        options (dict, optional): Execution options that change the result (endpoint, batch, ...).
+
+    Returns:
+        str: the sha256 hex digest.
+    """
+    query = deepcopy(algebra)
+    prologue = translatePrologue(query[0], None)
+    body = traverse(query[1], visitPost=functools.partial(translatePName, prologue=prologue))
+
+    projected = None
+    if body.name == "SelectQuery" and body.projection is not None:
+        projected = { str(p.var if p.var is not None else p.evar) for p in body.projection }
+
+    def is_renamed(term):
+        return isinstance(term, Variable) and projected is not None and str(term) not in projected
+
+    def sort_triples(node, masked):
+        if isinstance(node, CompValue) and node.name == "TriplesBlock":
+            terms = list(chain.from_iterable(node.triples))
+            if len(terms) % 3 == 0:
+                triples = [ terms[i:i+3] for i in range(0, len(terms), 3) ]
+                key = lambda triple: tuple("?" if masked and is_renamed(t) else repr(t) for t in triple)
+                node["triples"] = sorted(triples, key=key)
+            return node
+
+    # Order triples without looking at the names to be replaced, name variables by first appearance, then sort again
+    body = traverse(body, visitPost=functools.partial(sort_triples, masked=True))
+    renaming = {}
+    for term in _iter_terms(body):
+        if is_renamed(term) and term not in renaming:
+            renaming[term] = Variable(f"__v{len(renaming)}")
+    body = traverse(body, visitPost=lambda node: renaming.get(node) if isinstance(node, Variable) else None)
+    body = traverse(body, visitPost=functools.partial(sort_triples, masked=False))
+
+    canonical = repr(body) + repr(sorted((options or {}).items()))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+def serialize_group_graph_pattern(node, prologue=None):
+    """Serialize a group graph pattern as a standalone SELECT * query.
+
+    Args:
+        node (CompValue): The GroupGraphPatternSub node, left untouched.
+        prologue (list, optional): The prologue of the enclosing query, to resolve prefixed names.
+
+    Returns:
+        str: the SPARQL query.
+    """
+    query = [prologue if prologue is not None else [], CompValue("SelectQuery", where=deepcopy(node))]
+    return translateAlgebra(translateQuery(query))
+
+def add_service_to_triple_blocks(node, prologue=None, memo=None):
+    """Wrap group graph patterns with SERVICE clause.
+
+    Each distinct pattern is serialized once, the result being kept in memo under its structural hash.
+    Service variables are named after that hash and the occurrence count, so that the output is reproducible.
+
+    Args:
+        node (CompValue): The current node.
+        prologue (list, optional): The prologue of the query, to resolve prefixed names.
+        memo (dict, optional): The memo table, shared by all calls for the same query.
+
+    Returns:
+        CompValue: The node with its group graph patterns wrapped.
+    """
+    if memo is None:
+        memo = {}
+    
+    if isinstance(node, CompValue):
         for node_attr, node_value in node.items():
             if node_attr in ["where"]: continue
             if isinstance(node_value, CompValue) and node_value.name == "GroupGraphPatternSub":
+                pattern_hash = structural_hash(node_value)
+                if pattern_hash not in memo:
+                    memo[pattern_hash] = {
+                        "service_string": serialize_group_graph_pattern(node_value, prologue),
+                        "count": 0
+                    }
+                memo[pattern_hash]["count"] += 1
+                
                 service_node = CompValue(
                     "ServiceGraphPattern",
-                    service_string = translateAlgebra(translateQuery(node)),
-                    term = Variable(graph_id = str(uuid.uuid4())[:8]),
-                    graph = node
+                    service_string = memo[pattern_hash]["service_string"],
+                    term = Variable(f"service{pattern_hash[:8]}_{memo[pattern_hash]['count']}"),
+                    graph = node_value
                 )
                 node[node_attr] = service_node
-        return node                            
+        return node
+
+# --------- REWRITE PIPELINE ------------
+def compose_visitors(*visitors):
+    """Compose several post-order visitors into a single one.
+
+    At each node, the visitors are applied in order, each one receiving the node as left by the previous one.
+    Chaining ``traverse(algebra, visitPost=v)`` for every visitor walks the tree once per visitor;
+    the composed visitor does the same rewrite in one walk, as long as each visitor only looks
+    at the subtree of the node it is given. A replacement returned by a visitor is handed to the
+    remaining visitors as is, its new descendants are not visited again.
+
+    Args:
+        *visitors (callable): visitPost functions, as accepted by rdflib's ``traverse``.
+
+    Returns:
+        callable: a visitPost function applying all visitors.
+    """
+
+    def visit(node):
+        result = None
+        for visitor in visitors:
+            new_node = visitor(node)
+            if new_node is not None:
+                node = result = new_node
+        return result
+
+    return visit
+
+def rewrite(algebra, *visitors):
+    """Apply a list of post-order visitors to the algebra in a single traversal.
+
+    Example:
+
+    .. code-block:: python
+
+        algebra = rewrite(algebra, disable_orderby_limit, disable_offset)
+
+    Args:
+        algebra: The parsed query.
+        *visitors (callable): visitPost functions, applied in order at each node.
+
+    Returns:
+        The rewritten algebra.
+    """
+    return traverse(algebra, visitPost=compose_visitors(*visitors))
 
 # --------- MISC ------------
 def translateAlgebra(query_algebra):
@@ -428,10 +783,13 @@ def translateAlgebra(query_algebra):
     referenced by client code at all in normal use.
     """
 
+    # The translation is accumulated in memory, local to this call, so that
+    # concurrent or nested translations never share state.
+    query_text = ""
+
     def overwrite(text):
-        file = open("query.txt", "w+")
-        file.write(text)
-        file.close()
+        nonlocal query_text
+        query_text = text
         
     def replace(
         old: str,
@@ -440,9 +798,8 @@ def translateAlgebra(query_algebra):
         search_from_match_occurrence: int = None,
         count: int = 1,
     ):  
-        # Read in the file
-        with open("query.txt", "r") as file:
-            filedata = file.read()
+        nonlocal query_text
+        filedata = query_text
 
         def find_nth(haystack, needle, n):
             start = haystack.lower().find(needle)
@@ -465,9 +822,7 @@ def translateAlgebra(query_algebra):
                 filedata.replace(old, new, count)
             )  
         
-        # Write the file out again
-        with open("query.txt", "w") as file:
-            file.write(filedata)
+        query_text = filedata
 
     aggr_vars = collections.defaultdict(list)  # type: dict
 
@@ -616,7 +971,7 @@ def translateAlgebra(query_algebra):
                 )
                 replace("{Graph}", expr)
             elif node.name == "Extend":
-                query_string = open("query.txt", "r").read().lower()
+                query_string = query_text.lower()
                 select_occurrences = query_string.count("-*-select-*-")
                 replace(
                     node.var.n3(),
@@ -1264,7 +1619,4 @@ def translateAlgebra(query_algebra):
             #     raise ExpressionNotCoveredException("The expression {0} might not be covered yet.".format(node.name))
     
     traverse(query_algebra.algebra, visitPre=sparql_query_text)
-    query_from_algebra = open("query.txt", "r").read()
-    os.remove("query.txt")
-
-    return query_from_algebra
+    return query_text
@@ -5,7 +5,7 @@ import re
 import shutil
 import subprocess
 import click
-from utils import load_config, fedshop_logger
+from utils import docker_check_container_running, load_config, fedshop_logger, ping
 import requests
 import time
 
@@ -101,15 +101,22 @@ def ingest(ctx: click.Context, configfile, clean, cores, config, rerun_incomplet
 @click.option("--no-cache", is_flag=True, default=False)
 @click.option("--dry-run", is_flag=True, default=False)
 @click.option("--force", is_flag=True, default=False)
+@click.option("--incremental", is_flag=True, default=False, help="Only generate the query instances missing after n_query_instances grew or templates were added.")
 @click.pass_context
-def generate(ctx: click.Context, category, configfile, config, debug, clean, cores, rerun_incomplete, touch, no_cache, dry_run, force):
+def generate(ctx: click.Context, category, configfile, config, debug, clean, cores, rerun_incomplete, touch, no_cache, dry_run, force, incremental):
     """Run the benchmark
 
+    In incremental mode, the workloads are first grown to n_query_instances by `query.py generate-workloads --incremental`,
+    keeping existing instances, then the pipeline runs without rerunning the existing instances.
+
     Args:
         mode (_type_): Either "generate" or "evaluate"
         op (_type_): Either "debug" or "clean"
     """
     
+    if incremental and category != "queries":
+        raise click.UsageError("--incremental only applies to queries")
+    
     if no_cache:
         shutil.rmtree(".snakemake")
 
@@ -162,6 +169,9 @@ def generate(ctx: click.Context, category, configfile, config, debug, clean, cor
         if "attempt" not in config_dict.keys():
             config_dict["attempt"] = list(map(str, range(CONFIG_EVAL["n_attempts"])))
     
+    if incremental:
+        config_dict["incremental"] = ["True"]
+    
     SNAKEMAKE_CONFIGS = " ".join([f"{k}={','.join(v)}" for k, v in config_dict.items()])
     
     SNAKEMAKE_OPTS = ""
@@ -183,6 +193,29 @@ def generate(ctx: click.Context, category, configfile, config, debug, clean, cor
     if clean is not None:
         logger.info("Cleaning...")
         ctx.invoke(wipe, configfile=configfile, level=clean)
+    
+    if incremental:
+        logger.info("Adding the missing instances to the workloads...")
+        BENCH_DIR = f"{WORK_DIR}/benchmark/generation"
+        QUERIES = config_dict.get("query", [Path(f).stem for f in os.listdir(QUERY_DIR) if f.endswith(".sparql")])
+        QUERY_FILES = " ".join([f"{QUERY_DIR}/{query}.sparql" for query in QUERIES])
+        
+        SPARQL_COMPOSE_FILE = CONFIG_GEN["virtuoso"]["compose_file"]
+        SPARQL_CONTAINER_NAME = f"docker-{CONFIG_GEN['virtuoso']['service_name']}-1"
+        SPARQL_DEFAULT_ENDPOINT = CONFIG_GEN["virtuoso"]["default_endpoint"]
+        if CONFIG["use_docker"]:
+            if not docker_check_container_running(SPARQL_CONTAINER_NAME):
+                os.system(f"docker compose -f {SPARQL_COMPOSE_FILE} stop")
+                os.system(f"docker start {SPARQL_CONTAINER_NAME}")
+            while ping(SPARQL_DEFAULT_ENDPOINT) != 200:
+                logger.debug(f"Waiting for {SPARQL_DEFAULT_ENDPOINT} to start...")
+                time.sleep(1)
+        
+        if os.system(f"python fedshop/query.py generate-workloads {configfile} {QUERY_FILES} --bench-dir {BENCH_DIR} --incremental") != 0 : exit(1)
+        if os.system(f"python fedshop/query.py instanciate-workload-all {QUERY_FILES} --bench-dir {BENCH_DIR} --incremental") != 0 : exit(1)
+        
+        # Newer workloads and parameters must not trigger the rerun of existing instances
+        SNAKEMAKE_OPTS += " --rerun-triggers mtime"
 
     for batch in range(1, N_BATCH+1):
         logger.info(f"Generating instances for batch {batch}/{N_BATCH}...")
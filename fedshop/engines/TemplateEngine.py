@@ -1,8 +1,12 @@
 # Import part
+from functools import lru_cache
 from io import BytesIO
+import fcntl
 import json
 import os
 import re
+import socket
+import time
 import click
 import glob
 import subprocess
@@ -12,12 +16,323 @@ from pathlib import Path
 
 
 import sys
+import psutil
 import requests
 sys.path.append(str(os.path.join(Path(__file__).parent.parent)))
 
 from utils import create_stats, kill_process, load_config, fedshop_logger, str2n3
 logger = fedshop_logger(Path(__file__).name)
 
+ENGINE_HOST_SOURCE = os.path.join(Path(__file__).parent, "host", "EngineHost.java")
+ENGINE_HOST_MODES = ["mvn", "cold", "warm"]
+ENGINE_HOST_STARTUP_TIMEOUT = int(os.environ.get("RSFB__ENGINE_HOST_STARTUP_TIMEOUT", 300))
+# Seconds a host has to end after a STOP request, before it is killed
+ENGINE_HOST_STOP_TIMEOUT = 10
+# Return code of EngineHost.run when the engine ended the host with System.exit, its exit code being unknown
+ENGINE_HOST_EXIT = 2
+
+@lru_cache(maxsize=None)
+def java_major_version(java):
+    """Return the major version of a JVM, e.g, 8 for 1.8.0_392 and 17 for 17.0.2.
+    """
+    output = subprocess.run([java, "-version"], capture_output=True, text=True).stderr
+    match = re.search(r'version "(\d+)(?:\.(\d+))?', output)
+    if match is None:
+        raise RuntimeError(f"Could not read the version of {java}: {output}")
+    major = int(match.group(1))
+    return int(match.group(2)) if major == 1 else major
+
+class EngineHost:
+    """Client of a long-lived JVM running the main class of a Java engine, see host/EngineHost.java.
+
+    One host runs per engine and batch, in the engine directory. It outlives the Python process that started it,
+    its port and pid being kept in <engine dir>/target/fedshop-host. Queries of the same engine and batch are 
+    serialized with a lock file, as the engines keep static state.
+    
+    Modes:
+    - cold: every query runs on a fresh host, i.e, a fresh JVM without Maven, so that every query is measured with a cold JIT.
+    - warm: the host is kept between queries. A fresh host first runs the query `warmup` times, the runs being discarded, 
+        so that the first measured query of a batch is not the only one measured with a cold JIT.
+        Whatever an engine keeps in memory, e.g, static caches, survives between the queries of a warm host: 
+        only on-disk caches are cleared, e.g, CostFed's cache.db. Warm hosts run until stopped, see stop_engine_hosts.
+    """
+    
+    def __init__(self, name, engine_dir, main_class, batch_id, module=None, mode="warm", warmup=0, jvm_args=None):
+        """
+        Args:
+            name (str): The name of the engine, e.g, fedx.
+            engine_dir (str): The directory of the engine, the working directory of the host.
+            main_class (str): The class whose main is called for each query.
+            batch_id (int): The batch.
+            module (str, optional): The Maven module holding the main class, as in mvn -pl. Defaults to the root project.
+            mode (str, optional): cold or warm. Defaults to "warm".
+            warmup (int, optional): The number of discarded runs of the first query of a warm host. Defaults to 0.
+            jvm_args (list, optional): Arguments of the JVM, e.g, system properties. 
+        """
+        if mode not in ["cold", "warm"]:
+            raise ValueError(f"Unknown engine host mode {mode}, expected cold or warm!")
+        
+        self.name = name
+        self.engine_dir = os.path.realpath(engine_dir)
+        self.main_class = main_class
+        self.module = module
+        self.mode = mode
+        self.warmup = warmup
+        self.jvm_args = list(jvm_args or [])
+        
+        self.state_dir = os.path.join(self.engine_dir, "target", "fedshop-host")
+        prefix = os.path.join(self.state_dir, f"{name}_batch{batch_id}")
+        self.port_file = f"{prefix}.port"
+        self.pid_file = f"{prefix}.pid"
+        self.log_file = f"{prefix}.log"
+        self.lock_file = f"{prefix}.lock"
+        
+        self.fresh = False
+        self.lock_fs = None
+        
+    def classpath(self):
+        """Resolve the classpath of the engine with Maven, once until its pom.xml changes.
+        """
+        module_dir = os.path.join(self.engine_dir, self.module) if self.module else self.engine_dir
+        classpath_file = os.path.join(self.state_dir, f"{self.name}.classpath")
+        pom_file = os.path.join(self.engine_dir, "pom.xml")
+        
+        if not os.path.exists(classpath_file) or os.path.getmtime(classpath_file) < os.path.getmtime(pom_file):
+            cmd = ["mvn", "-q", "dependency:build-classpath", f"-Dmdep.outputFile={classpath_file}"]
+            if self.module:
+                cmd += ["-pl", self.module]
+            logger.debug(f"Resolving classpath of {self.name}: {' '.join(cmd)}")
+            if subprocess.run(cmd, cwd=self.engine_dir, stdout=subprocess.DEVNULL).returncode != 0:
+                raise RuntimeError(f"Could not resolve the classpath of {self.name}!")
+        
+        with open(classpath_file, "r") as cp_fs:
+            dependencies = cp_fs.read().strip()
+            
+        return os.pathsep.join([os.path.join(self.state_dir, "classes"), os.path.join(module_dir, "target", "classes"), dependencies])
+    
+    def compile(self):
+        """Compile the host, unless up to date.
+        """
+        class_file = os.path.join(self.state_dir, "classes", "EngineHost.class")
+        if not os.path.exists(class_file) or os.path.getmtime(class_file) < os.path.getmtime(ENGINE_HOST_SOURCE):
+            if subprocess.run(["javac", "-d", os.path.join(self.state_dir, "classes"), ENGINE_HOST_SOURCE]).returncode != 0:
+                raise RuntimeError("Could not compile EngineHost!")
+    
+    def pid(self):
+        """Return the pid of the running host, None if there is none.
+        """
+        try:
+            with open(self.pid_file, "r") as pid_fs:
+                pid = int(pid_fs.read())
+            if "EngineHost" in psutil.Process(pid).cmdline() and os.path.exists(self.port_file):
+                return pid
+        except (FileNotFoundError, ValueError, psutil.NoSuchProcess, psutil.AccessDenied):
+            pass
+        return None
+    
+    def start(self):
+        """Start a host, and wait until it listens.
+        """
+        Path(self.state_dir).mkdir(parents=True, exist_ok=True)
+        self.compile()
+        Path(self.port_file).unlink(missing_ok=True)
+        
+        java = os.path.join(os.environ["JAVA_HOME"], "bin", "java") if "JAVA_HOME" in os.environ else "java"
+        jvm_args = list(self.jvm_args)
+        
+        # The host traps System.exit with a SecurityManager, which Java 18 to 23 only allow on demand and Java 24 removed
+        java_version = java_major_version(java)
+        if java_version >= 24:
+            logger.warning(f"Java {java_version} cannot trap System.exit, queries of engines calling it end the {self.name} host and are reported as failed")
+        elif java_version >= 18 and not any(arg.startswith("-Djava.security.manager") for arg in jvm_args):
+            jvm_args.append("-Djava.security.manager=allow")
+        
+        cmd = [java, *jvm_args, "-cp", self.classpath(), "EngineHost", self.main_class, self.port_file]
+        logger.debug(f"Starting {self.name} host: {' '.join(cmd)}")
+        
+        with open(self.log_file, "a") as log_fs:
+            # New session, so that the host survives the process group of the caller
+            host_proc = subprocess.Popen(cmd, cwd=self.engine_dir, stdin=subprocess.DEVNULL, stdout=log_fs, stderr=subprocess.STDOUT, start_new_session=True)
+        with open(self.pid_file, "w") as pid_fs:
+            pid_fs.write(str(host_proc.pid))
+        
+        deadline = time.time() + ENGINE_HOST_STARTUP_TIMEOUT
+        while not os.path.exists(self.port_file):
+            if host_proc.poll() is not None:
+                raise RuntimeError(f"{self.name} host exited with code {host_proc.returncode}, see {self.log_file}!")
+            if time.time() > deadline:
+                self.stop(graceful=False)
+                raise RuntimeError(f"{self.name} host did not start within {ENGINE_HOST_STARTUP_TIMEOUT}s, see {self.log_file}!")
+            time.sleep(0.1)
+        self.fresh = True
+        
+    def stop(self, graceful=True):
+        """Stop the host, if any.
+
+        Args:
+            graceful (bool, optional): Ask the host to end with a STOP request first, and only kill it if it does not end 
+                within ENGINE_HOST_STOP_TIMEOUT. Otherwise, e.g, when the host is busy with a query, kill it right away. Defaults to True.
+        """
+        pid = self.pid()
+        if pid is not None and graceful:
+            try:
+                with open(self.port_file, "r") as port_fs:
+                    port = int(port_fs.read())
+                with socket.create_connection(("127.0.0.1", port), timeout=ENGINE_HOST_STOP_TIMEOUT) as sock:
+                    sock.sendall(b"STOP\n\n")
+                    sock.makefile("r", encoding="utf-8").readline()
+                psutil.Process(pid).wait(ENGINE_HOST_STOP_TIMEOUT)
+                pid = None
+            except psutil.NoSuchProcess:
+                pid = None
+            except (OSError, ValueError, psutil.TimeoutExpired) as e:
+                logger.warning(f"{self.name} host did not stop ({e}), killing it...")
+        if pid is not None:
+            kill_process(pid)
+        Path(self.port_file).unlink(missing_ok=True)
+        Path(self.pid_file).unlink(missing_ok=True)
+        
+    def acquire(self):
+        """Lock the host of the engine and batch, then start a host if the mode requires it.
+        """
+        Path(self.state_dir).mkdir(parents=True, exist_ok=True)
+        self.lock_fs = open(self.lock_file, "w")
+        fcntl.flock(self.lock_fs, fcntl.LOCK_EX)
+        
+        self.fresh = False
+        try:
+            if self.mode == "cold":
+                self.stop()
+            if self.pid() is None:
+                self.start()
+        except:
+            self.release()
+            raise
+        
+    def release(self):
+        """Stop the host in cold mode, then unlock it.
+        """
+        if self.mode == "cold":
+            self.stop()
+        if self.lock_fs is not None:
+            fcntl.flock(self.lock_fs, fcntl.LOCK_UN)
+            self.lock_fs.close()
+            self.lock_fs = None
+    
+    def warm_up(self, args, timeout):
+        """Run the query `warmup` times on a fresh warm host, discarding the runs. 
+        To be called before resetting the proxy statistics.
+        """
+        if self.mode == "warm" and self.fresh:
+            for i in range(self.warmup):
+                logger.debug(f"Warming up {self.name} host ({i+1}/{self.warmup})...")
+                if self.run(args, timeout) != 0:
+                    # The measured run fails the same way, on a host restarted if the failure ended it
+                    if self.pid() is None:
+                        self.start()
+                    break
+        self.fresh = False
+        
+    def run(self, args, timeout=None):
+        """Run the main class of the engine on the host, see acquire.
+
+        Args:
+            args (list): The arguments of main.
+            timeout (int, optional): Seconds to wait for the engine. The host is killed when they are elapsed. 
+
+        Raises:
+            subprocess.TimeoutExpired: the engine did not reply in time.
+
+        Returns:
+            int: 0 if main ended normally, ENGINE_HOST_EXIT if it ended the host with an unknown exit code, 
+                1 otherwise, e.g, the host died, as the return code of mvn exec:java.
+        """
+        if any("\n" in arg for arg in args):
+            raise ValueError(f"Arguments of {self.name} cannot hold line breaks!")
+        
+        with open(self.port_file, "r") as port_fs:
+            port = int(port_fs.read())
+        
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=timeout or None) as sock:
+                sock.sendall(("\n".join(args) + "\n\n").encode())
+                reply = sock.makefile("r", encoding="utf-8").readline().strip()
+        except socket.timeout:
+            self.stop(graceful=False)
+            raise subprocess.TimeoutExpired(f"{self.name} host", timeout)
+        except ConnectionError:
+            reply = ""
+        
+        logger.debug(f"{self.name} host replied: {reply}")
+        status = reply.split(" ", 1)[0]
+        if status == "OK":
+            return 0
+        elif status == "ERR":
+            return 1
+        elif status == "EXIT":
+            # The engine ended the JVM, whose exit code is lost: the query cannot be told successful
+            logger.error(f"{self.name} called System.exit, which the host could not trap, see {self.log_file}")
+            self.stop(graceful=False)
+            return ENGINE_HOST_EXIT
+        else:
+            logger.error(f"{self.name} host ended without replying, see {self.log_file}")
+            self.stop(graceful=False)
+            return 1
+
+def engine_host(config, name, main_class, batch_id, module=None):
+    """Create the host of an engine, following the evaluation.engine_host section of the config.
+
+    Args:
+        config (dict): The evaluation config.
+        name (str): The name of the engine in evaluation.engines.
+        main_class (str): The class whose main is called for each query.
+        batch_id (int): The batch.
+        module (str, optional): The Maven module holding the main class.
+
+    Returns:
+        EngineHost: the host, None in mvn mode, where each query runs through mvn exec:java.
+    """
+    host_config = config["evaluation"].get("engine_host") or {}
+    mode = host_config.get("mode") or "mvn"
+    if mode not in ENGINE_HOST_MODES:
+        raise ValueError(f"Unknown engine host mode {mode}, expected one of {ENGINE_HOST_MODES}!")
+    if mode == "mvn":
+        return None
+    
+    proxy_host = config["evaluation"]["proxy"]["host"]
+    proxy_port = config["evaluation"]["proxy"]["port"]
+    jvm_args = [ f"-Dhttp.proxyHost={proxy_host}", f"-Dhttp.proxyPort={proxy_port}", "-Dhttp.nonProxyHosts=" ]
+    jvm_args += list(host_config.get("jvm_args") or [])
+    
+    return EngineHost(
+        name, config["evaluation"]["engines"][name]["dir"], main_class, batch_id, module=module, 
+        mode=mode, warmup=int(host_config.get("warmup") or 0), jvm_args=jvm_args
+    )
+
+def stop_engine_hosts(config):
+    """Stop the hosts of every engine and batch, e.g, those left running by warm mode at the end of an evaluation.
+    Each host is stopped under its lock, once the query it may be running is over.
+
+    Args:
+        config (dict): The evaluation config.
+
+    Returns:
+        int: the number of hosts stopped.
+    """
+    n_stopped = 0
+    for name, engine_config in config["evaluation"]["engines"].items():
+        state_dir = os.path.join(os.path.realpath(engine_config["dir"]), "target", "fedshop-host")
+        for pid_file in glob.glob(os.path.join(glob.escape(state_dir), f"{glob.escape(name)}_batch*.pid")):
+            batch_id = re.search(r"_batch(-?\d+)\.pid$", pid_file).group(1)
+            host = EngineHost(name, engine_config["dir"], None, batch_id)
+            with open(host.lock_file, "w") as lock_fs:
+                fcntl.flock(lock_fs, fcntl.LOCK_EX)
+                if host.pid() is not None:
+                    logger.info(f"Stopping {name} host of batch {batch_id}...")
+                    n_stopped += 1
+                # Also removes the files of a host that died
+                host.stop()
+    return n_stopped
 
 # How to use
 # 1. Duplicate this file and rename the new file with <engine>.py
@@ -157,5 +472,16 @@ def generate_config_file(ctx: click.Context, datafiles, outfile, eval_config, ba
     """
     pass
 
+@cli.command("stop-engine-hosts")
+@click.argument("eval-config", type=click.Path(exists=True, file_okay=True, dir_okay=True))
+def stop_engine_hosts_cmd(eval_config):
+    """Stop the engine hosts left running, see stop_engine_hosts. Shared by all engines, not to be duplicated.
+
+    Args:
+        eval_config (str): The evaluation config.
+    """
+    n_stopped = stop_engine_hosts(load_config(eval_config))
+    logger.info(f"Stopped {n_stopped} engine hosts")
+
 if __name__ == "__main__":
     cli()
\ No newline at end of file
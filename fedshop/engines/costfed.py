@@ -17,7 +17,8 @@ import psutil
 import sys
 sys.path.append(str(os.path.join(Path(__file__).parent.parent)))
 
-from utils import load_config, fedshop_logger, str2n3, create_stats
+from utils import load_config, fedshop_logger, lookup_triple_pattern, str2n3, create_stats
+from engines.TemplateEngine import engine_host
 import fedx
 
 logger = fedshop_logger(Path(__file__).name)
@@ -91,10 +92,6 @@ def run_benchmark(ctx: click.Context, eval_config, query, out_result, out_source
     proxy_server = config["evaluation"]["proxy"]["endpoint"]
     endpoints_file = f"summaries/endpoints_batch{batch_id}.txt"
     
-    # Reset the proxy stats
-    if requests.get(proxy_server + "reset").status_code != 200:
-        raise RuntimeError("Could not reset statistics on proxy!")
-
     oldcwd = os.getcwd()
     summary_file = f"summaries/sum_fedshop_batch{batch_id}.n3"   
 
@@ -102,23 +99,43 @@ def run_benchmark(ctx: click.Context, eval_config, query, out_result, out_source
     Path(out_result).touch()
     Path(out_source_selection).touch()
     Path(query_plan).touch()
-
-    timeoutCmd = f'timeout --signal=SIGKILL {timeout}' if timeout != 0 else ""
-    cmd = f'{timeoutCmd} mvn exec:java -Dhttp.proxyHost="{proxy_host}" -Dhttp.proxyPort="{proxy_port}" -Dhttp.nonProxyHosts="" -Dexec.mainClass="org.aksw.simba.start.QueryEvaluation" -Dexec.args="costfed/costfed.props ../../{out_result} ../../{out_source_selection} ../../{query_plan} {timeout+10} {summary_file} ../../{query} {str(noexec).lower()} {endpoints_file}" -pl costfed'
-
-    logger.debug("=== CostFed ===")
-    logger.debug(cmd)
-    logger.debug("============")
-
-    os.chdir(Path(engine_dir))
-    costfed_proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    os.chdir(oldcwd)
+    
+    args = ["costfed/costfed.props", f"../../{out_result}", f"../../{out_source_selection}", f"../../{query_plan}", str(timeout+10), summary_file, f"../../{query}", str(noexec).lower(), endpoints_file]
+    
+    # Without mvn exec:java, on a long-lived JVM, warmed up before the proxy stats are reset
+    host = engine_host(config, "costfed", "org.aksw.simba.start.QueryEvaluation", batch_id, module="costfed")
+    if host is not None:
+        host.acquire()
     
     failed_reason = None
     
     try:        
-        costfed_proc.wait(timeout)
-        if costfed_proc.returncode == 0:
+        if host is not None:
+            host.warm_up(args, timeout)
+            # The warm-up runs filled the on-disk cache, which is otherwise removed after each query
+            Path(f"{engine_dir}/cache.db").unlink(missing_ok=True)
+        
+        # Reset the proxy stats
+        if requests.get(proxy_server + "reset").status_code != 200:
+            raise RuntimeError("Could not reset statistics on proxy!")
+
+        timeoutCmd = f'timeout --signal=SIGKILL {timeout}' if timeout != 0 else ""
+        cmd = f'{timeoutCmd} mvn exec:java -Dhttp.proxyHost="{proxy_host}" -Dhttp.proxyPort="{proxy_port}" -Dhttp.nonProxyHosts="" -Dexec.mainClass="org.aksw.simba.start.QueryEvaluation" -Dexec.args="{" ".join(args)}" -pl costfed'
+
+        logger.debug("=== CostFed ===")
+        logger.debug(cmd if host is None else f"{host.mode} host: {args}")
+        logger.debug("============")
+
+        if host is None:
+            os.chdir(Path(engine_dir))
+            costfed_proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            os.chdir(oldcwd)
+            returncode = costfed_proc.wait(timeout)
+        else:
+            # Non-zero as well when the engine ended the host, see ENGINE_HOST_EXIT
+            returncode = host.run(args, timeout)
+            
+        if returncode == 0:
             logger.info(f"{query} benchmarked sucessfully")
             
         else:
@@ -129,7 +146,10 @@ def run_benchmark(ctx: click.Context, eval_config, query, out_result, out_source
         logger.exception(f"{query} timed out!")        
         failed_reason = "timeout"
     finally:
-        os.system('pkill -9 -f "costfed/target"')
+        if host is None:
+            os.system('pkill -9 -f "costfed/target"')
+        else:
+            host.release()
         cache_file = f"{engine_dir}/cache.db"
         Path(cache_file).unlink(missing_ok=True)
         #kill_process(fedx_proc.pid)     
@@ -240,7 +260,7 @@ def transform_provenance(ctx: click.Context, infile, outfile, prefix_cache):
         return result
     
     def lookup_composition(x: str):
-        return inv_composition[x]
+        return lookup_triple_pattern(composition_file, x)[-1]
     
     def pad(x):
         encoder = LabelEncoder()
@@ -250,11 +270,10 @@ def transform_provenance(ctx: click.Context, infile, outfile, prefix_cache):
         return decoded
     
     in_df = pd.read_csv(infile)
+    composition_file = os.path.join(Path(prefix_cache).parent, "composition.json")
     
-    with open(prefix_cache, "r") as prefix_cache_fs, open(os.path.join(Path(prefix_cache).parent, "composition.json"), "r") as comp_fs:
+    with open(prefix_cache, "r") as prefix_cache_fs:
         prefix2alias = json.load(prefix_cache_fs)    
-        composition = json.load(comp_fs)
-        inv_composition = {f"{' '.join(v)}": k for k, v in composition.items()}
             
         out_df = None
         for key in in_df.keys():
@@ -16,7 +16,7 @@ import sys
 import requests
 sys.path.append(str(os.path.join(Path(__file__).parent.parent)))
 
-from utils import create_stats, kill_process, load_config, fedshop_logger, str2n3
+from utils import create_stats, kill_process, load_config, fedshop_logger, lookup_triple_pattern, str2n3
 logger = fedshop_logger(Path(__file__).name)
 
 import fedx
@@ -184,10 +184,9 @@ def run_benchmark(ctx: click.Context, eval_config, engine_config, query, out_res
             tpAliases = json.loads(str(output["tpAliases"].item()).replace("'", '"').replace("\\n", ""))
 
             prefix_cache = os.path.join("../../", Path(query).parent, "prefix_cache.json")
-            comp = json.load(open(os.path.join(Path(prefix_cache).parent, "composition.json"), "r"))
+            composition_file = os.path.join(Path(prefix_cache).parent, "composition.json")
             prefix2alias = json.load(open(prefix_cache, "r"))
 
-            inv_comp = {f"{' '.join(v)}": k for k, v in comp.items()}
             records = []
                         
             for sa in source_assignments_in:
@@ -195,7 +194,11 @@ def run_benchmark(ctx: click.Context, eval_config, engine_config, query, out_res
                 for tp, source in sa.items():
                     alias = tpAliases[tp]
                     triple = extract_triple(alias, prefix2alias)
-                    record[inv_comp.get(triple)] = source
+                    try:
+                        tp_name = lookup_triple_pattern(composition_file, triple, prefixes=prefix2alias)[-1]
+                    except KeyError:
+                        tp_name = None
+                    record[tp_name] = source
                     source = re.sub(r"http://(www\.\w+\.fr)/", r"\1", source)
                     
                 records.append(record)
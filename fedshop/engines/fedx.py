@@ -14,7 +14,8 @@ from sklearn.preprocessing import LabelEncoder
 import sys
 sys.path.append(str(os.path.join(Path(__file__).parent.parent)))
 
-from utils import load_config, fedshop_logger, str2n3, create_stats
+from utils import load_config, fedshop_logger, lookup_triple_pattern, str2n3, create_stats
+from engines.TemplateEngine import ENGINE_HOST_EXIT, engine_host
 logger = fedshop_logger(Path(__file__).name)
 
 @click.group
@@ -52,36 +53,52 @@ def exec_fedx(eval_config, query, out_result, out_source_selection, query_plan,
     proxy_host = config["evaluation"]["proxy"]["host"]
     proxy_port = config["evaluation"]["proxy"]["port"]
     
-    # Reset the proxy stats
-    if requests.get(proxy_server + "reset").status_code != 200:
-        raise RuntimeError("Could not reset statistics on proxy!")
-
     args = [engine_config, query, out_result, out_source_selection, query_plan, str(timeout+10), str(noexec).lower()]
-    args = " ".join(args)
-    timeoutCmd = f'timeout --signal=SIGKILL {timeout}' if timeout != 0 else ""
-    #timeoutCmd = ""
-    cmd = f'{timeoutCmd} mvn exec:java -Dhttp.proxyHost="{proxy_host}" -Dhttp.proxyPort="{proxy_port}" -Dhttp.nonProxyHosts="" -Dexec.mainClass="org.example.FedX" -Dexec.args="{args}"'.strip()
+    
+    # Without mvn exec:java, on a long-lived JVM, warmed up before the proxy stats are reset
+    host = engine_host(config, "fedx", "org.example.FedX", batch_id)
+    if host is not None:
+        host.acquire()
+    
+    failed_reason = None
+    try:
+        if host is not None:
+            host.warm_up(args, timeout)
+        
+        # Reset the proxy stats
+        if requests.get(proxy_server + "reset").status_code != 200:
+            raise RuntimeError("Could not reset statistics on proxy!")
 
-    logger.debug("=== FedX ===")
-    logger.debug(cmd)
-    logger.debug("============")
+        timeoutCmd = f'timeout --signal=SIGKILL {timeout}' if timeout != 0 else ""
+        #timeoutCmd = ""
+        cmd = f'{timeoutCmd} mvn exec:java -Dhttp.proxyHost="{proxy_host}" -Dhttp.proxyPort="{proxy_port}" -Dhttp.nonProxyHosts="" -Dexec.mainClass="org.example.FedX" -Dexec.args="{" ".join(args)}"'.strip()
 
-    os.chdir(Path(engine_dir))
-    fedx_proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
-    failed_reason = None
-    try:        
-        fedx_proc.wait(timeout)
-        if fedx_proc.returncode == 0:
+        logger.debug("=== FedX ===")
+        logger.debug(cmd if host is None else f"{host.mode} host: {args}")
+        logger.debug("============")
+
+        os.chdir(Path(engine_dir))
+        if host is None:
+            fedx_proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+            returncode = fedx_proc.wait(timeout)
+        else:
+            returncode = host.run(args, timeout)
+            
+        if returncode == 0:
             logger.info(f"{query} benchmarked sucessfully")
         else:
             logger.error(f"{query} reported error")    
-            if not os.path.exists(stats):
+            # With ENGINE_HOST_EXIT, the engine ended the host with an unknown exit code
+            if not os.path.exists(stats) or returncode == ENGINE_HOST_EXIT:
                 failed_reason = "error_runtime"
     except subprocess.TimeoutExpired: 
         logger.exception(f"{query} timed out!")
         failed_reason = "timeout"
     finally:
-        os.system('pkill -9 -f "FedX-1.0-SNAPSHOT.jar"')
+        if host is None:
+            os.system('pkill -9 -f "FedX-1.0-SNAPSHOT.jar"')
+        else:
+            host.release()
 
     # Write stats
     if stats != "/dev/null":            
@@ -181,7 +198,7 @@ def transform_provenance(infile, outfile, composition_file):
         return result
     
     def lookup_composition(x: str):
-        return inv_composition[x]
+        return lookup_triple_pattern(composition_file, x)[-1]
     
     def pad(x):
         encoder = LabelEncoder()
@@ -191,26 +208,22 @@ def transform_provenance(infile, outfile, composition_file):
         return decoded
     
     in_df = pd.read_csv(infile)
-        
-    with open(composition_file, "r") as comp_fs:
-        composition = json.load(comp_fs)
-        inv_composition = {f"{' '.join(v)}": k for k, v in composition.items()}
                         
-        in_df["triple"] = in_df["triple"].apply(extract_triple)
-        in_df["tp_name"] = in_df["triple"].apply(lookup_composition)
-        in_df["tp_number"] = in_df["tp_name"].str.replace("tp", "", regex=False).astype(int)
-        in_df.sort_values("tp_number", inplace=True)
-        in_df["source_selection"] = in_df["source_selection"].apply(extract_source_selection)
+    in_df["triple"] = in_df["triple"].apply(extract_triple)
+    in_df["tp_name"] = in_df["triple"].apply(lookup_composition)
+    in_df["tp_number"] = in_df["tp_name"].str.replace("tp", "", regex=False).astype(int)
+    in_df.sort_values("tp_number", inplace=True)
+    in_df["source_selection"] = in_df["source_selection"].apply(extract_source_selection)
 
-        # If unequal length (as in union, optional), fill with nan
-        max_length = in_df["source_selection"].apply(len).max()
-        #in_df["source_selection"] = in_df["source_selection"].apply(pad)
-                
-        out_df = in_df.set_index("tp_name")["source_selection"] \
-            .to_frame().T \
-            .apply(pd.Series.explode) \
-            .reset_index(drop=True) 
-        out_df.to_csv(outfile, index=False)
+    # If unequal length (as in union, optional), fill with nan
+    max_length = in_df["source_selection"].apply(len).max()
+    #in_df["source_selection"] = in_df["source_selection"].apply(pad)
+            
+    out_df = in_df.set_index("tp_name")["source_selection"] \
+        .to_frame().T \
+        .apply(pd.Series.explode) \
+        .reset_index(drop=True) 
+    out_df.to_csv(outfile, index=False)
 
 @cli.command()
 @click.argument("eval-config", type=click.Path(exists=True, dir_okay=False, file_okay=True))
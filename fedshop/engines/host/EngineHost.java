@@ -0,0 +1,133 @@
+import java.io.BufferedReader;
+import java.io.InputStreamReader;
+import java.io.OutputStreamWriter;
+import java.io.PrintWriter;
+import java.lang.reflect.InvocationTargetException;
+import java.lang.reflect.Method;
+import java.net.InetAddress;
+import java.net.ServerSocket;
+import java.net.Socket;
+import java.nio.charset.StandardCharsets;
+import java.nio.file.Files;
+import java.nio.file.Path;
+import java.nio.file.Paths;
+import java.nio.file.StandardCopyOption;
+import java.security.Permission;
+import java.util.ArrayList;
+import java.util.List;
+
+/**
+ * Long-lived JVM running the command line of an engine, so that Maven, the JVM startup
+ * and the class loading are paid once per engine and batch instead of once per query.
+ *
+ * Usage: java -cp <engine classpath>:<this class> EngineHost <main class> <port file>
+ *
+ * The main class is loaded once. The host listens on a loopback port, written to the port file,
+ * and serves one request at a time: the arguments of main, one per line, ended by an empty line.
+ * The reply is a single line:
+ * - "OK <elapsed ms>" when main returned, or called System.exit(0);
+ * - "ERR <elapsed ms> <message>" when main threw, or called System.exit with another status;
+ * - "EXIT <elapsed ms>" when main called System.exit and the host could not trap it,
+ *   see trapExit, in which case the host ends with the request.
+ * The request "STOP" ends the host.
+ *
+ * See EngineHost in fedshop/engines/TemplateEngine.py for the client.
+ */
+public class EngineHost {
+
+    /** Thrown instead of exiting when an engine calls System.exit. */
+    static class ExitTrappedException extends SecurityException {
+        final int status;
+
+        ExitTrappedException(int status) {
+            super("System.exit(" + status + ")");
+            this.status = status;
+        }
+    }
+
+    /** The connection of the request being served, to reply from the shutdown hook. */
+    private static volatile PrintWriter current;
+    private static volatile long started;
+
+    public static void main(String[] args) throws Exception {
+        Method main = Class.forName(args[0]).getMethod("main", String[].class);
+        Path portFile = Paths.get(args[1]);
+
+        trapExit();
+        Runtime.getRuntime().addShutdownHook(new Thread(() -> reply("EXIT " + elapsed())));
+
+        try (ServerSocket server = new ServerSocket(0, 1, InetAddress.getLoopbackAddress())) {
+            // Publish the port once the host accepts connections
+            Path tmpPortFile = portFile.resolveSibling(portFile.getFileName() + ".tmp");
+            Files.write(tmpPortFile, String.valueOf(server.getLocalPort()).getBytes(StandardCharsets.UTF_8));
+            Files.move(tmpPortFile, portFile, StandardCopyOption.REPLACE_EXISTING, StandardCopyOption.ATOMIC_MOVE);
+
+            while (true) {
+                try (Socket socket = server.accept()) {
+                    BufferedReader in = new BufferedReader(new InputStreamReader(socket.getInputStream(), StandardCharsets.UTF_8));
+                    PrintWriter out = new PrintWriter(new OutputStreamWriter(socket.getOutputStream(), StandardCharsets.UTF_8), true);
+
+                    List<String> request = new ArrayList<>();
+                    String line;
+                    while ((line = in.readLine()) != null && !line.isEmpty()) {
+                        request.add(line);
+                    }
+
+                    if (request.size() == 1 && request.get(0).equals("STOP")) {
+                        out.println("OK 0");
+                        Runtime.getRuntime().halt(0);
+                    }
+
+                    started = System.nanoTime();
+                    current = out;
+                    String reply;
+                    try {
+                        main.invoke(null, (Object) request.toArray(new String[0]));
+                        reply = "OK " + elapsed();
+                    } catch (InvocationTargetException e) {
+                        Throwable cause = e.getCause();
+                        if (cause instanceof ExitTrappedException && ((ExitTrappedException) cause).status == 0) {
+                            reply = "OK " + elapsed();
+                        } else {
+                            reply = "ERR " + elapsed() + " " + String.valueOf(cause).replace('\n', ' ');
+                        }
+                    }
+                    reply(reply);
+                }
+            }
+        }
+    }
+
+    /**
+     * Turn System.exit into an exception, so that the host survives engines calling it at the end of main.
+     * Java 18 to 23 only allow it with -Djava.security.manager=allow, which the client adds, and Java 24 not at all:
+     * an exit then ends the host, and the client reports the query as failed.
+     */
+    private static void trapExit() {
+        try {
+            System.setSecurityManager(new SecurityManager() {
+                @Override
+                public void checkPermission(Permission perm) {
+                }
+
+                @Override
+                public void checkExit(int status) {
+                    throw new ExitTrappedException(status);
+                }
+            });
+        } catch (UnsupportedOperationException | SecurityException e) {
+            System.err.println("EngineHost: System.exit cannot be trapped, the host ends with the first engine calling it");
+        }
+    }
+
+    private static synchronized void reply(String reply) {
+        if (current != null) {
+            current.println(reply);
+            current = null;
+        }
+    }
+
+    private static long elapsed() {
+        return (System.nanoTime() - started) / 1000000;
+    }
+}
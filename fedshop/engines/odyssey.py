@@ -15,7 +15,7 @@ import sys
 sys.path.append(str(os.path.join(Path(__file__).parent.parent)))
 #sys.set_int_max_str_digits(0)
 
-from utils import kill_process, load_config, str2n3
+from utils import kill_process, load_config, lookup_triple_pattern, str2n3
 # Example of use : 
 # python3 utils/generate-fedx-config-file.py experiments/bsbm/model/vendor test/out.ttl
 
@@ -381,8 +381,7 @@ def transform_result(infile, outfile, prefix_cache):
     in_df = pd.read_csv(infile)
     
     prefix2alias = json.load(open(prefix_cache, "r"))    
-    composition = json.load(open(os.path.join(Path(prefix_cache).parent, "composition.json"), "r"))
-    inv_composition = {f"{' '.join(v)}": k for k, v in composition.items()}
+    composition_file = os.path.join(Path(prefix_cache).parent, "composition.json")
     
     def extract_triple(x):
         fedx_pattern = r"StatementPattern\s+(\(new scope\)\s+)?Var\s+\((name=\w+,\s+value=(.*),\s+anonymous|name=(\w+))\)\s+Var\s+\((name=\w+,\s+value=(.*),\s+anonymous|name=(\w+))\)\s+Var\s+\((name=\w+,\s+value=(.*),\s+anonymous|name=(\w+))\)"
@@ -418,7 +417,7 @@ def transform_result(infile, outfile, prefix_cache):
         return result
     
     def lookup_composition(x: str):
-        return inv_composition[x]
+        return lookup_triple_pattern(composition_file, x, prefixes=prefix2alias)[-1]
         
     
     in_df["triple"] = in_df["triple"].apply(extract_triple)
@@ -18,9 +18,9 @@ import requests
 from tqdm import tqdm
 sys.path.append(str(os.path.join(Path(__file__).parent.parent)))
 
-from algebra.rdflib_algebra import add_service_to_triple_blocks, add_values_with_placeholders
+from algebra.rdflib_algebra import add_service_to_triple_blocks, add_values_with_rows, rewrite
 from utils import load_config, fedshop_logger, create_stats
-from query import export_query, exec_query_on_endpoint, parse_query_proc
+from query import export_query, exec_query_on_endpoint, parse_query_proc, read_query_result
 from rdflib.plugins.sparql.algebra import traverse
 
 logger = fedshop_logger(Path(__file__).name)
@@ -132,16 +132,19 @@ def create_service_query_manually(ctx: click.Context, eval_config, query, query_
     with open(proxy_mapping_file, "r") as proxy_mapping_fs:
         proxy_mapping = json.load(proxy_mapping_fs)
     
-    source_selection_combinations = source_selection_df \
-        .applymap(lambda x: URIRef(proxy_mapping[x]).n3()) \
-        .apply(lambda x: f"( {' '.join(x)} )", axis=1) \
-        .to_list()
+    # One row per combination of sources, serialized by whole columns
+    inline_data = { column: source_selection_df[column].map(proxy_mapping).to_list() for column in source_selection_df.columns }
+    datatypes = { column: "iri" for column in source_selection_df.columns }
         
     query_algebra, query_options = parse_query_proc(queryfile=query)
     
-    inline_data = dict(zip(source_selection_df.columns, source_selection_combinations)) 
-    query_algebra = traverse(query_algebra, visitPost=lambda node: add_values_with_placeholders(node, inline_data))
-    query_algebra = traverse(query_algebra, visitPost=lambda node: add_service_to_triple_blocks(node, inline_data))
+    prologue = query_algebra[0]
+    service_memo = {}
+    query_algebra = rewrite(
+        query_algebra,
+        lambda node: add_values_with_rows(node, inline_data, datatypes),
+        lambda node: add_service_to_triple_blocks(node, prologue=prologue, memo=service_memo)
+    )
     
     export_query(query_algebra, query_options, outfile=query_plan)
     
@@ -259,14 +262,14 @@ def run_benchmark(ctx: click.Context, eval_config, engine_config, query, out_res
     # else:
     out_query_text = ctx.invoke(create_service_query, eval_config=eval_config, query=query, query_plan=query_plan, force_source_selection=force_source_selection)
     response, result = exec_query_on_endpoint(out_query_text, endpoint, error_when_timeout=True, timeout=timeout)
+    
+    # The result is streamed, so it is only complete once read
+    csvOut = read_query_result(result)
         
     endTime = time.time()
     exec_time = (endTime - startTime)*1e3
     
-    with BytesIO(result) as header_stream, BytesIO(result) as data_stream: 
-        header = header_stream.readline().decode().strip().replace('"', '').split(",")
-        csvOut = pd.read_csv(data_stream, parse_dates=[h for h in header if "date" in h])                
-        csvOut.to_csv(out_result, index=False)
+    csvOut.to_csv(out_result, index=False)
         
     if csvOut.empty:
         raise RuntimeError("Query yields no results")
@@ -19,7 +19,8 @@ import sys
 sys.path.append(str(os.path.join(Path(__file__).parent.parent)))
 
 from query import execute_query
-from utils import load_config, fedshop_logger, str2n3, create_stats, create_stats
+from utils import load_config, fedshop_logger, lookup_triple_pattern, str2n3, create_stats, create_stats
+from engines.TemplateEngine import engine_host
 import fedx
 
 logger = fedshop_logger(Path(__file__).name)
@@ -105,10 +106,6 @@ def run_benchmark(ctx: click.Context, eval_config, query, out_result, out_source
     proxy_port = config["evaluation"]["proxy"]["port"]
     proxy_server = config["evaluation"]["proxy"]["endpoint"]
     
-    # Reset the proxy stats
-    if requests.get(proxy_server + "reset").status_code != 200:
-        raise RuntimeError("Could not reset statistics on proxy!")
-    
     #cmd = f"./semagrow.sh "
     out_result = os.path.realpath(out_result)
     out_source_selection = os.path.realpath(out_source_selection)
@@ -116,26 +113,44 @@ def run_benchmark(ctx: click.Context, eval_config, query, out_result, out_source
     query = os.path.realpath(query)
 
     tmp_results_file = Path(out_result).with_suffix('.csv')
-    noexec = "--noexec" if noexec else ""
+    args = ["--query", query, "--output", str(tmp_results_file), "--config", repo_file, "--metadata", summary_file]
+    if noexec:
+        args.append("--noexec")
     timeout_cmd = f'timeout --signal=SIGKILL {timeout}' if timeout != 0 else ""
-    cmd = f'{timeout_cmd} mvn exec:java -Dhttp.proxyHost="{proxy_host}" -Dhttp.proxyPort="{proxy_port}" -Dhttp.nonProxyHosts="" -pl "rdf4j/" -Dexec.mainClass="org.semagrow.cli.CliMain" -Dexec.args="--query {query} --output {tmp_results_file} --config {repo_file} --metadata {summary_file} {noexec}"'
-
-    logger.debug("=== Semagrow ===")
-    logger.debug(cmd)
-    logger.debug("============")
+    cmd = f'{timeout_cmd} mvn exec:java -Dhttp.proxyHost="{proxy_host}" -Dhttp.proxyPort="{proxy_port}" -Dhttp.nonProxyHosts="" -pl "rdf4j/" -Dexec.mainClass="org.semagrow.cli.CliMain" -Dexec.args="{" ".join(args)}"'
 
     os.chdir(Path(app))
 
     shutil.copy(repo_file, "repository.ttl")
     shutil.copy(summary_file, "metadata.ttl")
-        
-    semagrow_proc = subprocess.Popen(cmd.strip(), shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    
+    # Without mvn exec:java, on a long-lived JVM, warmed up before the proxy stats are reset
+    host = engine_host(config, "semagrow", "org.semagrow.cli.CliMain", batch_id, module="rdf4j")
+    if host is not None:
+        host.acquire()
     
     failed_reason = None
     
     try:        
-        semagrow_proc.wait(timeout)
-        if semagrow_proc.returncode == 0:
+        if host is not None:
+            host.warm_up(args, timeout)
+        
+        # Reset the proxy stats
+        if requests.get(proxy_server + "reset").status_code != 200:
+            raise RuntimeError("Could not reset statistics on proxy!")
+
+        logger.debug("=== Semagrow ===")
+        logger.debug(cmd if host is None else f"{host.mode} host: {args}")
+        logger.debug("============")
+        
+        if host is None:
+            semagrow_proc = subprocess.Popen(cmd.strip(), shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            returncode = semagrow_proc.wait(timeout)
+        else:
+            # Non-zero as well when the engine ended the host, see ENGINE_HOST_EXIT
+            returncode = host.run(args, timeout)
+            
+        if returncode == 0:
             logger.info(f"{query} benchmarked sucessfully")
             
             shutil.copy(tmp_results_file, out_result)
@@ -161,7 +176,10 @@ def run_benchmark(ctx: click.Context, eval_config, query, out_result, out_source
         failed_reason = "timeout"
         
     finally:
-        os.system('pkill -9 -f "mainClass=org.semagrow.cli.CliMain"')
+        if host is None:
+            os.system('pkill -9 -f "mainClass=org.semagrow.cli.CliMain"')
+        else:
+            host.release()
         #cache_file = f"{app}/cache.db"
         #Path(cache_file).unlink(missing_ok=True)
         #kill_process(fedx_proc.pid)    
@@ -251,11 +269,7 @@ def transform_provenance(ctx: click.Context, infile, outfile, prefix_cache):
         return result
     
     def lookup_composition(x: str):
-        result = re.sub(r"[\[\]]", "", x).strip()
-        for prefix, alias in prefix2alias.items():
-            result = re.sub(rf"<{re.escape(prefix)}(\w+)>", rf"{alias}:\1", result)
-                        
-        return inv_comp[result] 
+        return lookup_triple_pattern(composition_file, x, prefixes=prefix2alias)
     
     def pad(x):
         encoder = LabelEncoder()
@@ -275,18 +289,9 @@ def transform_provenance(ctx: click.Context, infile, outfile, prefix_cache):
     # os.remove(tmp_file)
     # #print(in_df)
     
-    with    open(prefix_cache, "r") as prefix_cache_fs, \
-            open(os.path.join(Path(prefix_cache).parent, "composition.json"), "r") as comp_fs \
-    :
+    composition_file = os.path.join(Path(prefix_cache).parent, "composition.json")
+    with open(prefix_cache, "r") as prefix_cache_fs:
         prefix2alias = json.load(prefix_cache_fs)    
-        composition = json.load(comp_fs)
-                
-        comp = { k: " ".join(v) for k, v in composition.items() }
-        inv_comp = {}
-        for k,v in comp.items():
-            if inv_comp.get(v) is None:
-                inv_comp[v] = []
-            inv_comp[v].append(k) 
                                     
         in_df["tps"] = in_df["tps"].apply(extract_triple)
         in_df["tp_name"] = in_df["tps"].apply(lookup_composition)
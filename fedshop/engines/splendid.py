@@ -18,7 +18,7 @@ import requests
 from sklearn.calibration import LabelEncoder
 sys.path.append(str(os.path.join(Path(__file__).parent.parent)))
 
-from utils import check_container_status, kill_process, load_config, fedshop_logger, create_stats
+from utils import check_container_status, kill_process, load_config, fedshop_logger, create_stats, lookup_triple_pattern
 import fedx
 
 logger = fedshop_logger(Path(__file__).name)
@@ -196,24 +196,11 @@ def transform_provenance(ctx: click.Context, infile, outfile, prefix_cache):
     raw_source_selection = pd.read_csv(infile, sep=";")[["triples", "sources"]]
     
     tp_composition = f"{Path(prefix_cache).parent}/composition.json"
-    with    open(tp_composition, "r") as comp_fs,\
-            open(prefix_cache, "r") as prefix_cache_fs \
-    :
+    with open(prefix_cache, "r") as prefix_cache_fs:
         prefix_cache_dict = json.load(prefix_cache_fs)
         
-        comp = { k: " ".join(v) for k, v in json.load(comp_fs).items() }
-        inv_comp = {}
-        for k,v in comp.items():
-            if inv_comp.get(v) is None:
-                inv_comp[v] = []
-            inv_comp[v].append(k) 
-        
         def get_triple_id(x):
-            result = re.sub(r"[\[\]]", "", x).strip()
-            for prefix, alias in prefix_cache_dict.items():
-                result = re.sub(rf"<{re.escape(prefix)}(\w+)>", rf"{alias}:\1", result)
-                        
-            return inv_comp[result] 
+            return lookup_triple_pattern(tp_composition, x, prefixes=prefix_cache_dict)
         
         def pad(x, max_length):
             encoder = LabelEncoder()
@@ -1,68 +1,215 @@
 from copy import deepcopy
 import glob
+import hashlib
 from itertools import chain
+import math
 import json
 from pathlib import Path
+import pickle
+import shutil
 from pprint import pprint
+import multiprocessing
 import subprocess
-
-from collections import Counter
+import threading
+import time
+
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import closing, nullcontext
+import csv
+from functools import lru_cache, partial, reduce
 import os
 from pathlib import Path
 from tqdm import tqdm
 
-from rdflib.term import Variable
+import rdflib
+from rdflib.term import Identifier, Literal, URIRef, Variable
 from rdflib.plugins.sparql.parser import parseQuery
-from rdflib.plugins.sparql.algebra import _traverseAgg, traverse, translateQuery, pprintAlgebra
+from rdflib.plugins.sparql.algebra import _traverseAgg, traverse, translatePName, translatePrologue, translateQuery, pprintAlgebra
 from rdflib.plugins.sparql.parserutils import CompValue
 
-from algebra.rdflib_algebra import add_graph_to_triple_pattern, add_values_with_placeholders, collect_triple_variables, collect_variables, disable_offset, disable_orderby_limit, extract_where, inject_constant_into_placeholders, remove_filter_with_placeholders, replace_select_projection_with_graph, translateAlgebra
-from algebra.pandas_algebra import collect_constants, parse_expr, translate_query
+from algebra.rdflib_algebra import add_graph_to_triple_pattern, add_projection_variables, add_values_with_rows, canonical_fingerprint, collect_triple_variables, collect_variables, disable_offset, disable_orderby_limit, extract_where, inject_constant_into_placeholders, normalize_column, normalize_constant, remove_filter_with_placeholders, replace_select_projection_with_graph, rewrite, translateAlgebra
+from algebra.pandas_algebra import collect_constants, compile_query, parse_expr, translate_query
 
 import re
 import numpy as np
 import pandas as pd
-from SPARQLWrapper import SPARQLWrapper, CSV
+import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlencode
 from io import BytesIO, StringIO
 import click
 
-from utils import load_config, fedshop_logger
+from utils import build_composition_index, composition_index_file, load_config, fedshop_logger
 logger = fedshop_logger(Path(__file__).name)
 
-import nltk
-
-nltk.download('stopwords', quiet=True)
-nltk.download('punkt', quiet=True)
-
-from nltk.corpus import stopwords as nltk_stopwords
-from nltk.tokenize import word_tokenize, RegexpTokenizer
-
-tokenizer = RegexpTokenizer(r"\w+")
-
-from ftlangdetect import detect
-from iso639 import Lang
 import tempfile
 
 PANDAS_RANDOM_STATE = 42
 WDQ_BIN_PATH = "fedshop/misc/wdq"
 
+# Parsed queries are cached by content hash: in memory for the process lifetime and,
+# when RSFB__PARSE_CACHE_DIR is set, on disk so that other CLI invocations can reuse them.
+PARSE_CACHE_SIZE = 256
+PARSE_CACHE_DIR = os.environ.get("RSFB__PARSE_CACHE_DIR")
+
+# SPARQL endpoints are queried through a pool of keep-alive connections.
+# Queries longer than SPARQL_MAX_GET_LENGTH once url-encoded are sent with POST, as servers limit the URL length.
+SPARQL_POOL_SIZE = int(os.environ.get("RSFB__SPARQL_POOL_SIZE", 16))
+SPARQL_MAX_GET_LENGTH = 2048
+
+# Processes sharing QUERY_SLOTS, e.g. the workers of generate-workloads, download at most that many results at once
+QUERY_SLOTS = None
+
+# Results are requested as SPARQL TSV, which spells out every value as an RDF term,
+# so that columns are typed from their datatypes rather than guessed from their names.
+SPARQL_RESULT_FORMAT = "text/tab-separated-values"
+XSD = "http://www.w3.org/2001/XMLSchema#"
+XSD_NUMERIC_TYPES = { f"{XSD}{t}" for t in [
+    "integer", "decimal", "double", "float", "long", "int", "short", "byte", 
+    "nonNegativeInteger", "nonPositiveInteger", "positiveInteger", "negativeInteger",
+    "unsignedLong", "unsignedInt", "unsignedShort", "unsignedByte"
+]}
+XSD_DATE_TYPES = { f"{XSD}{t}" for t in ["date", "dateTime", "dateTimeStamp"] }
+SPARQL_TERM_PATTERN = r'^(?:<(?P<iri>.*)>|_:(?P<bnode>.*)|"(?P<lexical>.*)"(?:\^\^<(?P<datatype>.*)>|@(?P<lang>[A-Za-z0-9-]+))?)$'
+TSV_ESCAPES = {"t": "\t", "n": "\n", "r": "\r", '"': '"', "'": "'", "\\": "\\"}
+
+# The result store is trimmed down to this many bytes, least recently used results first
+RESULT_STORE_MAX_SIZE = int(os.environ.get("RSFB__RESULT_STORE_MAX_SIZE", 10 * 1024**3))
+# Downloads of a result evicted by concurrent processes before it is read, until giving up
+RESULT_STORE_ATTEMPTS = 3
+
+# Paged results are split into ranges of the MD5 of their rows, bounds having PAGE_BOUND_DIGITS hex digits at least
+PAGE_BOUND_DIGITS = 2
+
+# Results are read by chunks of RESULT_CHUNK_SIZE rows, and downloaded by blocks of RESULT_CHUNK_BYTES
+RESULT_CHUNK_SIZE = 100000
+RESULT_CHUNK_BYTES = 1 << 20
+
+# Value selections are sampled while being read. Percentiles and placeholder candidates are
+# drawn from a sample of at most STATISTICS_SAMPLE_SIZE values per column, exact below that size.
+STATISTICS_SAMPLE_SIZE = int(os.environ.get("RSFB__STATISTICS_SAMPLE_SIZE", 1000000))
+
+# Batched exclusive probes tag the bindings of each instance with its id, in this variable
+INSTANCE_ID_VARIABLE = "fedshop_instance_id"
+
+# Placeholders of a compiled query template are stood in for by these IRIs
+PLACEHOLDER_SLOT_IRI = "urn:fedshop:placeholder:"
+
 @click.group
 def cli():
     pass
 
 
-stopwords = []
-for lang in ["english"]:
-    stopwords.extend(nltk_stopwords.words(lang))
+# nltk, ftlangdetect and iso639 are slow to import and most commands do not need them.
+# They are loaded on first use and kept for the rest of the process.
 
+@lru_cache(maxsize=None)
+def _load_nltk():
+    import nltk
+    nltk.download('stopwords', quiet=True)
+    nltk.download('punkt', quiet=True)
+    return nltk
+
+@lru_cache(maxsize=None)
+def get_stopwords():
+    _load_nltk()
+    from nltk.corpus import stopwords as nltk_stopwords
+    
+    stopwords = []
+    for lang in ["english"]:
+        stopwords.extend(nltk_stopwords.words(lang))
+    return stopwords
+
+@lru_cache(maxsize=None)
+def get_tokenizer():
+    _load_nltk()
+    from nltk.tokenize import RegexpTokenizer
+    return RegexpTokenizer(r"\w+")
+
+@lru_cache(maxsize=None)
+def _load_lang_detect():
+    from ftlangdetect import detect
+    from iso639 import Lang
+    return detect, Lang
+
+def __getattr__(name):
+    # Keep module.stopwords and module.tokenizer working without loading nltk at import time
+    if name == "stopwords":
+        return get_stopwords()
+    if name == "tokenizer":
+        return get_tokenizer()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 def lang_detect(txt):
+    detect, Lang = _load_lang_detect()
     lines = str(txt).splitlines()
     result = Counter(map(lambda x: Lang(detect(text=x, low_memory=False)["lang"]).name.lower(), lines)).most_common(1)[
         0]
     return result
 
 
+@lru_cache(maxsize=None)
+def _get_sparql_session(pid):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=SPARQL_POOL_SIZE, pool_maxsize=SPARQL_POOL_SIZE)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({"Accept": SPARQL_RESULT_FORMAT, "Accept-Encoding": "gzip, deflate"})
+    return session
+
+def get_sparql_session():
+    """Return the HTTP session of the current process, with its pool of keep-alive connections.
+
+    Sessions are keyed by pid, so that forked workers never share sockets with their parent.
+    """
+    return _get_sparql_session(os.getpid())
+
+def set_query_slots(slots):
+    """Share a semaphore bounding the results downloaded at once, by all threads and processes holding it.
+
+    Args:
+        slots (multiprocessing.BoundedSemaphore): The semaphore, or None to lift the bound.
+    """
+    global QUERY_SLOTS
+    QUERY_SLOTS = slots
+
+def query_slot():
+    """Context holding a query slot while a result is downloaded, see set_query_slots.
+    """
+    return QUERY_SLOTS if QUERY_SLOTS is not None else nullcontext()
+
+def sparql_request(query, endpoint, timeout=None, default_graph=None, stream=True):
+    """Send a query to a SPARQL endpoint, asking for TSV results, see decode_result_chunk.
+
+    Queries are sent with GET, unless their encoded form exceeds SPARQL_MAX_GET_LENGTH, e.g. with large VALUES clauses.
+
+    Args:
+        query (str): The query.
+        endpoint (str): The SPARQL endpoint.
+        timeout (float, optional): Seconds to wait for the endpoint. Defaults to None, i.e. wait forever.
+        default_graph (str, optional): The default graph IRI.
+        stream (bool, optional): If set, the body is downloaded as it is read. Defaults to True.
+
+    Raises:
+        requests.HTTPError: the endpoint answered with an error status.
+
+    Returns:
+        requests.Response: the response, decompressed on the fly.
+    """
+    params = {"query": query}
+    if default_graph is not None:
+        params["default-graph-uri"] = default_graph
+    
+    session = get_sparql_session()
+    if len(urlencode(params)) > SPARQL_MAX_GET_LENGTH:
+        response = session.post(endpoint, data=params, timeout=timeout, stream=stream)
+    else:
+        response = session.get(endpoint, params=params, timeout=timeout, stream=stream)
+    
+    response.raise_for_status()
+    return response
+
 def exec_query_on_endpoint(query, endpoint, error_when_timeout, timeout=None, default_graph=None):
     """Send a query to ANY endpoint
 
@@ -73,19 +220,24 @@ def exec_query_on_endpoint(query, endpoint, error_when_timeout, timeout=None, de
         timeout (_type_, optional): _description_. Defaults to None.
 
     Returns:
-        _type_: _description_
+        the response and a binary file object over the TSV result, read as it arrives, to be closed by the caller, 
+        e.g. with read_query_result.
     """
 
-    sparql_endpoint = SPARQLWrapper(endpoint, defaultGraph=default_graph)
-    if error_when_timeout and timeout is not None:
-        sparql_endpoint.setTimeout(int(timeout))
-
-    sparql_endpoint.setMethod("GET")
-    sparql_endpoint.setReturnFormat(CSV)
-    sparql_endpoint.setQuery(query)
-
-    response = sparql_endpoint.query()
-    result = response.convert()
+    if not error_when_timeout:
+        timeout = None
+    
+    with query_slot():
+        response = sparql_request(query, endpoint, timeout=timeout, default_graph=default_graph)
+        if QUERY_SLOTS is None:
+            response.raw.decode_content = True
+            return response, response.raw
+        
+        # The slot is only released once the result is downloaded, so spool it instead of handing over the response
+        result = tempfile.TemporaryFile()
+        for chunk in response.iter_content(chunk_size=RESULT_CHUNK_BYTES):
+            result.write(chunk)
+        result.seek(0)
     return response, result
 
 
@@ -102,6 +254,632 @@ def exec_query(query, endpoint, error_when_timeout=False):
     """
     return exec_query_on_endpoint(query, endpoint, error_when_timeout)
 
+def batch_datafiles(config, batch_id=None):
+    """List the .nq files ingested in the endpoint of a batch.
+
+    Args:
+        config (DictConfig): The configuration.
+        batch_id (int, optional): The batch. If None, all the .nq files of the dataset.
+
+    Returns:
+        list: the file paths.
+    """
+    data_dir = config["generation"]["virtuoso"]["data_dir"]
+    if batch_id is None:
+        return sorted(glob.glob(f"{data_dir}/*.nq"))
+    members = config["generation"]["virtuoso"]["federation_members"][f"batch{batch_id}"]
+    return [ f"{data_dir}/{member}.nq" for member in members.keys() ]
+
+def dataset_fingerprint(datafiles, result_store):
+    """Hash the content of data files, so that results obtained on other data are never reused.
+
+    Digests are kept in {result_store}/datasets.json and only recomputed for files whose size or mtime changed.
+
+    Args:
+        datafiles (list): The data files.
+        result_store (str): The directory of the result store.
+
+    Returns:
+        str: the sha256 hex digest.
+    """
+    digest_file = os.path.join(result_store, "datasets.json")
+    digests = {}
+    if os.path.exists(digest_file):
+        with open(digest_file, "r") as digest_fs:
+            digests = json.load(digest_fs)
+    
+    updated = False
+    fingerprint = hashlib.sha256()
+    for datafile in sorted(datafiles):
+        stat = os.stat(datafile)
+        entry = digests.get(os.path.realpath(datafile))
+        if entry is None or entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+            file_hash = hashlib.sha256()
+            with open(datafile, "rb") as data_fs:
+                for block in iter(lambda: data_fs.read(RESULT_CHUNK_BYTES), b""):
+                    file_hash.update(block)
+            entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": file_hash.hexdigest()}
+            digests[os.path.realpath(datafile)] = entry
+            updated = True
+        fingerprint.update(f"{Path(datafile).name}:{entry['sha256']}\n".encode())
+    
+    if updated:
+        Path(result_store).mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(mode="w", dir=result_store, delete=False) as tmp_fs:
+            json.dump(digests, tmp_fs)
+        os.replace(tmp_fs.name, digest_file)
+    
+    return fingerprint.hexdigest()
+
+def result_store_key(query_text, endpoint, batch_id=None, dataset=None):
+    """Key of a query result in the result store.
+
+    Equivalent queries, i.e. that only differ by formatting, prefixes, triple pattern order 
+    or the names of non-projected variables, share the same key for a given endpoint, batch and dataset.
+
+    Args:
+        query_text (str): The query.
+        endpoint (str): The SPARQL endpoint.
+        batch_id (int, optional): The batch the endpoint is serving.
+        dataset (str, optional): The fingerprint of the data ingested in the endpoint.
+
+    Returns:
+        str: the key.
+    """
+    options = {"endpoint": endpoint, "batch_id": batch_id, "dataset": dataset}
+    try:
+        algebra, _ = parse_query_proc(querydata=query_text)
+        return canonical_fingerprint(algebra, options=options)
+    except Exception as e:
+        # Virtuoso accepts some queries rdflib does not, fall back to the query text
+        logger.debug(f"Could not fingerprint query, falling back to its text: {e}")
+        canonical = " ".join(query_text.split()) + repr(sorted(options.items()))
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+def result_store_file(result_store, key, batch_id=None, dataset=None):
+    """Path of a result in the store. The batch and dataset are spelled out in the name so that entries can be invalidated by them.
+    """
+    batch_label = "any" if batch_id is None else batch_id
+    dataset_label = "any" if dataset is None else dataset[:16]
+    return os.path.join(result_store, f"batch{batch_label}.{dataset_label}.{key}.tsv")
+
+def evict_result_store(result_store, max_size=None, keep=None):
+    """Remove the least recently used results until the store fits in max_size bytes.
+
+    Args:
+        result_store (str): The directory of the result store.
+        max_size (int, optional): The size limit. Defaults to RESULT_STORE_MAX_SIZE.
+        keep (list, optional): Results never removed, e.g. the one just written, though their size counts.
+    """
+    if max_size is None:
+        max_size = RESULT_STORE_MAX_SIZE
+    keep = set() if keep is None else { os.path.realpath(store_file) for store_file in keep }
+    
+    entries = []
+    for store_file in glob.glob(os.path.join(result_store, "batch*")):
+        try:
+            stat = os.stat(store_file)
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, store_file))
+    
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, store_file in sorted(entries):
+        if total_size <= max_size:
+            break
+        if os.path.realpath(store_file) in keep:
+            continue
+        logger.debug(f"Evicting {store_file}")
+        try:
+            os.remove(store_file)
+        except FileNotFoundError:
+            pass
+        total_size -= size
+
+def download_query_result(query, endpoint, outfile):
+    """Stream the result of a query to a file. 
+    The file is written under another name then renamed, so that it is either complete or missing.
+    """
+    with query_slot(), tempfile.NamedTemporaryFile(mode="wb", dir=Path(outfile).parent, delete=False) as tmp_fs:
+        response = sparql_request(query, endpoint)
+        for chunk in response.iter_content(chunk_size=RESULT_CHUNK_BYTES):
+            tmp_fs.write(chunk)
+    os.replace(tmp_fs.name, outfile)
+
+def split_query_prologue(query):
+    """Split a query into its prologue (PREFIX, BASE, DEFINE...) and the SELECT query itself.
+    """
+    select_match = re.search(r"\bSELECT\b", query, re.IGNORECASE)
+    if select_match is None:
+        raise ValueError("Only SELECT queries can be paged!")
+    return query[:select_match.start()], query[select_match.start():]
+
+def projected_variables(query):
+    """The variables projected by a SELECT query, in order.
+
+    Raises:
+        ValueError: the query is not a SELECT query or projects *.
+    """
+    _, select_query = split_query_prologue(query)
+    projection = re.search(r"\bSELECT\b(.*?)\{", select_query, re.IGNORECASE | re.DOTALL).group(1)
+    variables = list(dict.fromkeys(re.findall(r"[?$](\w+)", projection)))
+    if "*" in projection or len(variables) == 0:
+        raise ValueError("The query needs an explicit projection!")
+    return variables
+
+def filter_hash_range(query, lower=None, upper=None, variables=None):
+    """Keep the rows of a SELECT query whose MD5 of the values of variables is in [lower, upper).
+
+    Rows are spread uniformly and deterministically over the range of hashes, whatever the order 
+    the endpoint returns them in. Bounds are prefixes of hex digests, e.g. "8" keeps about half of the rows.
+
+    Args:
+        query (str): The query, with an explicit projection.
+        lower (str, optional): The lower bound. Defaults to None, i.e. unbounded.
+        upper (str, optional): The upper bound. Defaults to None, i.e. unbounded.
+        variables (list, optional): The variables to hash. Defaults to all the projected ones.
+
+    Returns:
+        str: the query.
+    """
+    prologue, select_query = split_query_prologue(query)
+    projection = projected_variables(query)
+    if variables is None:
+        variables = projection
+    
+    row_hash = "MD5(CONCAT({}))".format(', "\\t", '.join([ f'COALESCE(STR(?{v}), "")' for v in variables ]))
+    conditions = []
+    if lower is not None:
+        conditions.append(f'{row_hash} >= "{lower}"')
+    if upper is not None:
+        conditions.append(f'{row_hash} < "{upper}"')
+    if len(conditions) == 0:
+        return query
+    
+    # Project explicitly, as results of several such queries are concatenated column by column
+    return f"{prologue}SELECT {' '.join(['?' + v for v in projection])} WHERE {{ {{ {select_query} }} FILTER({' && '.join(conditions)}) }}"
+
+def hash_bound(fraction, n_digits=PAGE_BOUND_DIGITS):
+    """The hex prefix below which the given fraction of MD5 digests falls.
+    """
+    return format(min(int(fraction * 16**n_digits), 16**n_digits - 1), f"0{n_digits}x")
+
+def paginate_query(query, n_pages):
+    """Split a SELECT query into pages holding disjoint ranges of rows, see filter_hash_range.
+
+    Rows are assigned to pages by the MD5 of their values, so that pages are stable and about the same size 
+    whatever the order the endpoint returns rows in, and can be fetched in any order. 
+    Unlike LIMIT/OFFSET pages, no ORDER BY is needed, hence no sort bounded by Virtuoso's MaxSortedTopRows.
+
+    Args:
+        query (str): The query, with an explicit projection.
+        n_pages (int): The number of pages.
+
+    Raises:
+        ValueError: the query is not a SELECT query or projects *.
+
+    Returns:
+        list: the query of every page.
+    """
+    projected_variables(query)
+    if n_pages <= 1:
+        return [query]
+    
+    n_digits = max(PAGE_BOUND_DIGITS, math.ceil(math.log(n_pages, 16)) + 1)
+    bounds = [None] + [ format(page_id * 16**n_digits // n_pages, f"0{n_digits}x") for page_id in range(1, n_pages) ] + [None]
+    return [ filter_hash_range(query, lower=bounds[page_id], upper=bounds[page_id+1]) for page_id in range(n_pages) ]
+
+def sample_query(query, fraction, variables=None):
+    """Sample a fraction of the rows of a SELECT query on the endpoint side, see filter_hash_range.
+    Sampling several queries on the variables they share keeps the rows that join.
+    """
+    n_digits = max(PAGE_BOUND_DIGITS, math.ceil(-math.log(fraction, 16)) + 2)
+    return filter_hash_range(query, upper=hash_bound(fraction, n_digits), variables=variables)
+
+def count_query_result(query, endpoint):
+    """Count the rows of the result of a query, on the endpoint side.
+    """
+    prologue, select_query = split_query_prologue(query)
+    count_query = f"{prologue}SELECT (COUNT(*) AS ?count) WHERE {{ {{ {select_query} }} }}"
+    with query_slot():
+        return int(read_query_result(sparql_request(count_query, endpoint).raw)["count"].iloc[0])
+
+def download_paged_query_result(query, endpoint, outfile, page_size, page_dir, n_jobs=1):
+    """Stream the result of a query to a file, page by page, see paginate_query.
+
+    Pages are fetched concurrently and checkpointed in page_dir as they complete. 
+    After a crash, calling again with the same arguments only fetches the missing pages. 
+    Once every page is there, they are concatenated into outfile and page_dir is removed.
+
+    Args:
+        query (str): The query.
+        endpoint (str): The SPARQL endpoint.
+        outfile (str): The TSV file to write.
+        page_size (int): The maximum number of rows per page.
+        page_dir (str): The directory where pages are checkpointed.
+        n_jobs (int, optional): The number of pages fetched concurrently. Defaults to 1.
+    """
+    Path(page_dir).mkdir(parents=True, exist_ok=True)
+    
+    # The plan is kept with the pages, so that a resumed execution splits the result the same way
+    plan_file = os.path.join(page_dir, "pages.json")
+    query_hash = hashlib.sha256(f"{endpoint}\n{page_size}\n{query}".encode()).hexdigest()
+    plan = None
+    if os.path.exists(plan_file):
+        with open(plan_file, "r") as plan_fs:
+            plan = json.load(plan_fs)
+        if plan["query"] != query_hash:
+            logger.debug(f"Discarding pages of another query in {page_dir}")
+            shutil.rmtree(page_dir)
+            Path(page_dir).mkdir(parents=True, exist_ok=True)
+            plan = None
+    
+    if plan is None:
+        n_rows = count_query_result(query, endpoint)
+        plan = {"query": query_hash, "n_rows": n_rows, "n_pages": max(1, math.ceil(n_rows / page_size))}
+        with open(plan_file, "w") as plan_fs:
+            json.dump(plan, plan_fs)
+    
+    page_files = [ os.path.join(page_dir, f"page{page_id}.tsv") for page_id in range(plan["n_pages"]) ]
+    missing_pages = [ 
+        (page_query, page_file) 
+        for page_query, page_file in zip(paginate_query(query, plan["n_pages"]), page_files) 
+        if not os.path.exists(page_file) 
+    ]
+    logger.debug(f"Fetching {len(missing_pages)}/{len(page_files)} pages of {plan['n_rows']} rows")
+    
+    with ThreadPoolExecutor(max_workers=max(1, min(n_jobs, len(missing_pages)))) as executor:
+        futures = [ executor.submit(download_query_result, page_query, endpoint, page_file) for page_query, page_file in missing_pages ]
+        for future in as_completed(futures):
+            future.result()
+    
+    # Every page repeats the header line, keep the first one only
+    with tempfile.NamedTemporaryFile(mode="wb", dir=Path(outfile).parent, delete=False) as tmp_fs:
+        for page_id, page_file in enumerate(page_files):
+            with open(page_file, "rb") as page_fs:
+                header = page_fs.readline()
+                if page_id == 0:
+                    tmp_fs.write(header)
+                shutil.copyfileobj(page_fs, tmp_fs, RESULT_CHUNK_BYTES)
+    os.replace(tmp_fs.name, outfile)
+    shutil.rmtree(page_dir)
+
+def open_query_result(query, endpoint, result_store=None, batch_id=None, dataset=None, page_size=None, n_jobs=1):
+    """Send a query to an endpoint, unless an equivalent query has already been answered by the same endpoint, batch and dataset.
+
+    The result is never held in memory as a whole: it is read from the response as it arrives, 
+    or from the result store, which is filled by streaming the response to disk.
+
+    Args:
+        query (str): The query.
+        endpoint (str): The SPARQL endpoint.
+        result_store (str, optional): The directory of the result store. If None, the query is always executed.
+        batch_id (int, optional): The batch the endpoint is serving.
+        dataset (str, optional): The fingerprint of the data ingested in the endpoint, see dataset_fingerprint.
+        page_size (int, optional): If set, fetch the result by pages of at most this many rows, see download_paged_query_result. 
+            Pages are checkpointed under {result_store}/pages, or the temporary directory without result store.
+        n_jobs (int, optional): The number of pages fetched concurrently. Defaults to 1.
+
+    Returns:
+        a binary file object over the TSV result, to be closed by the caller.
+    """
+    if result_store is None and page_size is None and QUERY_SLOTS is None:
+        response = sparql_request(query, endpoint)
+        response.raw.decode_content = True
+        return response.raw
+    
+    if result_store is None and page_size is None:
+        # The slot is only released once the result is downloaded, so spool it instead of handing over the response
+        with tempfile.NamedTemporaryFile(prefix="fedshop.", suffix=".tsv", delete=False) as tmp_fs:
+            result_file = tmp_fs.name
+        download_query_result(query, endpoint, result_file)
+        result_stream = open(result_file, "rb")
+        os.remove(result_file)
+        return result_stream
+    
+    key = result_store_key(query, endpoint, batch_id=batch_id, dataset=dataset)
+    if result_store is None:
+        page_dir = os.path.join(tempfile.gettempdir(), f"fedshop.{key}.pages")
+        result_file = f"{page_dir}.tsv"
+        download_paged_query_result(query, endpoint, result_file, page_size, page_dir, n_jobs=n_jobs)
+        result_stream = open(result_file, "rb")
+        # The result stays readable until closed
+        os.remove(result_file)
+        return result_stream
+    
+    # Results are opened before anything is evicted: an open result stays readable once removed from the store
+    store_file = result_store_file(result_store, key, batch_id=batch_id, dataset=dataset)
+    try:
+        result_stream = open(store_file, "rb")
+        logger.debug(f"Reusing result from {store_file}")
+        # Mark as recently used, unless a concurrent process evicted it meanwhile
+        try:
+            os.utime(store_file)
+        except FileNotFoundError:
+            pass
+        return result_stream
+    except FileNotFoundError:
+        pass
+    
+    Path(result_store).mkdir(parents=True, exist_ok=True)
+    for attempt in range(RESULT_STORE_ATTEMPTS):
+        if page_size is None:
+            download_query_result(query, endpoint, store_file)
+        else:
+            page_dir = os.path.join(result_store, "pages", key)
+            download_paged_query_result(query, endpoint, store_file, page_size, page_dir, n_jobs=n_jobs)
+        try:
+            result_stream = open(store_file, "rb")
+            break
+        except FileNotFoundError:
+            logger.debug(f"{store_file} was evicted by a concurrent process before being read, downloading it again...")
+    else:
+        raise RuntimeError(f"{store_file} was evicted {RESULT_STORE_ATTEMPTS} times before being read, RSFB__RESULT_STORE_MAX_SIZE may be too small")
+    
+    evict_result_store(result_store, keep=[store_file])
+    return result_stream
+
+def read_result_header(result_stream):
+    """Read the variable names on the first line of a TSV result, without their ?, $ or surrounding quotes.
+    """
+    return [ h.strip().strip('"').lstrip("?$") for h in result_stream.readline().decode().rstrip("\r\n").split("\t") ]
+
+def read_result_terms(result_stream, header, chunksize=None):
+    """Read a TSV result as strings of RDF terms, unbound values being NaN.
+    """
+    return pd.read_csv(
+        result_stream, sep="\t", header=None, names=header, dtype=str, 
+        quoting=csv.QUOTE_NONE, keep_default_na=False, na_values=[""], chunksize=chunksize
+    )
+
+def decode_sparql_terms(column):
+    """Turn a column of RDF terms, as written in SPARQL TSV results, into typed values.
+
+    IRIs and blank nodes become categories, literals of numeric and date datatypes numbers and datetimes, 
+    and other literals their lexical form. A column mixing kinds of terms is kept as lexical forms.
+
+    Args:
+        column (pd.Series): The terms.
+
+    Returns:
+        pd.Series: the values.
+    """
+    terms = column.dropna()
+    if terms.empty:
+        # Leave the type open, so that chunks where the column is bound decide it
+        return column.astype(object)
+    
+    parts = terms.str.extract(SPARQL_TERM_PATTERN)
+    # Virtuoso abbreviates numbers and booleans, e.g. 42 instead of "42"^^xsd:integer
+    bare = parts.isna().all(axis=1)
+    
+    # Blank nodes are spelled as in CSV results, i.e. the way Virtuoso accepts them back in queries
+    iris = parts["iri"].fillna("nodeID://" + parts["bnode"])
+    if iris.notna().all():
+        return iris.reindex(column.index).astype("category")
+    
+    lexical = parts["lexical"].where(~bare, terms)
+    datatypes = parts["datatype"]
+    
+    if (bare | datatypes.isin(XSD_NUMERIC_TYPES)).all():
+        try: return pd.to_numeric(lexical).reindex(column.index)
+        except ValueError: pass
+    
+    if datatypes.isin(XSD_DATE_TYPES).all():
+        try: return pd.to_datetime(lexical).reindex(column.index)
+        except ValueError: pass
+    
+    values = lexical.fillna(iris)
+    escaped = values.str.contains("\\", regex=False, na=False)
+    if escaped.any():
+        values[escaped] = values[escaped].str.replace(r"\\(.)", lambda m: TSV_ESCAPES.get(m.group(1), m.group(0)), regex=True)
+    return values.reindex(column.index)
+
+def decode_result_chunk(chunk):
+    """Type every column of a chunk of TSV result, see decode_sparql_terms.
+    """
+    return chunk.apply(decode_sparql_terms)
+
+def read_query_result(result_stream):
+    """Parse a whole TSV result into typed columns, then close the stream.
+    """
+    with closing(result_stream):
+        header = read_result_header(result_stream)
+        return decode_result_chunk(read_result_terms(result_stream, header))
+
+def write_result_file(result, outfile):
+    """Write a result, as Parquet if outfile ends with .parquet, so that column types are kept, otherwise as CSV.
+    """
+    if Path(outfile).suffix == ".parquet":
+        result.to_parquet(outfile, index=False)
+    else:
+        result.to_csv(outfile, index=False)
+
+def write_result_chunks(chunks, outfile):
+    """Write chunks of a result one after the other, see write_result_file.
+
+    Returns:
+        int: the number of rows written.
+    """
+    n_rows = 0
+    if Path(outfile).suffix == ".parquet":
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        
+        def merge_schema(tables):
+            fields = []
+            for column_fields in zip(*(table.schema for table in tables)):
+                typed_fields = [ field for field in column_fields if not pa.types.is_null(field.type) ]
+                field = typed_fields[0] if len(typed_fields) > 0 else column_fields[0]
+                # Each chunk has its own categories, widen dictionary indices so that all of them fit
+                if pa.types.is_dictionary(field.type):
+                    field = field.with_type(pa.dictionary(pa.int32(), field.type.value_type))
+                fields.append(field)
+            return pa.schema(fields)
+        
+        writer, pending = None, []
+        try:
+            for chunk in chunks:
+                pending.append(pa.Table.from_pandas(chunk, preserve_index=False))
+                n_rows += len(chunk)
+                if writer is None:
+                    schema = merge_schema(pending)
+                    # Columns without a value so far have no type yet, wait a few chunks for one
+                    if any(pa.types.is_null(field.type) for field in schema) and len(pending) < 8:
+                        continue
+                    writer = pq.ParquetWriter(outfile, schema)
+                for table in pending:
+                    writer.write_table(table.cast(writer.schema))
+                pending = []
+            
+            if len(pending) > 0:
+                writer = pq.ParquetWriter(outfile, merge_schema(pending))
+                for table in pending:
+                    writer.write_table(table.cast(writer.schema))
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError) as e:
+            raise RuntimeError(f"Column types of {outfile} change from chunk to chunk: {e}")
+        finally:
+            if writer is not None:
+                writer.close()
+        return n_rows
+    
+    with open(outfile, "w") as out_fs:
+        for chunk_id, chunk in enumerate(chunks):
+            chunk.to_csv(out_fs, index=False, header=(chunk_id == 0))
+            n_rows += len(chunk)
+    return n_rows
+
+def read_result_file(result_file, chunksize=None):
+    """Read a result written by write_result_file or write_result_chunks.
+    Parquet files keep their column types. In CSV files, columns whose name contains "date" are parsed as dates.
+
+    Args:
+        result_file (str): The file.
+        chunksize (int, optional): If set, return an iterator over chunks of this many rows.
+
+    Returns:
+        the result, or an iterator over its chunks.
+    """
+    if Path(result_file).suffix == ".parquet":
+        if chunksize is None:
+            return pd.read_parquet(result_file)
+        import pyarrow.parquet as pq
+        return ( batch.to_pandas() for batch in pq.ParquetFile(result_file).iter_batches(batch_size=chunksize) )
+    
+    with open(result_file, "r") as header_fs:
+        header = header_fs.readline().strip().replace('"', '').split(",")
+    return pd.read_csv(result_file, parse_dates=[h for h in header if "date" in h], low_memory=False, chunksize=chunksize)
+
+class Reservoir:
+    """Seeded uniform sample of at most n_samples rows amongst a stream of chunks, in constant memory.
+
+    Every row gets a random key and the sample keeps the rows with the smallest keys.
+    Keys are drawn in row order from a single RandomState, so that the sample only depends on the seed
+    and the rows, not on how they are split into chunks.
+
+    Args:
+        n_samples (int): The size of the sample.
+        seed (int, optional): The seed. Defaults to PANDAS_RANDOM_STATE.
+    """
+
+    def __init__(self, n_samples, seed=PANDAS_RANDOM_STATE):
+        self.n_samples = n_samples
+        self.random_state = np.random.RandomState(seed)
+        self.keys = np.empty(0)
+        self.sample = None
+        self.n_seen = 0
+
+    def update(self, chunk):
+        """Offer the rows of a chunk (pd.DataFrame or pd.Series) to the sample.
+        """
+        keys = self.random_state.random_sample(len(chunk))
+        self.n_seen += len(chunk)
+        if self.sample is None:
+            self.sample = chunk.iloc[:0]
+
+        if len(self.keys) == self.n_samples:
+            kept = keys < self.keys.max(initial=0)
+            chunk, keys = chunk[kept], keys[kept]
+        if len(keys) == 0:
+            return
+
+        sample = chunk if len(self.keys) == 0 else pd.concat([self.sample, chunk], ignore_index=True)
+        keys = np.concatenate([self.keys, keys])
+        order = np.argsort(keys, kind="stable")[:self.n_samples]
+        self.sample, self.keys = sample.iloc[order].reset_index(drop=True), keys[order]
+
+    def result(self, exact=True):
+        """The sample, in random order.
+
+        Args:
+            exact (bool, optional): If set, fail when fewer than n_samples rows were offered, as pd.DataFrame.sample does. Defaults to True.
+
+        Raises:
+            ValueError: fewer than n_samples rows were offered.
+        """
+        if exact and self.n_seen < self.n_samples:
+            raise ValueError(f"Cannot take a sample of {self.n_samples} rows amongst {self.n_seen}")
+        return self.sample
+
+@cli.command()
+@click.argument("result-store", type=click.Path(file_okay=False, dir_okay=True))
+@click.option("--batch-id", type=click.INT, help="Only invalidate the results of this batch.")
+@click.option("--stale", is_flag=True, default=False, help="Only invalidate the results obtained on other data than the current dataset.")
+@click.option("--configfile", type=click.Path(exists=True, file_okay=True, dir_okay=False), help="The configuration, required with --stale.")
+def invalidate_result_store(result_store, batch_id, stale, configfile):
+    """Remove results from the result store. By default, all of them.
+
+    Args:
+        result_store (str): The directory of the result store.
+        batch_id (int): if set, only remove the results of this batch.
+        stale (bool): if set, only remove the results obtained on other data than the current dataset.
+        configfile (str): the configuration, to locate the dataset.
+    """
+    if stale and configfile is None:
+        raise click.UsageError("--stale requires --configfile")
+    
+    config = load_config(configfile) if configfile is not None else None
+    current_datasets = {}
+    
+    n_removed = 0
+    for store_file in glob.glob(os.path.join(result_store, "batch*")):
+        batch_label, dataset_label, _, _ = Path(store_file).name.split(".")
+        batch_label = batch_label.replace("batch", "")
+        
+        if batch_id is not None and batch_label != str(batch_id):
+            continue
+        
+        if stale:
+            if batch_label not in current_datasets:
+                datafiles = batch_datafiles(config, None if batch_label == "any" else int(batch_label))
+                current_datasets[batch_label] = dataset_fingerprint(datafiles, result_store)[:16]
+            if dataset_label == current_datasets[batch_label]:
+                continue
+        
+        os.remove(store_file)
+        n_removed += 1
+    
+    logger.info(f"Removed {n_removed} results from {result_store}")
+
+def iter_result_chunks(result_stream, header, chunksize, dropna=False):
+    """Parse a TSV result by chunks of typed rows, closing the stream once exhausted.
+
+    Args:
+        result_stream: The binary stream, positioned after the header line.
+        header (list): The column names.
+        chunksize (int): The number of rows per chunk.
+        dropna (bool, optional): If set, drop the rows with missing values. Defaults to False.
+
+    Yields:
+        pd.DataFrame: the chunks.
+    """
+    with closing(result_stream):
+        for chunk in read_result_terms(result_stream, header, chunksize=chunksize):
+            chunk = decode_result_chunk(chunk)
+            if dropna:
+                chunk = chunk.dropna()
+            yield chunk
+
 @cli.command()
 @click.argument("endpoint", type=click.STRING)
 @click.option("--queryfile", type=click.Path(exists=True, file_okay=True, dir_okay=False))
@@ -111,21 +889,36 @@ def exec_query(query, endpoint, error_when_timeout=False):
 @click.option("--seed", type=click.INT, default=PANDAS_RANDOM_STATE)
 @click.option("--ignore-errors", is_flag=True, default=False)
 @click.option("--dropna", is_flag=True, default=False)
-def execute_query(endpoint, queryfile, querydata, outfile, sample, seed, ignore_errors, dropna):
+@click.option("--result-store", type=click.Path(file_okay=False, dir_okay=True), help="Directory where results are shared between equivalent queries.")
+@click.option("--batch-id", type=click.INT, help="The batch served by the endpoint, part of the result store key.")
+@click.option("--chunksize", type=click.INT, help="Stream the result by chunks of this many rows, instead of loading it at once.")
+@click.option("--configfile", type=click.Path(exists=True, file_okay=True, dir_okay=False), help="The configuration, to key stored results on the data of the batch.")
+@click.option("--page-size", type=click.INT, help="Fetch the result by resumable pages of at most this many rows.")
+@click.option("--n-jobs", type=click.INT, default=1, help="Number of pages fetched concurrently.")
+def execute_query(endpoint, queryfile, querydata, outfile, sample, seed, ignore_errors, dropna, result_store, batch_id, chunksize, configfile, page_size, n_jobs):
     """Execute query, export to an output file and return number of rows .
 
+    With chunksize, the result is written to outfile chunk by chunk and an iterator over chunks is returned,
+    so that memory stays bounded whatever the size of the result. Sampling needs the whole result, hence disables streaming.
+
     Args:
         queryfile ([type]): the query file name
         outfile ([type]): the output file name
         sample ([type]): the number of rows randomly sampled
         ignore_errors ([type]): if set, ignore when the result is empty
         endpoint ([type]): the SPARQL endpoint
+        result_store ([type]): if set, reuse the result of an equivalent query executed against the same endpoint and batch
+        batch_id ([type]): the batch served by the endpoint
+        chunksize ([type]): if set, stream the result by chunks of this many rows
+        configfile ([type]): if set with result_store, stored results are only reused for the same data
+        page_size ([type]): if set, fetch the result by pages of at most this many rows, resuming from the pages already fetched
+        n_jobs ([type]): the number of pages fetched concurrently
 
     Raises:
         RuntimeError: the result is empty
 
     Returns:
-        [type]: the number of rows
+        [type]: the result, or an iterator over its chunks
     """
     
     query_text = querydata
@@ -136,11 +929,17 @@ def execute_query(endpoint, queryfile, querydata, outfile, sample, seed, ignore_
     if query_text is None:
         raise RuntimeError("No query to execute...")
     
-    _, result = exec_query(query=query_text, endpoint=endpoint, error_when_timeout=False)
-
-    with BytesIO(result) as header_stream, BytesIO(result) as data_stream:
-        header = header_stream.readline().decode().strip().replace('"', '').split(",")
-        csvOut = pd.read_csv(data_stream, parse_dates=[h for h in header if "date" in h])
+    dataset = None
+    if result_store is not None and configfile is not None:
+        dataset = dataset_fingerprint(batch_datafiles(load_config(configfile), batch_id), result_store)
+    
+    result_stream = open_query_result(
+        query_text, endpoint, result_store=result_store, batch_id=batch_id, dataset=dataset, 
+        page_size=page_size, n_jobs=n_jobs
+    )
+    
+    if chunksize is None or sample is not None:
+        csvOut = read_query_result(result_stream)
 
         if csvOut.empty and not ignore_errors:
             logger.error(query_text)
@@ -153,9 +952,28 @@ def execute_query(endpoint, queryfile, querydata, outfile, sample, seed, ignore_
             csvOut = csvOut.sample(sample, random_state=seed)
 
         if outfile: 
-            csvOut.to_csv(outfile, index=False)
+            write_result_file(csvOut, outfile)
 
         return csvOut
+    
+    header = read_result_header(result_stream)
+    chunks = iter_result_chunks(result_stream, header, chunksize, dropna=dropna)
+    if outfile is None:
+        first_chunk = next(chunks, None)
+        if (first_chunk is None or first_chunk.empty) and not ignore_errors:
+            chunks.close()
+            logger.error(query_text)
+            raise RuntimeError(f"{queryfile} returns no result...")
+        return chain([first_chunk], chunks) if first_chunk is not None else chunks
+    
+    n_rows = write_result_chunks(chunks, outfile)
+    if n_rows == 0 and not ignore_errors:
+        if os.path.exists(outfile):
+            os.remove(outfile)
+        logger.error(query_text)
+        raise RuntimeError(f"{queryfile} returns no result...")
+    
+    return read_result_file(outfile, chunksize=chunksize)
 
 def pretty_print_query(queryfile):
     cmd = f"./{WDQ_BIN_PATH} --no-execute --language en --query {queryfile}"
@@ -329,15 +1147,14 @@ def build_value_selection_query(ctx: click.Context, queryfile, constfile, outfil
     for subq_id, (kind, subq_bgp_algebra) in enumerate(subq_bgp_algebras):
         subq_vars = set(map(str, _traverseAgg(subq_bgp_algebra, collect_triple_variables))) & cond_consts
 
-        subq_bgp_algebra = traverse(
+        subq_bgp_algebra = rewrite(
             subq_bgp_algebra, 
-            visitPost=lambda x: remove_filter_with_placeholders(
+            lambda x: remove_filter_with_placeholders(
                 x, consts={"query": subq_vars, "filter": filter_consts}
-            )
+            ),
+            disable_orderby_limit,
+            disable_offset
         )
-                        
-        subq_bgp_algebra = traverse(subq_bgp_algebra, visitPost=disable_orderby_limit)
-        subq_bgp_algebra = traverse(subq_bgp_algebra, visitPost=disable_offset)
                 
         if kind == "exclusive":
             subqueries[f"sq{subq_id}"] = {
@@ -368,6 +1185,105 @@ def build_value_selection_query(ctx: click.Context, queryfile, constfile, outfil
     with open(outfile, "w") as out_fs:
         json.dump(subqueries, out_fs)
 
+def read_constant_datatypes(constfile):
+    """Read the datatype of the constants described in a constfile, if any.
+
+    A constant may declare "datatype": "iri", or the datatype of its literals, e.g. "xsd:date". 
+
+    Args:
+        constfile (str): The path to the constfile.
+
+    Returns:
+        dict: a dictionary mapping constant names to their datatype.
+    """
+    if constfile is None or not os.path.exists(constfile):
+        return {}
+    with open(constfile, "r") as cfs:
+        consts_info = json.load(cfs)
+    return { const: info["datatype"] for const, info in consts_info.items() if isinstance(info, dict) and info.get("datatype") }
+
+def compile_query_template_proc(queryfile, placeholder_values):
+    """Serialize a query template once, leaving a typed slot for each placeholder.
+
+    The placeholders are replaced by an IRI or a literal, following the type of the sample value, 
+    so that rdflib orders the triple patterns as it would for an instance with values of the same types.
+    Ties between triple patterns that only differ by the injected value are not reordered per instance.
+
+    Args:
+        queryfile (str): The path to the query file.
+        placeholder_values (dict): A dictionary mapping placeholder names to a sample value.
+
+    Returns:
+        dict: the serialized query and, for each placeholder, the type and the N3 token of its slot.
+    """
+    algebra, options = parse_query_proc(queryfile=queryfile)
+    slots = {}
+    for placeholder, value in placeholder_values.items():
+        slot_iri = f"{PLACEHOLDER_SLOT_IRI}{placeholder}"
+        slots[placeholder] = URIRef(slot_iri) if isinstance(normalize_constant(value), URIRef) else Literal(slot_iri)
+        
+    algebra = rewrite(
+        algebra,
+        lambda node: inject_constant_into_placeholders(node, slots),
+        disable_offset
+    )
+    return {
+        "query": export_query(algebra, options),
+        "slots": { 
+            placeholder: {
+                "type": "uri" if isinstance(slot, URIRef) else "literal",
+                "token": slot.n3()
+            } 
+            for placeholder, slot in slots.items() 
+        }
+    }
+
+def fill_query_template(template, placeholder_values):
+    """Instantiate a compiled template, see `compile_query_template_proc`.
+
+    Args:
+        template (dict): The compiled template.
+        placeholder_values (dict): A dictionary mapping placeholder names to constant values.
+
+    Raises:
+        ValueError: a value does not have the type of its slot.
+
+    Returns:
+        str: the instantiated query.
+    """
+    query = template["query"]
+    if len(template["slots"]) == 0:
+        return query
+    
+    filled = {}
+    for placeholder, slot in template["slots"].items():
+        term = normalize_constant(placeholder_values[placeholder])
+        term_type = "uri" if isinstance(term, URIRef) else "literal"
+        if term_type != slot["type"]:
+            raise ValueError(f"Value {term} for {placeholder} is a {term_type}, expected a {slot['type']}!")
+        filled[slot["token"]] = term.n3()
+        
+    return re.sub("|".join(map(re.escape, filled.keys())), lambda m: filled[m.group(0)], query)
+
+@cli.command()
+@click.argument("queryfile", type=click.Path(exists=True, file_okay=True, dir_okay=False))
+@click.argument("value-selection", type=click.Path(exists=True, file_okay=True, dir_okay=False))
+@click.argument("outfile", type=click.Path(exists=False, file_okay=True, dir_okay=False))
+def compile_query_template(queryfile, value_selection, outfile):
+    """Compile a query template, with one slot per column of the value selection file.
+    Slot types are taken from the first row.
+
+    Args:
+        queryfile (str): The path to the query file.
+        value_selection (str): The path to the value selection file.
+        outfile (str): The path to the compiled template (json).
+    """
+    placeholder_values = read_result_file(value_selection).to_dict(orient="records")[0]
+    template = compile_query_template_proc(queryfile, placeholder_values)
+    with open(outfile, "w") as out_fs:
+        json.dump(template, out_fs)
+    return template
+
 @cli.command()
 @click.argument("queryfile", type=click.Path(exists=True, file_okay=True, dir_okay=False))
 @click.argument("value-selection", type=click.Path(exists=True, file_okay=True, dir_okay=False))
@@ -377,10 +1293,10 @@ def build_value_selection_query(ctx: click.Context, queryfile, constfile, outfil
 def instanciate_workload(ctx: click.Context, queryfile, value_selection, outfile, instance_id):
     """
     Instantiate a workload by injecting constant values into placeholders in a query.
+    The values are converted and injected as in instanciate-workload-all, see `instanciate_template_proc`.
 
     Args:
         ctx (click.Context): The Click context object.
-        configfile: The path to the configuration file.
         queryfile: The path to the query file.
         value_selection: The path to the value selection file.
         outfile: The path to the output file.
@@ -389,15 +1305,110 @@ def instanciate_workload(ctx: click.Context, queryfile, value_selection, outfile
     Returns:
         None
     """
-                    
-    value_selection_values = read_csv(value_selection) 
-    placeholder_chosen_values = value_selection_values.to_dict(orient="records")[instance_id]
-        
-    # Open the original queryfile
-    algebra, options = ctx.invoke(parse_query, queryfile=queryfile)
-    algebra = traverse(algebra, visitPost=lambda node: inject_constant_into_placeholders(node, placeholder_chosen_values))
-    algebra = traverse(algebra, visitPost=disable_offset)
-    export_query(algebra, options, outfile=outfile)
+    # Escape the braces of the path, which is formatted with the instance id
+    outfile = outfile.replace("{", "{{").replace("}", "}}")
+    instanciate_template_proc(queryfile, value_selection, outfile, instance_ids=[instance_id])
+
+def instanciate_query_proc(queryfile, placeholder_values, outfile=None):
+    """Inject constant values into the placeholders of the query algebra, then export the query.
+
+    Args:
+        queryfile (str): The path to the query file.
+        placeholder_values (dict): A dictionary mapping placeholder names to constant values.
+        outfile (str, optional): The path to the output file.
+
+    Returns:
+        str: the instantiated query.
+    """
+    algebra, options = parse_query_proc(queryfile=queryfile)
+    algebra = rewrite(
+        algebra, 
+        lambda node: inject_constant_into_placeholders(node, placeholder_values),
+        disable_offset
+    )
+    return export_query(algebra, options, outfile=outfile)
+
+def instanciate_template_proc(queryfile, value_selection, outfile, instance_ids=None, skip_existing=False):
+    """Write the injected query of every instance of a template.
+
+    The value selection file is read and the template compiled once. 
+    Instances whose values do not fit the compiled template are injected through the algebra.
+
+    Args:
+        queryfile (str): The path to the query file.
+        value_selection (str): The path to the workload value selection file.
+        outfile (str): The path to the injected queries, formatted with the instance id, e.g, "<outdir>/instance_{instance_id}/injected.sparql".
+        instance_ids (list, optional): The instances to write. Defaults to all rows of the value selection.
+        skip_existing (bool, optional): If set, leave the instances already written untouched. Defaults to False.
+
+    Returns:
+        list: the paths to the injected queries, written or not.
+    """
+    # Convert each column once, following its dtype and the datatypes of the constfile
+    datatypes = read_constant_datatypes(str(Path(queryfile).with_suffix(".const.json")))
+    placeholder_values = read_result_file(value_selection) \
+        .apply(lambda column: normalize_column(column, datatypes.get(column.name))) \
+        .to_dict(orient="records")
+    if instance_ids is None:
+        instance_ids = range(len(placeholder_values))
+    
+    outfiles = [ outfile.format(instance_id=instance_id) for instance_id in instance_ids ]
+    if skip_existing:
+        instance_ids = [ instance_id for instance_id, instance_outfile in zip(instance_ids, outfiles) if not os.path.exists(instance_outfile) ]
+        if len(instance_ids) == 0:
+            return outfiles
+    
+    template = compile_query_template_proc(queryfile, placeholder_values[0])
+    
+    for instance_id in instance_ids:
+        instance_outfile = outfile.format(instance_id=instance_id)
+        Path(instance_outfile).parent.mkdir(parents=True, exist_ok=True)
+        try:
+            query = fill_query_template(template, placeholder_values[instance_id])
+            with open(instance_outfile, "w") as out_fs:
+                out_fs.write(query)
+        except ValueError as e:
+            logger.warning(f"{e} Falling back to algebra injection...")
+            instanciate_query_proc(queryfile, placeholder_values[instance_id], outfile=instance_outfile)
+    return outfiles
+
+@cli.command()
+@click.argument("queryfiles", type=click.Path(exists=True, file_okay=True, dir_okay=False), nargs=-1)
+@click.option("--bench-dir", type=click.Path(file_okay=False, dir_okay=True), required=True, help="Directory holding <query>/workload_value_selection.parquet.")
+@click.option("--instance-ids", type=click.STRING, help="Comma-separated instance ids. Defaults to all rows of each value selection file.")
+@click.option("--n-jobs", type=click.INT, default=1, help="Number of templates instantiated in parallel.")
+@click.option("--incremental", is_flag=True, default=False, help="Only write the instances that have no injected query yet.")
+def instanciate_workload_all(queryfiles, bench_dir, instance_ids, n_jobs, incremental):
+    """Instantiate every instance of the given query templates in a single process.
+    
+    For each template <query>, the values are read from {bench_dir}/<query>/workload_value_selection.parquet 
+    and the queries are written to {bench_dir}/<query>/instance_<id>/injected.sparql.
+
+    Args:
+        queryfiles (list): The paths to the query templates.
+        bench_dir (str): The generation benchmark directory.
+        instance_ids (str): Comma-separated instance ids.
+        n_jobs (int): Number of worker processes.
+        incremental (bool): Only write the instances that have no injected query yet.
+    """
+    
+    if instance_ids is not None:
+        instance_ids = [ int(instance_id) for instance_id in instance_ids.split(",") ]
+    
+    jobs = []
+    for queryfile in queryfiles:
+        outdir = f"{bench_dir}/{Path(queryfile).stem}"
+        jobs.append((queryfile, f"{outdir}/workload_value_selection.parquet", f"{outdir}/instance_{{instance_id}}/injected.sparql", instance_ids, incremental))
+    
+    if n_jobs > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=min(n_jobs, len(jobs))) as executor:
+            futures = [ executor.submit(instanciate_template_proc, *job) for job in jobs ]
+            for future in as_completed(futures):
+                logger.debug(f"Instantiated {len(future.result())} queries")
+    else:
+        for job in jobs:
+            outfiles = instanciate_template_proc(*job)
+            logger.debug(f"Instantiated {len(outfiles)} queries")
 
 @cli.command()
 @click.argument("provenance", type=click.Path(exists=True, file_okay=True, dir_okay=False))
@@ -476,7 +1487,12 @@ def decompose_query(ctx: click.Context, queryfile, outfile):
     
         return children[0] if isinstance(children, list) and len(children) > 0 else children
     
-    def visit_add_triple(node, children):
+    def translate_term(node, children):
+        if isinstance(node, Identifier):
+            return node
+        return children[0] if isinstance(children, list) and len(children) > 0 else children
+    
+    def visit_add_triple(node, children, translate=translate):
         if isinstance(node, CompValue):
             if node.name == "TriplesBlock":
                 for triple in node["triples"]:
@@ -494,11 +1510,81 @@ def decompose_query(ctx: click.Context, queryfile, outfile):
         
     with open(outfile, "w") as out_fs:
         json.dump(composition, out_fs)
+    
+    # Same triple patterns with prefixed names resolved, so that the index holds every spelling engines may use
+    prologue = translatePrologue(algebra[0], None)
+    resolved = traverse(algebra[1], visitPost=partial(translatePName, prologue=prologue))
+    terms = {
+        f"tp{triple_id}": triple 
+        for triple_id, triple in enumerate(_traverseAgg(resolved, partial(visit_add_triple, translate=translate_term)))
+    }
+    
+    with open(composition_index_file(outfile), "w") as index_fs:
+        json.dump(build_composition_index(composition, terms), index_fs)
 
-def parse_query_proc(queryfile=None, querydata=None):
+_parse_cache = OrderedDict()
+_parse_cache_lock = threading.Lock()
+# pyparsing grammars are not safe to run from several threads at once
+_parse_lock = threading.Lock()
+
+def _parse_cache_get(key):
+    """Return the pickled (algebra, misc) for key, looking in memory first, then on disk.
+    """
+    with _parse_cache_lock:
+        if key in _parse_cache:
+            _parse_cache.move_to_end(key)
+            return _parse_cache[key]
+    
+    if PARSE_CACHE_DIR is None:
+        return None
+    
+    cache_file = os.path.join(PARSE_CACHE_DIR, f"{key}.pkl")
+    if not os.path.exists(cache_file):
+        return None
+    
+    with open(cache_file, "rb") as cache_fs:
+        blob = cache_fs.read()
+    _parse_cache_put(key, blob, persist=False)
+    return blob
+
+def _parse_cache_put(key, blob, persist=True):
+    with _parse_cache_lock:
+        _parse_cache[key] = blob
+        _parse_cache.move_to_end(key)
+        while len(_parse_cache) > PARSE_CACHE_SIZE:
+            _parse_cache.popitem(last=False)
+    
+    if persist and PARSE_CACHE_DIR is not None:
+        Path(PARSE_CACHE_DIR).mkdir(parents=True, exist_ok=True)
+        # Write then rename so that concurrent processes never read a partial file
+        with tempfile.NamedTemporaryFile(mode="wb", dir=PARSE_CACHE_DIR, delete=False) as tmp_fs:
+            tmp_fs.write(blob)
+        os.replace(tmp_fs.name, os.path.join(PARSE_CACHE_DIR, f"{key}.pkl"))
+
+def parse_query_proc(queryfile=None, querydata=None, use_cache=True):
+    """Parse a query into its algebra.
+
+    Results are cached by the hash of the query text. Each call returns a fresh copy of the algebra,
+    so callers are free to mutate it.
+
+    Args:
+        queryfile (str, optional): The path to the query file.
+        querydata (str, optional): The query string, used when queryfile is not given.
+        use_cache (bool, optional): Whether to read and populate the parse cache. Defaults to True.
+
+    Returns:
+        tuple: the parsed algebra and a dict of miscellaneous options.
+    """
     if queryfile:
         with open(queryfile, "r") as qf:
             querydata = qf.read()
+    
+    cache_key = None
+    if use_cache:
+        cache_key = hashlib.sha256(f"{rdflib.__version__}\n{querydata}".encode()).hexdigest()
+        blob = _parse_cache_get(cache_key)
+        if blob is not None:
+            return pickle.loads(blob)
             
     misc = {
         "explicit_join_order": False
@@ -510,7 +1596,11 @@ def parse_query_proc(queryfile=None, querydata=None):
         misc["explicit_join_order"] = True
         query = query.replace('DEFINE sql:select-option "order"', '')
     
-    algebra = parseQuery(query)
+    with _parse_lock:
+        algebra = parseQuery(query)
+    
+    if use_cache:
+        _parse_cache_put(cache_key, pickle.dumps((algebra, misc), protocol=pickle.HIGHEST_PROTOCOL))
     return algebra, misc
     
 
@@ -577,12 +1667,6 @@ def export_query(algebra, options, outfile=None):
             out_fs.write(query)
     return query
     
-def read_csv(csv_file):
-    with open(csv_file, "r") as header_fs:
-        header = header_fs.readline().strip().replace('"', '').split(",")
-        tmp = pd.read_csv(csv_file, parse_dates=[h for h in header if "date" in h], low_memory=False)
-        return tmp
-        
 @cli.command()
 @click.argument("queryfile", type=click.Path(exists=True, file_okay=True, dir_okay=False))
 @click.argument("outfile", type=click.Path(dir_okay=False, file_okay=True))
@@ -604,10 +1688,13 @@ def build_provenance_query(ctx: click.Context, queryfile, outfile):
     """
     
     algebra, options = ctx.invoke(parse_query, queryfile=queryfile)
-    algebra = traverse(algebra, visitPost=add_graph_to_triple_pattern)
-    algebra = traverse(algebra, visitPost=replace_select_projection_with_graph)
-    algebra = traverse(algebra, visitPost=disable_orderby_limit)
-    algebra = traverse(algebra, visitPost=disable_offset)
+    algebra = rewrite(
+        algebra, 
+        add_graph_to_triple_pattern,
+        replace_select_projection_with_graph,
+        disable_orderby_limit,
+        disable_offset
+    )
     export_query(algebra, options, outfile=outfile)
         
 @cli.command()
@@ -616,10 +1703,24 @@ def build_provenance_query(ctx: click.Context, queryfile, outfile):
 @click.argument("subqueryfile", type=click.Path(exists=True, file_okay=True, dir_okay=False))
 @click.argument("workload-value-selection", type=click.Path(exists=False, file_okay=True, dir_okay=False))
 @click.argument("n-instances", type=click.INT)
+@click.option("--oversampling", type=click.FLOAT, help="Sample subqueries on the endpoint to about generation.n_query_instances times this many rows. Defaults to generation.virtuoso.value_selection_oversampling.")
+@click.option("--incremental", is_flag=True, default=False, help="Keep the rows of an existing workload value selection and only add the missing instances.")
 @click.pass_context
-def create_workload_value_selection(ctx: click.Context, configfile, constfile, subqueryfile, workload_value_selection, n_instances):
+def create_workload_value_selection(ctx: click.Context, configfile, constfile, subqueryfile, workload_value_selection, n_instances, oversampling, incremental):
     """Create a value selection file from a query file
 
+    With oversampling, subqueries are first sampled on the endpoint side, on the variables they share so that sampled rows still join.
+    The sampled fraction is sized for generation.n_query_instances (or n_instances, if more), not for the instances asked for, 
+    so that the same rows are sampled whatever n_instances.
+    If too few sampled rows survive the constraints, the full subquery results are fetched instead.
+
+    In incremental mode, the rows of the existing workload value selection are kept as instances 0 to k-1, 
+    and only instances k to n_instances-1 are sampled. Instance i only depends on the seed and on i, see first_instance, 
+    so that a workload grown in several steps holds the same instances as one sampled at once.
+    Subquery results are reused, as in any mode.
+    With oversampling, this only holds while the sampled fraction stays the same, i.e. while generation.n_query_instances 
+    and the oversampling are unchanged: a warning is logged when the existing instances were sampled with another fraction.
+
     Args:
         queryfile (str): Path to the query file.
         value_selection (str): Path to the value selection file.
@@ -627,64 +1728,232 @@ def create_workload_value_selection(ctx: click.Context, configfile, constfile, s
         constfile (str): Path to the constfile.
         seed (int): Random seed for reproducibility.
         workload_value_selection (str): Path to the output workload value selection file.
+        oversampling (float): Sample subqueries to generation.n_query_instances times this many rows.
+        incremental (bool): Only add the instances missing from the existing workload value selection.
+
+    Raises:
+        RuntimeError: in incremental mode, the existing workload value selection has other placeholders than the new instances.
     """
     
     # Read config
     config = load_config(configfile)
     batch0_endpoint = config["generation"]["virtuoso"]["default_endpoint"]
+    result_store = config["generation"]["virtuoso"].get("result_store")
+    if oversampling is None:
+        oversampling = config["generation"]["virtuoso"].get("value_selection_oversampling")
+    
+    existing = None
+    first_instance = 0
+    seed = PANDAS_RANDOM_STATE
+    if incremental and os.path.exists(workload_value_selection):
+        existing = read_result_file(workload_value_selection)
+        if len(existing) >= n_instances:
+            logger.info(f"{workload_value_selection} already has {len(existing)} instances")
+            return existing
+        logger.info(f"Adding instances {len(existing)} to {n_instances-1} to {workload_value_selection}")
+        first_instance = len(existing)
 
     # Get subqueries
     subqueries = {}
     with open(subqueryfile, "r") as sqfs:
         subqueries = json.load(sqfs)
+    
+    def execute_subqueries(fraction=None, sample_variables=None):
+        b_require_exclusive = False
+        exclusive_sq = None
         
-    b_require_exclusive = False
-    exclusive_sq = None
-
-    for subq_id, subq_info in subqueries.items():
-        subq_kind = subq_info["kind"]
-        subq_text = subq_info["query"]
-        
-        subq_value_selection_file = f"{Path(subqueryfile).parent}/{Path(subqueryfile).stem}.{subq_id}.csv"
-        
-        if not os.path.exists(subq_value_selection_file):
-            logger.debug(f"Executing subquery:\n {subq_text}")
-            ctx.invoke(
-                execute_query, 
-                querydata = subq_text,
-                outfile=subq_value_selection_file, 
-                endpoint=batch0_endpoint
-            )
-        subqueries[subq_id]["subq_value_selection_file"] = subq_value_selection_file
+        for subq_id, subq_info in subqueries.items():
+            subq_kind = subq_info["kind"]
+            subq_text = subq_info["query"]
+            
+            subq_value_selection_file = f"{Path(subqueryfile).parent}/{Path(subqueryfile).stem}.{subq_id}.parquet"
+            if fraction is not None:
+                subq_text = sample_query(subq_text, fraction, variables=sample_variables)
+                # The sampled query holds the fraction and the sampled variables, a sample is only reused for the same ones
+                sample_id = hashlib.sha256(subq_text.encode()).hexdigest()[:16]
+                sample_prefix = f"{Path(subqueryfile).parent}/{Path(subqueryfile).stem}.{subq_id}.sample"
+                subq_value_selection_file = f"{sample_prefix}.{sample_id}.parquet"
+                for stale_sample_file in glob.glob(f"{glob.escape(sample_prefix)}*.parquet"):
+                    if stale_sample_file != subq_value_selection_file:
+                        if existing is not None:
+                            logger.warning(f"The instances of {workload_value_selection} were sampled with another fraction, the new ones will differ from a workload sampled at once")
+                        os.remove(stale_sample_file)
             
-        if subq_kind == "exclusive":
-            b_require_exclusive = True
-            exclusive_sq = subq_text
+            if not os.path.exists(subq_value_selection_file):
+                logger.debug(f"Executing subquery:\n {subq_text}")
+                ctx.invoke(
+                    execute_query, 
+                    querydata = subq_text,
+                    outfile=subq_value_selection_file, 
+                    endpoint=batch0_endpoint,
+                    result_store=result_store,
+                    batch_id=0,
+                    configfile=configfile,
+                    chunksize=RESULT_CHUNK_SIZE,
+                    page_size=config["generation"]["virtuoso"].get("page_size"),
+                    n_jobs=config["generation"]["virtuoso"].get("max_client_connections", 1)
+                )
+            subqueries[subq_id]["subq_value_selection_file"] = subq_value_selection_file
                 
-    # Update subqueries file
-    with open(subqueryfile, "w") as sqfs:
-        json.dump(subqueries, sqfs)
+            if subq_kind == "exclusive":
+                b_require_exclusive = True
+                exclusive_sq = subq_info["query"]
+                    
+        # Update subqueries file
+        with open(subqueryfile, "w") as sqfs:
+            json.dump(subqueries, sqfs)
+        
+        # Create workload value selection
+        if b_require_exclusive:
+            return ctx.invoke(
+                create_workload_value_selection_with_exclusive,
+                configfile=configfile,
+                querydata=exclusive_sq,
+                excl_value_selection=subq_value_selection_file,
+                subqueries_file=subqueryfile,
+                n_instances=n_instances,
+                constfile=constfile,
+                seed=seed,
+                first_instance=first_instance
+            )
+        else:
+            return ctx.invoke(
+                create_workload_value_selection_with_constraints, 
+                subquery_file=subqueryfile, 
+                n_instances=n_instances, 
+                constfile=constfile,
+                seed=seed,
+                first_instance=first_instance
+            )
+    
+    result = None
+    if oversampling is not None:
+        subq_texts = [ subq_info["query"] for subq_info in subqueries.values() ]
+        n_rows = min([ count_query_result(subq_text, batch0_endpoint) for subq_text in subq_texts ])
+        # Sized for the configured workload rather than for the instances asked for, so that growing a workload keeps the sample
+        n_sampled_instances = max(n_instances, config["generation"]["n_query_instances"])
+        fraction = n_sampled_instances * oversampling / max(n_rows, 1)
+        if fraction < 1:
+            # Sample on the variables shared by all subqueries, so that sampled rows still join
+            shared_variables = sorted(set.intersection(*[ set(projected_variables(subq_text)) for subq_text in subq_texts ]))
+            logger.debug(f"Sampling {fraction:.2%} of the subquery results on {shared_variables or 'all variables'}")
+            try:
+                result = execute_subqueries(fraction=fraction, sample_variables=shared_variables or None)
+            except (RuntimeError, ValueError) as e:
+                logger.warning(f"Too few sampled rows ({e}), falling back to the full subquery results...")
+    
+    if result is None:
+        result = execute_subqueries()
+    
+    if existing is not None:
+        if list(result.columns) != list(existing.columns):
+            raise RuntimeError(f"The instances of {workload_value_selection} have other placeholders ({', '.join(existing.columns)}) than the new ones ({', '.join(result.columns)}), remove it to start over")
+        result = pd.concat([existing, result], ignore_index=True)
+    
+    write_result_file(result, workload_value_selection)
+    return result
+
+def generate_workload_proc(queryfile, constfile, outdir, configfile, n_instances, incremental=False):
+    """Build the value selection queries of a template, then sample its workload value selection.
+
+    Args:
+        queryfile (str): The path to the query template.
+        constfile (str): The path to its constfile.
+        outdir (str): The directory receiving value_selection.json and workload_value_selection.parquet.
+        configfile (str): The configuration.
+        n_instances (int): The number of instances.
+        incremental (bool, optional): If set, keep existing value selection queries and instances, see create_workload_value_selection.
+
+    Returns:
+        dict: the seconds spent building the value selection queries and sampling the value selection.
+    """
+    Path(outdir).mkdir(parents=True, exist_ok=True)
+    subqueryfile = f"{outdir}/value_selection.json"
     
-    # Create workload value selection
-    if b_require_exclusive:
+    timings = {}
+    with click.Context(cli) as ctx:
+        start = time.perf_counter()
+        if not (incremental and os.path.exists(subqueryfile)):
+            ctx.invoke(build_value_selection_query, queryfile=queryfile, constfile=constfile, outfile=subqueryfile)
+        timings["build_value_selection_query"] = time.perf_counter() - start
+        
+        start = time.perf_counter()
         ctx.invoke(
-            create_workload_value_selection_with_exclusive,
-            configfile=configfile,
-            querydata=exclusive_sq,
-            excl_value_selection=subq_value_selection_file,
-            subqueries_file=subqueryfile,
+            create_workload_value_selection, 
+            configfile=configfile, 
+            constfile=constfile, 
+            subqueryfile=subqueryfile, 
+            workload_value_selection=f"{outdir}/workload_value_selection.parquet", 
             n_instances=n_instances,
-            workload_value_selection=workload_value_selection,
-            constfile=constfile
-        )
-    else:
-        ctx.invoke(
-            create_workload_value_selection_with_constraints, 
-            subquery_file=subqueryfile, 
-            n_instances=n_instances, 
-            workload_value_selection=workload_value_selection,
-            constfile=constfile
+            incremental=incremental
         )
+        timings["create_workload_value_selection"] = time.perf_counter() - start
+    return timings
+
+@cli.command()
+@click.argument("configfile", type=click.Path(exists=True, file_okay=True, dir_okay=False))
+@click.argument("queryfiles", type=click.Path(exists=True, file_okay=True, dir_okay=False), nargs=-1)
+@click.option("--bench-dir", type=click.Path(file_okay=False, dir_okay=True), required=True, help="Directory receiving <query>/value_selection.json and <query>/workload_value_selection.parquet.")
+@click.option("--n-instances", type=click.INT, help="Number of instances per template. Defaults to generation.n_query_instances.")
+@click.option("--n-jobs", type=click.INT, help="Number of templates processed in parallel. Defaults to the number of templates.")
+@click.option("--timings", type=click.Path(exists=False, file_okay=True, dir_okay=False), help="CSV file receiving the time spent on each template.")
+@click.option("--incremental", is_flag=True, default=False, help="Keep existing instances and only add the missing ones.")
+def generate_workloads(configfile, queryfiles, bench_dir, n_instances, n_jobs, timings, incremental):
+    """Create the workload value selection of every given query template from a single parent process.
+
+    Templates are processed by a pool of worker processes, see generate_workload_proc. 
+    All workers share generation.virtuoso.max_client_connections query slots, 
+    so that the endpoint never receives more queries at once, whatever the number of workers.
+    The constfile of <query>.sparql is <query>.const.json, next to it.
+
+    Args:
+        configfile (str): The configuration.
+        queryfiles (list): The paths to the query templates.
+        bench_dir (str): The generation benchmark directory.
+        n_instances (int): The number of instances per template.
+        n_jobs (int): The number of worker processes.
+        timings (str): The path to the timings CSV file.
+        incremental (bool): Keep existing instances and only add the missing ones.
+
+    Raises:
+        RuntimeError: some templates failed, after the others are done.
+    """
+    
+    config = load_config(configfile)
+    if n_instances is None:
+        n_instances = config["generation"]["n_query_instances"]
+    if n_jobs is None:
+        n_jobs = len(queryfiles)
+    query_slots = multiprocessing.BoundedSemaphore(config["generation"]["virtuoso"].get("max_client_connections", 1))
+    
+    records, failures = [], []
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=max(1, min(n_jobs, len(queryfiles))), initializer=set_query_slots, initargs=(query_slots,)) as executor:
+        futures = {}
+        for queryfile in queryfiles:
+            query = Path(queryfile).stem
+            constfile = str(Path(queryfile).with_suffix(".const.json"))
+            future = executor.submit(generate_workload_proc, queryfile, constfile, f"{bench_dir}/{query}", configfile, n_instances, incremental)
+            futures[future] = query
+        
+        for future in as_completed(futures):
+            query = futures[future]
+            try:
+                record = future.result()
+            except Exception as e:
+                logger.error(f"{query}: {e}")
+                failures.append(query)
+                continue
+            record = { "query": query, **record, "total": sum(record.values()) }
+            logger.info(f"{query}: " + ", ".join(f"{step} {seconds:.1f}s" for step, seconds in record.items() if step != "query"))
+            records.append(record)
+    
+    logger.info(f"Generated {len(records)} workloads in {time.perf_counter() - start:.1f}s")
+    if timings is not None:
+        pd.DataFrame.from_records(records, columns=["query", "build_value_selection_query", "create_workload_value_selection", "total"]).sort_values("query").to_csv(timings, index=False)
+    
+    if len(failures) > 0:
+        raise RuntimeError(f"Could not generate the workload of {', '.join(sorted(failures))}")
 
 @click.command()
 @click.argument("configfile", type=click.Path(exists=True, file_okay=True, dir_okay=False))
@@ -696,24 +1965,41 @@ def create_workload_value_selection(ctx: click.Context, configfile, constfile, s
 @click.option("--workload-value-selection", type=click.Path(exists=False, file_okay=True, dir_okay=False))
 @click.option("--constfile", type=click.Path(exists=True, file_okay=True, dir_okay=False))
 @click.option("--seed", type=click.INT, default=PANDAS_RANDOM_STATE)
+@click.option("--first-instance", type=click.INT, default=0, help="Only sample instances from this one on, e.g. the instances missing from a workload.")
+@click.option("--n-jobs", type=click.INT, help="Number of concurrent probes. Defaults to generation.virtuoso.max_client_connections.")
+@click.option("--probing", type=click.Choice(["per-instance", "batched"]), help="Probe the exclusive values with one query per instance, or with a single query. Defaults to generation.virtuoso.exclusive_probing.")
 @click.pass_context
-def create_workload_value_selection_with_exclusive(ctx: click.Context, configfile, excl_value_selection, subqueries_file, n_instances, queryfile, querydata, workload_value_selection, constfile, seed):
+def create_workload_value_selection_with_exclusive(ctx: click.Context, configfile, excl_value_selection, subqueries_file, n_instances, queryfile, querydata, workload_value_selection, constfile, seed, first_instance, n_jobs, probing):
+    """Sample the exclusive values of {n_instances} instances, then the rest of the placeholders of each instance 
+    amongst the results of the query probing its exclusive values, see create_workload_value_selection_with_constraints.
+
+    Per instance, each probe binds the exclusive values of one instance with VALUES. 
+    Batched, a single probe binds the exclusive values of all instances, tagged with the instance id, and its result is split by instance.
+    Either way, instance i is sampled with seed+i.
+    
+    Instance i gets the exclusive values of rank i in the seeded sample, so that instances do not depend on how many are sampled:
+    with first_instance, only instances first_instance to n_instances-1 are sampled and probed.
+    """
             
     # Read config
     config = load_config(configfile)
     batch0_endpoint = config["generation"]["virtuoso"]["default_endpoint"]
+    result_store = config["generation"]["virtuoso"].get("result_store")
+    if probing is None:
+        probing = config["generation"]["virtuoso"].get("exclusive_probing") or "per-instance"
     
     # Composition
     comp = {}
     with open(constfile, "r") as cfs:
         comp = json.load(cfs)
+    datatypes = read_constant_datatypes(constfile)
     
     # Obtain the rest of the placeholders using VALUES
-    workload_subq_value_selection = (
-        read_csv(excl_value_selection)
-        .sample(n_instances, random_state=seed)
-        .reset_index(drop=True)
-    )
+    reservoir = Reservoir(n_instances, seed=seed)
+    for chunk in read_result_file(excl_value_selection, chunksize=RESULT_CHUNK_SIZE):
+        reservoir.update(chunk)
+    workload_subq_value_selection = reservoir.result().iloc[first_instance:].reset_index(drop=True)
+    instance_ids = list(range(first_instance, n_instances))
         
     subq_algebra, _ = ctx.invoke(parse_query, queryfile=queryfile, querydata=querydata)
     subq_variables = set(map(str, _traverseAgg(subq_algebra, collect_triple_variables)))
@@ -732,120 +2018,190 @@ def create_workload_value_selection_with_exclusive(ctx: click.Context, configfil
             if const in filter_consts:
                 filter_consts.remove(const)
     
-    tmp_dfs = []
-    for instance_id in tqdm(range(n_instances)):
-        tmp_query_algebra, options = ctx.invoke(parse_query, queryfile=queryfile, querydata=querydata)  
-        inline_data = workload_subq_value_selection.iloc[instance_id]
-        if isinstance(inline_data, pd.Series):
-            inline_data = inline_data.to_frame().T
-        inline_data = inline_data.to_dict(orient="list")
+    def sample_instances(instance_results):
+        # Results are sampled one by one in instance order, each with its own seed
+        tmp_dfs = []
+        constraints = None
+        for instance_id, instance_result in zip(instance_ids, tqdm(instance_results, total=len(instance_ids))):
+            # Probe results of all instances have the same columns, compile the constraints against the first one
+            if constraints is None:
+                constraints = compile_constraints(comp, instance_result.columns)
+            tmp_df: pd.DataFrame = ctx.invoke(
+                create_workload_value_selection_with_constraints, 
+                value_selection_data=instance_result, 
+                n_instances=1, 
+                seed=seed+instance_id,
+                constfile=constfile,
+                constraints=constraints
+            )
+            tmp_dfs.append(tmp_df)
+        return pd.concat(tmp_dfs, ignore_index=True)
+    
+    if probing == "batched":
+        tmp_query_algebra, options = ctx.invoke(parse_query, queryfile=queryfile, querydata=querydata)
+        inline_data = workload_subq_value_selection.to_dict(orient="list")
+        inline_data[INSTANCE_ID_VARIABLE] = instance_ids
         query_consts = set(map(str, _traverseAgg(tmp_query_algebra, collect_triple_variables)))
-        tmp_query_algebra = traverse(tmp_query_algebra, visitPost=lambda node: add_values_with_placeholders(node, inline_data))
-        tmp_query_algebra = traverse(tmp_query_algebra, visitPost=lambda node: remove_filter_with_placeholders(node, consts={"query": query_consts,"select": consts, "filter": filter_consts}))
-        tmp_query_algebra = traverse(tmp_query_algebra, disable_orderby_limit)
-        tmp_query_algebra = traverse(tmp_query_algebra, disable_offset)
-        tmp_query_str = export_query(tmp_query_algebra, options)
-        
-        # if not os.path.exists(tmp_query_result_file):              
-        tmp_query_result = ctx.invoke(
+        tmp_query_algebra = rewrite(
+            tmp_query_algebra,
+            lambda node: add_values_with_rows(node, inline_data, datatypes),
+            lambda node: remove_filter_with_placeholders(node, consts={"query": query_consts,"select": consts, "filter": filter_consts}),
+            lambda node: add_projection_variables(node, [INSTANCE_ID_VARIABLE]),
+            disable_orderby_limit,
+            disable_offset
+        )
+        probe_result: pd.DataFrame = ctx.invoke(
             execute_query, 
-            querydata=tmp_query_str, 
+            querydata=export_query(tmp_query_algebra, options), 
             endpoint=batch0_endpoint, 
-        )        
-        
-        tmp_df: pd.DataFrame = ctx.invoke(
-            create_workload_value_selection_with_constraints, 
-            value_selection_data=tmp_query_result, 
-            n_instances=1, 
-            seed=PANDAS_RANDOM_STATE+instance_id,
-            constfile=constfile
+            result_store=result_store,
+            batch_id=0,
+            configfile=configfile,
+            page_size=config["generation"]["virtuoso"].get("page_size")
         )
         
-        tmp_dfs.append(tmp_df)
+        # Split the result by instance
+        probe_instance_ids = probe_result.pop(INSTANCE_ID_VARIABLE).to_numpy()
+        order = np.argsort(probe_instance_ids, kind="stable")
+        bounds = np.searchsorted(probe_instance_ids[order], np.arange(first_instance, n_instances + 1))
+        workload_subq_value_selection = sample_instances(
+            probe_result.iloc[order[bounds[i]:bounds[i+1]]].reset_index(drop=True) 
+            for i in range(n_instances - first_instance)
+        )
+    
+    else:
+        tmp_query_strs = []
+        for position in range(len(instance_ids)):
+            tmp_query_algebra, options = ctx.invoke(parse_query, queryfile=queryfile, querydata=querydata)  
+            inline_data = workload_subq_value_selection.iloc[position]
+            if isinstance(inline_data, pd.Series):
+                inline_data = inline_data.to_frame().T
+            inline_data = inline_data.to_dict(orient="list")
+            query_consts = set(map(str, _traverseAgg(tmp_query_algebra, collect_triple_variables)))
+            tmp_query_algebra = rewrite(
+                tmp_query_algebra,
+                lambda node: add_values_with_rows(node, inline_data, datatypes),
+                lambda node: remove_filter_with_placeholders(node, consts={"query": query_consts,"select": consts, "filter": filter_consts}),
+                disable_orderby_limit,
+                disable_offset
+            )
+            tmp_query_strs.append(export_query(tmp_query_algebra, options))
         
-    workload_subq_value_selection = pd.concat(tmp_dfs, ignore_index=True)
-    workload_subq_value_selection.to_csv(workload_value_selection, index=False)
+        def probe(tmp_query_str):
+            return ctx.invoke(
+                execute_query, 
+                querydata=tmp_query_str, 
+                endpoint=batch0_endpoint, 
+                result_store=result_store,
+                batch_id=0,
+                configfile=configfile
+            )
+        
+        # Probes are sent concurrently, while results are sampled in instance order, 
+        # so that the output does not depend on which probe returns first.
+        if n_jobs is None:
+            n_jobs = config["generation"]["virtuoso"].get("max_client_connections", 1)
+        
+        with ThreadPoolExecutor(max_workers=max(1, min(n_jobs, len(instance_ids)))) as executor:
+            futures = [ executor.submit(probe, tmp_query_str) for tmp_query_str in tmp_query_strs ]
+            workload_subq_value_selection = sample_instances( future.result() for future in futures )
+        
+    if workload_value_selection:
+        write_result_file(workload_subq_value_selection, workload_value_selection)
     return workload_subq_value_selection
                             
-@cli.command()
-@click.option("--value-selection", type=click.Path(exists=True, file_okay=True, dir_okay=False))
-@click.option("--value-selection-data", type=click.STRING)
-@click.option("--n-instances", type=click.INT)
-@click.option("--subquery-file", type=click.Path(exists=True, file_okay=True, dir_okay=False))
-@click.option("--workload-value-selection", type=click.Path(exists=False, file_okay=True, dir_okay=False))
-@click.option("--constfile", type=click.Path(exists=True, file_okay=True, dir_okay=False))
-@click.option("--seed", type=click.INT, default=PANDAS_RANDOM_STATE)
-@click.pass_context
-def create_workload_value_selection_with_constraints(ctx: click.Context, value_selection, value_selection_data, n_instances, subquery_file, workload_value_selection, constfile, seed):
-    """Sample {n_instances} rows amongst the value selection. 
-    The sampling is guaranteed to return results for provenance queries, using statistical criteria:
-        1. Percentiles for numerical attribute: if value falls between 25-75 percentile
-        2. URL: ignored
-        3. String value: contains top 10 most common words
+def encode_join_keys(frames, join_cols):
+    """Encode the join columns of every frame as one integer key, with codes shared across frames.
+    Missing values get a code of their own, as pd.merge matches them with each other.
+    """
+    keys = [ np.zeros(len(frame), dtype=np.int64) for frame in frames ]
+    offsets = np.cumsum([0] + [ len(frame) for frame in frames ])
+    for col in join_cols:
+        codes, uniques = pd.factorize(pd.concat([ frame[col] for frame in frames ], ignore_index=True))
+        codes = np.where(codes < 0, len(uniques), codes)
+        combined = [ key * (len(uniques) + 1) + codes[offsets[i]:offsets[i+1]] for i, key in enumerate(keys) ]
+        # Renumber after each column so that keys never overflow
+        combined_codes, _ = pd.factorize(np.concatenate(combined))
+        keys = [ combined_codes[offsets[i]:offsets[i+1]].astype(np.int64) for i in range(len(frames)) ]
+    return keys
+
+def join_subquery_results(frames, join_cols):
+    """Inner join subquery results on their common columns, as successive pd.merge in file order would.
+
+    1. Join columns, e.g. IRIs, are encoded as integer keys shared by all frames.
+    2. Rows whose key is missing from any frame are dropped (semi-join reduction), before any join.
+    3. Frames are joined on the integer key, each time with the frame that yields the smallest intermediate result,
+       estimated from key counts.
+    
+    Columns are named and ordered as with pd.merge in file order. Rows are ordered as their positions in the files.
 
     Args:
-        value_selection (_type_): _description_
-        workload_value_selection (_type_): _description_
-        n_instances (_type_): _description_
+        frames (list): The subquery results, in file order.
+        join_cols (list): The columns shared by all frames.
+
+    Raises:
+        ValueError: the frames share no column.
+
+    Returns:
+        pd.DataFrame: the joined result.
     """
+    if len(frames) == 1:
+        return frames[0]
     
-    with open(constfile, "r") as cfs:
-        comp = json.load(cfs)
-        
-    subqueries = {}
+    join_cols = sorted(join_cols)
+    if len(join_cols) == 0:
+        raise ValueError("Subquery results share no column to join on!")
     
-    if subquery_file:
-        with open(subquery_file, "r") as sqfs:
-            subqueries = json.load(sqfs)
+    # Names and order of the columns as given by pd.merge in file order
+    # (one-row stand-ins, as merging empty frames does not order columns the same way)
+    out_columns = reduce(
+        lambda left, right: pd.merge(left, right, how="inner", on=join_cols), 
+        [ pd.DataFrame({col: [0] for col in frame.columns}) for frame in frames ]
+    ).columns
+    sources = [ (0, col) for col in frames[0].columns ] + [ (i, col) for i, frame in enumerate(frames) if i > 0 for col in frame.columns if col not in join_cols ]
     
-    subquery_results = []
-    if value_selection_data is not None:
-        subquery_results.append(value_selection_data)
+    keys = encode_join_keys(frames, join_cols)
+    common_keys = reduce(np.intersect1d, [ np.unique(key) for key in keys ])
+    
+    reduced = []
+    for i, (frame, key) in enumerate(zip(frames, keys)):
+        mask = np.isin(key, common_keys)
+        columns = frame.columns if i == 0 else [ col for col in frame.columns if col not in join_cols ]
+        tmp = frame.loc[mask, columns]
+        tmp.columns = [ f"{i}:{col}" for col in columns ]
+        tmp.insert(0, f"{i}:__pos", np.flatnonzero(mask))
+        tmp.insert(0, "__key", key[mask])
+        reduced.append(tmp.reset_index(drop=True))
+        logger.debug(f"Subquery result {i}: {len(frame)} rows, {len(tmp)} after semi-join reduction")
+    
+    # Greedily join the frame that keeps the intermediate result the smallest
+    remaining = sorted(range(len(reduced)), key=lambda i: len(reduced[i]))
+    df = reduced[remaining.pop(0)]
+    while len(remaining) > 0:
+        counts = df["__key"].value_counts()
+        estimates = [ (counts * reduced[i]["__key"].value_counts()).sum() for i in remaining ]
+        next_id = remaining.pop(int(np.argmin(estimates)))
+        logger.debug(f"Joining subquery result {next_id}, estimated {min(estimates)} rows")
+        df = pd.merge(df, reduced[next_id], how="inner", on="__key")
     
-    if value_selection is None: 
-        subquery_result_files = [ sq_info["subq_value_selection_file"] for sq_info in subqueries.values() if "subq_value_selection_file" in sq_info ]
+    df = df.sort_values([ f"{i}:__pos" for i in range(len(frames)) ], kind="stable", ignore_index=True)
+    df = df[[ f"{i}:{col}" for i, col in sources ]]
+    df.columns = out_columns
+    return df
 
-        join_cols = set()        
-        for subquery_result_file in subquery_result_files:
-            tmp = read_csv(subquery_result_file)
-            subquery_results.append(tmp)
-            
-            if len(join_cols) == 0:
-                join_cols = set(tmp.columns)
-            else:
-                join_cols = join_cols & set(tmp.columns)
-        
-        logger.debug(f"Join columns: {join_cols}")
-    else:
-        subquery_results.append(read_csv(value_selection))
-
-    # Join all subquery results  
-    df = subquery_results.pop(0)
-    while len(subquery_results) > 0:
-        tmp = subquery_results.pop(0)
-        logger.debug(f"Left join with {df.columns}")
-        logger.debug(f"Right join with {tmp.columns}")
-        df = pd.merge(df, tmp, how="inner", on=list(join_cols))
-    
-    # Filter out numerical values that are not in the 10-90 percentile    
-    numerical_cols = []
-    for col in df.columns:
-        values = df[col].dropna()
-        if not values.empty:
-            dtype = values.dtype
-            if np.issubdtype(dtype, np.number) or np.issubdtype(dtype, np.datetime64):
-                numerical_cols.append(col)
-    
-    numerical = df[numerical_cols]
-    if not numerical.empty:
-        query = " or ".join([
-            f"( `{col}` >= {repr(numerical[col].quantile(0.10))} and `{col}` <= {repr(numerical[col].quantile(0.90))} )"
-            # f"( `{col}` > {repr(numerical[col].min())} and `{col}` < {repr(numerical[col].max())} )"
-            for col in numerical.columns
-        ])
+def compile_constraints(comp, columns):
+    """Compile the constraints of a constfile against the columns of a value selection, once per template.
 
-        df = df.query(query)   
-    
+    Conditions between columns become a single boolean mask over the value selection, see compile_query.
+    Conditions comparing a column with a placeholder that is not a column are left for the placeholder values to satisfy.
+
+    Args:
+        comp (dict): The content of the constfile.
+        columns (list): The columns of the value selection.
+
+    Returns:
+        tuple: the mask function, None without condition between columns, the placeholder conditions and the placeholder names.
+    """
     def has_only_placeholder(node, children):
         if isinstance(node, CompValue):
             if node.name == "Placeholder":
@@ -853,16 +2209,16 @@ def create_workload_value_selection_with_constraints(ctx: click.Context, value_s
             return False
         return all(children)
     
-    def remove_placeholder_nodes(node, non_placeholder_queries, non_placeholder_names, df):
+    def remove_placeholder_nodes(node, non_placeholder_queries, non_placeholder_names, columns):
         if isinstance(node, CompValue):
             if node.name == "ComparisonCondition":
                 left, op, right = node["left"]["column_name"], node["op"]["op"], node["right"]["column_name"]
                 logger.debug(f"Inspecting: left={repr(left)}, op={repr(op)}, right={repr(right)}")
-                if left not in df.columns:
+                if left not in columns:
                     non_placeholder_queries.append(node)
                     non_placeholder_names.add(right)
                     return CompValue("Placeholder")
-                if right not in df.columns:
+                if right not in columns:
                     non_placeholder_queries.append(node)
                     non_placeholder_names.add(right)
                     return CompValue("Placeholder")
@@ -878,65 +2234,10 @@ def create_workload_value_selection_with_constraints(ctx: click.Context, value_s
                 op, right = node["op"], node["right"]
                 if right.name == "Placeholder":
                     return CompValue("Placeholder")
-                
-    def create_placeholder_value(row, placeholder_query):
-        """Create a placeholder value for a given row based on the placeholder query.
     
-        Args:
-            row (dict): The row containing the values.
-            placeholder_query (dict): The placeholder query specifying the left and right column names and the operator.
-
-        Raises:
-            ValueError: If the left column name is not found in the dataframe.
-            ValueError: If the right column name is not found in the dataframe.
-
-        Returns:
-            dict: The updated row with the placeholder value filled.
-        """
-        
-        left, op, right = placeholder_query["left"]["column_name"], placeholder_query["op"]["op"], placeholder_query["right"]["column_name"]
-        
-        def estimate_replacement_value_based_on_op(op, value):
-            epsilon = None
-            if str(value).isnumeric():
-                epsilon = 1
-            elif isinstance(value, pd.Timestamp):
-                epsilon = pd.Timedelta(days=1)
-            else:
-                raise ValueError(f"Unsupported value type {type(value)} for value {value}!")
-            
-            if op in ["=", "!=", "in"]:
-                return value
-            elif op in [">", ">="]:
-                return value - epsilon
-            elif op in ["<", "<="]:
-                return value + epsilon
-            else:
-                raise ValueError(f"Unsupported operator: {op}")
-        
-        # Left is the placeholder, select random value in df[right]
-        # x < p1
-        if left not in df.columns:
-            logger.debug(f"Row: {row}")
-            subq = f"{right} {op} {repr(estimate_replacement_value_based_on_op(op, row[right]))}" 
-            logger.debug(f"subq: {subq}")
-            candidates = df.query(subq)[right]
-            if candidates.empty:
-                raise ValueError(f"Query {subq} returns no result!")
-            row[left] = candidates.sample(1, random_state=seed).item()
-        
-        # Right is the placeholder, select random value in df[left]
-        elif right not in df.columns:
-            subq = f"{left} {op} {repr(estimate_replacement_value_based_on_op(op, row[left]))}" 
-            candidates = df.query(subq)[left]
-            if candidates.empty:
-                raise ValueError(f"Query {subq} returns no result!")
-            row[right] = candidates.sample(1, random_state=seed).item()
-                
-        return row
-                    
     non_placeholder_queries = []
     non_placeholder_names = set()
+    constraint_filter = None
     
     cond_queries = [ q.get("query") for q in comp.values() if len(q) > 0 and q.get("query") ]
     if len(cond_queries) > 0:
@@ -946,30 +2247,236 @@ def create_workload_value_selection_with_constraints(ctx: click.Context, value_s
         algebra = traverse(
             algebra, 
             visitPost=lambda node: remove_placeholder_nodes(
-                node, non_placeholder_queries, non_placeholder_names, df
+                node, non_placeholder_queries, non_placeholder_names, columns
             )
         )
         
         if not _traverseAgg(algebra, has_only_placeholder):
             logger.debug("Filtering on placeholder columns...")
-            query = translate_query(algebra)    
-            df = df.query(query)
+            logger.debug(f"Filter: {translate_query(algebra)}")
+            constraint_filter = compile_query(algebra)
     
-    if df.empty:
+    return constraint_filter, non_placeholder_queries, non_placeholder_names
+
+@cli.command()
+@click.option("--value-selection", type=click.Path(exists=True, file_okay=True, dir_okay=False))
+@click.option("--value-selection-data", type=click.STRING)
+@click.option("--n-instances", type=click.INT)
+@click.option("--subquery-file", type=click.Path(exists=True, file_okay=True, dir_okay=False))
+@click.option("--workload-value-selection", type=click.Path(exists=False, file_okay=True, dir_okay=False))
+@click.option("--constfile", type=click.Path(exists=True, file_okay=True, dir_okay=False))
+@click.option("--seed", type=click.INT, default=PANDAS_RANDOM_STATE)
+@click.option("--first-instance", type=click.INT, default=0, help="Only return instances from this one on, e.g. the instances missing from a workload.")
+@click.pass_context
+def create_workload_value_selection_with_constraints(ctx: click.Context, value_selection, value_selection_data, n_instances, subquery_file, workload_value_selection, constfile, seed, first_instance, constraints=None):
+    """Sample {n_instances} rows amongst the value selection. 
+    The sampling is guaranteed to return results for provenance queries, using statistical criteria:
+        1. Percentiles for numerical attribute: if value falls between 25-75 percentile
+        2. URL: ignored
+        3. String value: contains top 10 most common words
+
+    Args:
+        value_selection (_type_): _description_
+        workload_value_selection (_type_): _description_
+        n_instances (_type_): _description_
+        constraints (tuple, optional): The constraints of constfile compiled by compile_constraints, when invoked from Python. 
+            Defaults to compiling them against the columns of the value selection.
+    """
+    
+    with open(constfile, "r") as cfs:
+        comp = json.load(cfs)
+        
+    subqueries = {}
+    
+    if subquery_file:
+        with open(subquery_file, "r") as sqfs:
+            subqueries = json.load(sqfs)
+    
+    subquery_results = []
+    if value_selection_data is not None:
+        subquery_results.append(value_selection_data)
+    
+    join_cols = set()
+    if value_selection is not None and value_selection_data is None:
+        # A single value selection file is streamed rather than loaded
+        read_chunks = partial(read_result_file, value_selection, chunksize=RESULT_CHUNK_SIZE)
+    else:
+        if value_selection is None: 
+            subquery_result_files = [ sq_info["subq_value_selection_file"] for sq_info in subqueries.values() if "subq_value_selection_file" in sq_info ]
+
+            for subquery_result_file in subquery_result_files:
+                tmp = read_result_file(subquery_result_file)
+                subquery_results.append(tmp)
+                
+                if len(join_cols) == 0:
+                    join_cols = set(tmp.columns)
+                else:
+                    join_cols = join_cols & set(tmp.columns)
+            
+            logger.debug(f"Join columns: {join_cols}")
+        else:
+            subquery_results.append(read_result_file(value_selection))
+
+        # Join all subquery results  
+        df = join_subquery_results(subquery_results, join_cols)
+        read_chunks = lambda: iter([df])
+    
+    # Percentiles of numerical values, estimated from a sample of each column
+    columns, numerical_samples = None, {}
+    for chunk in read_chunks():
+        if columns is None:
+            columns = chunk.columns
+        for col in chunk.columns:
+            values = chunk[col].dropna()
+            if not values.empty:
+                dtype = values.dtype
+                if pd.api.types.is_numeric_dtype(dtype) or pd.api.types.is_datetime64_any_dtype(dtype):
+                    numerical_samples.setdefault(col, Reservoir(STATISTICS_SAMPLE_SIZE, seed=seed)).update(values)
+    
+    if columns is None:
+        raise ValueError("No results after filtering...")
+    
+    percentiles = { col: sample.result(exact=False).quantile([0.10, 0.90]) for col, sample in numerical_samples.items() }
+    
+    def compared_columns(placeholder_query):
+        """The placeholder of a placeholder query and the column it is compared to, None if it compares two columns.
+        """
+        left, right = placeholder_query["left"]["column_name"], placeholder_query["right"]["column_name"]
+        # Left is the placeholder, select random value in right
+        # x < p1
+        if left not in columns:
+            return left, right
+        # Right is the placeholder, select random value in left
+        elif right not in columns:
+            return right, left
+        return None
+                
+    def create_placeholder_values(result, placeholder_query):
+        """Fill a placeholder for all rows at once, based on the placeholder query.
+        
+        For each row, the value is drawn amongst the values of the column compared to the placeholder 
+        that satisfy the comparison with the row's own value, shifted by one unit (one day for dates).
+        The candidates are sorted once, so that the candidates of every row are a range found with np.searchsorted.
+    
+        Args:
+            result (pd.DataFrame): The rows to fill.
+            placeholder_query (dict): The placeholder query specifying the left and right column names and the operator.
+
+        Raises:
+            ValueError: If the compared column is neither numerical nor dates.
+            ValueError: If the operator is not supported.
+            ValueError: If no value satisfies the comparison for some row.
+
+        Returns:
+            pd.DataFrame: The rows with the placeholder filled.
+        """
+        
+        op = placeholder_query["op"]["op"]
+        if compared_columns(placeholder_query) is None:
+            return result
+        placeholder, column = compared_columns(placeholder_query)
+        
+        values = result[column]
+        if pd.api.types.is_datetime64_any_dtype(values):
+            epsilon = pd.Timedelta(days=1)
+        elif pd.api.types.is_numeric_dtype(values):
+            epsilon = 1
+        else:
+            raise ValueError(f"Unsupported value type {values.dtype} for column {column}!")
+        
+        if op in [">", ">="]:
+            thresholds = values - epsilon
+        elif op in ["<", "<="]:
+            thresholds = values + epsilon
+        elif op in ["=", "!=", "in"]:
+            thresholds = values
+        else:
+            raise ValueError(f"Unsupported operator: {op}")
+        
+        candidate_sample = candidate_samples[column]
+        candidates = candidate_sample.result(exact=False).to_numpy()
+        if candidate_sample.n_seen > len(candidates):
+            # Only a sample of the column is known, in which the rows' own values may be missing
+            candidates = np.concatenate([candidates, values.dropna().to_numpy()])
+        candidates = np.sort(candidates)
+        thresholds = thresholds.to_numpy()
+        lower = np.searchsorted(candidates, thresholds, side="left")
+        upper = np.searchsorted(candidates, thresholds, side="right")
+        n_candidates = len(candidates)
+        
+        # Candidates of a row are candidates[start:start+count], skipping those equal to its threshold for !=
+        if op == "<":
+            start, count = 0, lower
+        elif op == "<=":
+            start, count = 0, upper
+        elif op == ">":
+            start, count = upper, n_candidates - upper
+        elif op == ">=":
+            start, count = lower, n_candidates - lower
+        elif op in ["=", "in"]:
+            start, count = lower, upper - lower
+        else:
+            start, count = 0, n_candidates - (upper - lower)
+        count = np.where(pd.isna(thresholds), 0, count)
+        
+        if (count == 0).any():
+            threshold = thresholds[np.argmax(count == 0)]
+            raise ValueError(f"Query {column} {op} {repr(threshold)} returns no result!")
+        
+        picks = start + np.floor(np.random.RandomState(seed).random_sample(len(result)) * count).astype(int)
+        if op == "!=":
+            picks = np.where(picks >= lower, picks + (upper - lower), picks)
+        
+        result = result.copy()
+        result[placeholder] = candidates[picks]
+        return result
+                    
+    if constraints is None:
+        constraints = compile_constraints(comp, columns)
+    constraint_filter, non_placeholder_queries, non_placeholder_names = constraints
+    
+    # Sample n_instances amongst the filtered rows, and the values placeholders are drawn from
+    reservoir = Reservoir(n_instances, seed=seed)
+    candidate_samples = {}
+    for placeholder_query in non_placeholder_queries:
+        if compared_columns(placeholder_query) is not None:
+            _, column = compared_columns(placeholder_query)
+            if column in columns:
+                candidate_samples[column] = Reservoir(STATISTICS_SAMPLE_SIZE, seed=seed)
+    
+    for chunk in read_chunks():
+        # Filter out numerical values that are not in the 10-90 percentile
+        if len(percentiles) > 0:
+            # Keep the rows with at least one value between the 10th and 90th percentile of its column
+            mask = np.zeros(len(chunk), dtype=bool)
+            for col, bounds in percentiles.items():
+                mask |= chunk[col].between(bounds[0.10], bounds[0.90]).to_numpy()
+            chunk = chunk.loc[mask]
+        
+        if constraint_filter is not None:
+            chunk = chunk.loc[constraint_filter(chunk)]
+        
+        reservoir.update(chunk)
+        for column, candidate_sample in candidate_samples.items():
+            candidate_sample.update(chunk[column].dropna())
+    
+    if reservoir.n_seen == 0:
         raise ValueError("No results after filtering...")
     
-    # Sample n_instances
-    result = df.sample(n_instances)
+    result = reservoir.result()
     
     # Get a value for the placeholder
     for placeholder_query in non_placeholder_queries:
         logger.debug(f"Placeholder query: {placeholder_query}")
-        result = result.apply(lambda row: create_placeholder_value(row, placeholder_query), axis=1) 
+        result = create_placeholder_values(result, placeholder_query)
     
     # Remove placeholder columns
     result.drop(columns=non_placeholder_names, axis=1, inplace=True)
+    
+    # Instance i is the row of rank i in the seeded sample, with the i-th draw of each placeholder, whatever n_instances
+    result = result.iloc[first_instance:].reset_index(drop=True)
     if workload_value_selection:
-        result.to_csv(workload_value_selection, index=False)
+        write_result_file(result, workload_value_selection)
     return result
 
 
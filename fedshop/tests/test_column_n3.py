@@ -0,0 +1,68 @@
+from pathlib import Path
+import sys
+import unittest
+
+import numpy as np
+import pandas as pd
+
+FEDSHOP_DIR = Path(__file__).parent.parent
+sys.path.insert(0, str(FEDSHOP_DIR))
+
+from algebra.rdflib_algebra import column_n3, normalize_constant
+
+PRODUCT = "http://www4.wiwiss.fu-berlin.de/bizer/bsbm/v01/instances/dataFromProducer1/Product{}"
+
+# One column per kind of value selection column, with missing values wherever the dtype holds them
+COLUMNS = {
+    "iri": pd.Series([PRODUCT.format(1), PRODUCT.format(2), np.nan, PRODUCT.format(1)], dtype=object),
+    "iri_category": pd.Series([PRODUCT.format(1), np.nan, PRODUCT.format(2), PRODUCT.format(1)], dtype="category"),
+    "blank_node": pd.Series(["nodeID://b0", "nodeID://b1", None], dtype=object),
+    "int64": pd.Series([0, -7, 42, 10**12], dtype=np.int64),
+    "int32": pd.Series([1, 2, 3], dtype=np.int32),
+    "nullable_int": pd.Series([5, pd.NA, 18], dtype="Int64"),
+    "int_category": pd.Series([3, 1, 3, np.nan], dtype="category"),
+    "bool": pd.Series([True, False, True], dtype=bool),
+    "nullable_bool": pd.Series([True, pd.NA, False], dtype="boolean"),
+    "float": pd.Series([12.5, np.nan, 150.0, -0.25, 1e-7], dtype=np.float64),
+    "whole_float": pd.Series([1.0, 2.0, 3.0], dtype=np.float64),
+    "datetime": pd.Series(pd.to_datetime(["2008-06-20", "2008-06-21T10:30:00", None])),
+    "fractional_datetime": pd.Series(pd.to_datetime(["2008-06-20T10:30:00.5", "2008-06-21", "2008-06-22T00:00:00.000001"])),
+    "nanosecond_datetime": pd.Series(pd.to_datetime(["2008-06-20T10:30:00.000000001", "2008-06-21"])),
+    "tz_datetime": pd.Series(pd.to_datetime(["2008-06-20T10:30:00", "2008-06-21", None])).dt.tz_localize("Europe/Paris"),
+    "utc_datetime": pd.Series(pd.to_datetime(["2008-06-20T10:30:00.25Z", "2008-06-21T00:00:00Z"])),
+    "datetime_category": pd.Series(pd.to_datetime(["2008-06-20", "2008-06-20", None])).astype("category"),
+    "text": pd.Series(["potato", "kartoffel", None, 'say "hi"'], dtype=object),
+    "text_category": pd.Series(["potato", np.nan, "potato", "accent é"], dtype="category"),
+    "empty": pd.Series([], dtype=object),
+    "all_missing": pd.Series([np.nan, np.nan], dtype=np.float64),
+}
+
+def expected_n3(column):
+    return pd.Series(
+        [ "UNDEF" if pd.isna(value) else normalize_constant(value).n3() for value in column.tolist() ],
+        index=column.index, dtype=object
+    )
+
+class TestColumnN3(unittest.TestCase):
+    """column_n3 serializes whole columns of the workload value selection at once,
+    and must give what serializing each value with normalize_constant gives."""
+
+    def test_like_normalize_constant(self):
+        for name, column in COLUMNS.items():
+            with self.subTest(column=name, dtype=str(column.dtype)):
+                pd.testing.assert_series_equal(column_n3(column), expected_n3(column))
+
+    def test_index(self):
+        # Rows keep their labels, e.g. after sampling the value selection
+        for name, column in COLUMNS.items():
+            with self.subTest(column=name):
+                shuffled = column.sample(frac=1, random_state=0).set_axis(np.arange(len(column)) * 3 + 1)
+                pd.testing.assert_series_equal(column_n3(shuffled), expected_n3(shuffled))
+
+    def test_missing_values(self):
+        for name, column in COLUMNS.items():
+            with self.subTest(column=name):
+                self.assertTrue((column_n3(column)[column.isna()] == "UNDEF").all())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+from functools import reduce
+from pathlib import Path
+import sys
+import unittest
+
+import numpy as np
+import pandas as pd
+
+FEDSHOP_DIR = Path(__file__).parent.parent
+sys.path.insert(0, str(FEDSHOP_DIR))
+
+from query import join_subquery_results
+
+def random_frames(seed, n_frames):
+    """Subquery results sharing the join columns "a" and "b", with missing and unmatched keys.
+    Each frame has a column "row<i>" holding its row positions, and "c" is shared by the first and last frames only.
+    """
+    random_state = np.random.RandomState(seed)
+    iris = np.array([ f"http://example.org/r{i}" for i in range(6) ] + [None], dtype=object)
+    frames = []
+    for i in range(n_frames):
+        n_rows = random_state.randint(1, 40)
+        frame = pd.DataFrame({
+            "a": random_state.choice(iris, n_rows),
+            f"row{i}": np.arange(n_rows),
+            "b": random_state.choice([1.0, 2.0, 3.0, np.nan], n_rows),
+        })
+        if i in [0, n_frames - 1]:
+            frame["c"] = random_state.randint(0, 3, n_rows)
+        frames.append(frame)
+    return frames
+
+def sorted_rows(df):
+    return df.astype(object).where(df.notna(), "<NaN>").astype(str).sort_values(df.columns.to_list()).reset_index(drop=True)
+
+class TestJoinSubqueryResults(unittest.TestCase):
+    """join_subquery_results plans the join of subquery results, and must give what chained pd.merge gives."""
+
+    def assert_joins_like_merge(self, frames, join_cols):
+        expected = reduce(lambda left, right: pd.merge(left, right, how="inner", on=list(join_cols)), frames)
+        result = join_subquery_results(frames, join_cols)
+
+        if len(expected) > 0:
+            self.assertListEqual(result.columns.to_list(), expected.columns.to_list())
+        else:
+            # pd.merge orders columns differently once an intermediate result is empty, see test_empty_frame
+            self.assertSetEqual(set(result.columns), set(expected.columns))
+            expected = expected[result.columns]
+        pd.testing.assert_frame_equal(sorted_rows(result), sorted_rows(expected))
+        self.assert_rows_in_file_order(result, len(frames))
+        return result
+
+    def assert_rows_in_file_order(self, result, n_frames):
+        # Rows follow their positions in the files, first file first
+        positions = [ f"row{i}" for i in range(n_frames) ]
+        self.assertTrue(result.equals(result.sort_values(positions, kind="stable", ignore_index=True)))
+
+    def test_random_frames(self):
+        n_non_empty = 0
+        for seed in range(30):
+            for n_frames in [2, 3, 4]:
+                with self.subTest(seed=seed, n_frames=n_frames):
+                    result = self.assert_joins_like_merge(random_frames(seed, n_frames), {"a", "b"})
+                    n_non_empty += len(result) > 0
+        # Most joins have rows, so that positions and columns are actually compared
+        self.assertGreater(n_non_empty, 45)
+
+    def test_missing_keys_match(self):
+        # As with pd.merge, missing values in join columns match each other
+        frames = [
+            pd.DataFrame({"a": ["x", None, None], "row0": [0, 1, 2]}),
+            pd.DataFrame({"a": [None, "y", "x"], "row1": [0, 1, 2]}),
+        ]
+        result = self.assert_joins_like_merge(frames, {"a"})
+        self.assertListEqual(result["row0"].to_list(), [0, 1, 2])
+        self.assertListEqual(result["row1"].to_list(), [2, 0, 0])
+
+    def test_unmatched_keys(self):
+        frames = [
+            pd.DataFrame({"a": ["x", "y"], "row0": [0, 1]}),
+            pd.DataFrame({"a": ["z"], "row1": [0]}),
+        ]
+        result = self.assert_joins_like_merge(frames, {"a"})
+        self.assertEqual(len(result), 0)
+
+    def test_empty_frame(self):
+        # pd.merge orders columns differently when a frame is empty, the join keeps the order it has with rows
+        for empty_id in range(3):
+            with self.subTest(empty_id=empty_id):
+                frames = random_frames(3, 3)
+                expected_columns = self.assert_joins_like_merge(frames, {"a", "b"}).columns
+                frames[empty_id] = frames[empty_id].iloc[:0]
+                result = join_subquery_results(frames, {"a", "b"})
+                self.assertEqual(len(result), 0)
+                self.assertListEqual(result.columns.to_list(), expected_columns.to_list())
+
+    def test_categorical_keys(self):
+        # Subquery results hold IRIs as categories, each file with its own categories
+        frames = random_frames(7, 3)
+        for frame in frames:
+            frame["a"] = frame["a"].astype("category")
+        self.assert_joins_like_merge(frames, {"a", "b"})
+
+    def test_no_common_column(self):
+        with self.assertRaises(ValueError):
+            join_subquery_results([pd.DataFrame({"a": [1]}), pd.DataFrame({"b": [1]})], set())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,42 @@
+import json
+import os
+from pathlib import Path
+import subprocess
+import sys
+import unittest
+
+FEDSHOP_DIR = Path(__file__).parent.parent
+
+# Wall-clock budget for importing query.py, in seconds
+IMPORT_TIME_BUDGET = float(os.environ.get("RSFB__IMPORT_TIME_BUDGET", 5))
+
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import query
+elapsed = time.perf_counter() - start
+print(json.dumps({
+    "elapsed": elapsed,
+    "modules": [ module for module in sys.modules if module.split(".")[0] in ["nltk", "ftlangdetect", "iso639"] ]
+}))
+"""
+
+class TestQueryImport(unittest.TestCase):
+    """Importing query.py must not load nltk, its corpora nor the language detection, see get_stopwords and lang_detect."""
+
+    def import_query(self):
+        # A fresh interpreter, so that no module is loaded by the test runner beforehand
+        proc = subprocess.run([sys.executable, "-c", IMPORT_SCRIPT], cwd=FEDSHOP_DIR, capture_output=True, text=True)
+        self.assertEqual(proc.returncode, 0, proc.stderr)
+        return json.loads(proc.stdout.strip().splitlines()[-1])
+
+    def test_lazy_modules_not_loaded(self):
+        report = self.import_query()
+        self.assertListEqual(report["modules"], [], "nltk or the language detection is loaded when importing query.py")
+
+    def test_import_time_budget(self):
+        report = self.import_query()
+        self.assertLess(report["elapsed"], IMPORT_TIME_BUDGET, f"Importing query.py took {report['elapsed']:.2f}s")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+from pathlib import Path
+import sys
+import unittest
+
+import numpy as np
+import pandas as pd
+
+FEDSHOP_DIR = Path(__file__).parent.parent
+sys.path.insert(0, str(FEDSHOP_DIR))
+
+from query import Reservoir
+
+def frame(n_rows):
+    return pd.DataFrame({
+        "product": [ f"http://example.org/Product{i}" for i in range(n_rows) ],
+        "price": np.arange(n_rows) * 1.5,
+    })
+
+def sample(rows, n_samples, chunk_sizes=None, seed=0, exact=True):
+    """Offer rows to a Reservoir, whole or split into chunks of the given sizes."""
+    reservoir = Reservoir(n_samples, seed=seed)
+    if chunk_sizes is None:
+        reservoir.update(rows)
+    else:
+        bounds = np.cumsum([0] + chunk_sizes)
+        assert bounds[-1] == len(rows)
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            reservoir.update(rows.iloc[start:end])
+    return reservoir.result(exact=exact)
+
+class TestReservoir(unittest.TestCase):
+    """Value selections are sampled with Reservoir, which must not depend on chunks, must be a prefix of larger samples,
+    and must draw rows with the same distribution and contract as df.sample, though not the same rows for a given seed."""
+
+    def test_chunks(self):
+        rows = frame(100)
+        expected = sample(rows, 10)
+        for chunk_sizes in [[100], [1] * 100, [3, 0, 17, 1, 50, 29], [60, 40], [99, 1]]:
+            with self.subTest(chunk_sizes=chunk_sizes):
+                pd.testing.assert_frame_equal(sample(rows, 10, chunk_sizes), expected)
+
+    def test_chunks_series(self):
+        rows = frame(100)["price"]
+        pd.testing.assert_series_equal(sample(rows, 10, [7, 0, 33, 60]), sample(rows, 10))
+
+    def test_prefix(self):
+        rows = frame(200)
+        for n_samples in [1, 5, 20]:
+            for n_more in [1, 7, 100]:
+                with self.subTest(n_samples=n_samples, n_more=n_more):
+                    smaller = sample(rows, n_samples, [13, 87, 100])
+                    larger = sample(rows, n_samples + n_more, [50, 150])
+                    pd.testing.assert_frame_equal(smaller, larger.iloc[:n_samples])
+
+    def test_seed(self):
+        rows = frame(100)
+        pd.testing.assert_frame_equal(sample(rows, 10, seed=42), sample(rows, 10, seed=42))
+        self.assertFalse(sample(rows, 10, seed=42).equals(sample(rows, 10, seed=43)))
+
+    def test_rows(self):
+        # As df.sample without replacement: distinct rows of the input, values untouched
+        rows = frame(50)
+        result = sample(rows, 20, [10, 25, 15])
+        self.assertEqual(len(result), 20)
+        self.assertEqual(result["product"].nunique(), 20)
+        merged = result.merge(rows, how="left", indicator=True)
+        self.assertTrue((merged["_merge"] == "both").all())
+
+    def test_too_few_rows(self):
+        # As df.sample, asking for more rows than there are fails, unless the sample needs not be exact
+        rows = frame(5)
+        with self.assertRaises(ValueError):
+            rows.sample(10, random_state=0)
+        with self.assertRaises(ValueError):
+            sample(rows, 10)
+        self.assertEqual(len(sample(rows, 10, exact=False)), 5)
+        self.assertEqual(len(sample(rows.iloc[:0], 10, exact=False)), 0)
+
+    def test_uniform(self):
+        # As df.sample, every row has the same chance to be sampled, and every rank within the sample
+        n_rows, n_samples, n_seeds = 20, 5, 4000
+        rows = frame(n_rows)
+        inclusions = np.zeros(n_rows)
+        first = np.zeros(n_rows)
+        for seed in range(n_seeds):
+            ids = (sample(rows, n_samples, [8, 12], seed=seed)["price"].to_numpy() / 1.5).astype(int)
+            inclusions[ids] += 1
+            first[ids[0]] += 1
+        np.testing.assert_allclose(inclusions / n_seeds, n_samples / n_rows, atol=0.03)
+        np.testing.assert_allclose(first / n_seeds, 1 / n_rows, atol=0.015)
+
+if __name__ == "__main__":
+    unittest.main()
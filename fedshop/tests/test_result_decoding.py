@@ -0,0 +1,101 @@
+from io import BytesIO
+from pathlib import Path
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+FEDSHOP_DIR = Path(__file__).parent.parent
+sys.path.insert(0, str(FEDSHOP_DIR))
+
+from query import iter_result_chunks, read_query_result, read_result_file, read_result_header, write_result_chunks
+
+# SPARQL TSV result in the shape Virtuoso writes it: quoted header, abbreviated numbers,
+# typed, language-tagged and escaped literals, blank nodes and unbound values
+RESULT_FILE = FEDSHOP_DIR / "tests" / "data" / "virtuoso_result.tsv"
+
+PRODUCT = "http://www4.wiwiss.fu-berlin.de/bizer/bsbm/v01/instances/dataFromProducer{}/Product{}"
+
+class TestResultDecoding(unittest.TestCase):
+    """SPARQL TSV results are decoded into typed columns, see decode_sparql_terms, then written by write_result_chunks."""
+
+    def read_fixture(self):
+        with open(RESULT_FILE, "rb") as result_fs:
+            return read_query_result(BytesIO(result_fs.read()))
+
+    def test_header(self):
+        for header in [b'?s\t?o\n', b'$s\t$o\n', b'"s"\t"o"\n', b'"?s"\t"?o"\r\n', b's\to\n']:
+            self.assertListEqual(read_result_header(BytesIO(header)), ["s", "o"], header)
+
+    def test_column_types(self):
+        result = self.read_fixture()
+        self.assertListEqual(result.columns.to_list(), ["product", "node", "price", "date", "label", "review", "mixed"])
+        self.assertEqual(result["product"].dtype, "category")
+        self.assertEqual(result["node"].dtype, "category")
+        self.assertEqual(result["price"].dtype, np.float64)
+        self.assertEqual(result["date"].dtype, "datetime64[ns]")
+        self.assertEqual(result["label"].dtype, object)
+
+    def test_iris_and_blank_nodes(self):
+        result = self.read_fixture()
+        self.assertListEqual(
+            result["product"].to_list(),
+            [PRODUCT.format(1, 1), PRODUCT.format(1, 2), PRODUCT.format(1, 3), PRODUCT.format(1, 1), PRODUCT.format(2, 4)]
+        )
+        # Blank nodes are spelled the way Virtuoso accepts them back in queries
+        self.assertListEqual(result["node"].iloc[[0, 1, 2, 4]].to_list(), ["nodeID://b0", "nodeID://nodeID2", "nodeID://b0", "nodeID://b1"])
+        self.assertTrue(pd.isna(result["node"].iloc[3]))
+
+    def test_typed_and_abbreviated_literals(self):
+        result = self.read_fixture()
+        self.assertListEqual(result["price"].to_list(), [12.5, 42.0, 150.0, -7.0, 0.0])
+        self.assertListEqual(
+            result["date"].iloc[:4].to_list(),
+            [pd.Timestamp("2008-06-20"), pd.Timestamp("2008-06-21T10:30:00"), pd.Timestamp("2008-06-22"), pd.Timestamp("2008-06-23")]
+        )
+        self.assertTrue(pd.isna(result["date"].iloc[4]))
+
+    def test_lexical_forms(self):
+        result = self.read_fixture()
+        self.assertListEqual(
+            result["label"].to_list(),
+            ["potato", "kartoffel", 'tab\there, line\nbreak, "quoted" and back\\slash', "plain", "accent é"]
+        )
+        self.assertListEqual(result["review"].iloc[2:].to_list(), ["short text", "long text", "more"])
+        # A column mixing IRIs and literals is kept as lexical forms
+        self.assertListEqual(result["mixed"].iloc[:4].to_list(), ["http://example.org/a", "plain", "42", "3"])
+
+    def test_write_result_chunks(self):
+        expected = self.read_fixture()
+        for suffix in [".parquet", ".csv"]:
+            with self.subTest(suffix=suffix), tempfile.TemporaryDirectory() as tmpdir:
+                outfile = f"{tmpdir}/result{suffix}"
+                result_stream = open(RESULT_FILE, "rb")
+                header = read_result_header(result_stream)
+                # Chunks of 2 rows: "review" is unbound in the whole first chunk
+                n_rows = write_result_chunks(iter_result_chunks(result_stream, header, chunksize=2), outfile)
+                self.assertEqual(n_rows, len(expected))
+
+                result = read_result_file(outfile)
+                self.assertListEqual(result.columns.to_list(), expected.columns.to_list())
+                if suffix == ".parquet":
+                    # Column types are kept, categories of all chunks included
+                    self.assertListEqual(result.dtypes.to_list(), expected.dtypes.to_list())
+                    pd.testing.assert_frame_equal(result, expected, check_categorical=False)
+                else:
+                    pd.testing.assert_frame_equal(result.astype(str), expected.astype(str))
+
+    def test_decode_chunks_like_whole(self):
+        # Holds as long as each chunk has the same kinds of terms as the whole column, e.g. not only numbers in "mixed"
+        expected = self.read_fixture()
+        with open(RESULT_FILE, "rb") as result_fs:
+            header = read_result_header(result_fs)
+            chunks = list(iter_result_chunks(BytesIO(result_fs.read()), header, chunksize=2))
+        self.assertEqual(len(chunks), 3)
+        result = pd.concat([ chunk.astype(object) for chunk in chunks ], ignore_index=True)
+        pd.testing.assert_frame_equal(result, expected.astype(object))
+
+if __name__ == "__main__":
+    unittest.main()
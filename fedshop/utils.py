@@ -1,6 +1,8 @@
 import ast
+from functools import lru_cache
 import importlib
 from io import BytesIO
+from itertools import product
 import json
 import os
 from pathlib import Path
@@ -11,11 +13,10 @@ import time
 import colorlog
 import numpy as np
 import requests
-from scipy.stats import norm, truncnorm
 from omegaconf import OmegaConf
 import psutil
 import pandas as pd
-from rdflib import Literal, URIRef
+from rdflib import Literal, URIRef, Variable
 
 import logging
 
@@ -61,6 +62,105 @@ def str2n3(value):
     else:
         return Literal(value).n3()
 
+def composition_index_file(composition_file):
+    """Path of the lookup index that decompose-query writes next to a composition file.
+    """
+    return os.path.join(Path(composition_file).parent, f"{Path(composition_file).stem}.index.json")
+
+def normalize_triple_string(triple):
+    """Drop brackets and collapse whitespaces, as engines wrap and space triple patterns differently.
+    """
+    return " ".join(re.sub(r"[\[\]]", "", str(triple)).split())
+
+def _term_spellings(text, term=None, aliases=None):
+    spellings = {text}
+    
+    # Without the parsed term, guess its kind from the composition text
+    if term is None:
+        pname = re.fullmatch(r"([\w-]*):(\S*)", text)
+        if text.startswith("http"): 
+            term = URIRef(text)
+        elif pname is not None and aliases is not None and pname.group(1) in aliases:
+            term = URIRef(f"{aliases[pname.group(1)]}{pname.group(2)}")
+        else:
+            spellings.add(f"?{text}")
+    
+    if isinstance(term, Variable):
+        spellings.update([str(term), f"?{term}"])
+    elif term is not None:
+        spellings.update([str(term), term.n3()])
+    return spellings
+
+def build_composition_index(composition, terms=None, prefixes=None):
+    """Map every spelling of each triple pattern to its tp ids.
+
+    Spellings combine, for each term, the composition text, the bare value and its n3 form (``?var``, ``<iri>``, ``"lit"^^<dt>``).
+
+    Args:
+        composition (dict): The composition, i.e. {"tp0": [s, p, o], ...}.
+        terms (dict, optional): The parsed rdflib terms of each triple pattern, with the same keys. If not given, kinds are guessed from the text.
+        prefixes (dict, optional): prefix -> alias, to resolve the ``alias:local`` names of the composition when terms are not given.
+
+    Returns:
+        dict: spelling -> list of tp ids, in composition order.
+    """
+    aliases = { alias: prefix for prefix, alias in prefixes.items() } if prefixes is not None else None
+    index = {}
+    for tp_name, triple in composition.items():
+        tp_terms = terms.get(tp_name) if terms is not None else None
+        spellings = [ _term_spellings(text, tp_terms[i] if tp_terms is not None else None, aliases) for i, text in enumerate(triple) ]
+        for spelling in product(*spellings):
+            tp_names = index.setdefault(normalize_triple_string(" ".join(spelling)), [])
+            if tp_name not in tp_names:
+                tp_names.append(tp_name)
+    return index
+
+@lru_cache(maxsize=None)
+def _load_composition_index(composition_file, mtime, prefixes=None):
+    index_file = composition_index_file(composition_file)
+    if os.path.exists(index_file) and os.path.getmtime(index_file) >= mtime:
+        with open(index_file, "r") as index_fs:
+            return json.load(index_fs)
+    
+    # Composition files written before the index existed, whose prefixed names are resolved with the given prefixes
+    with open(composition_file, "r") as comp_fs:
+        return build_composition_index(json.load(comp_fs), prefixes=dict(prefixes) if prefixes is not None else None)
+
+def load_composition_index(composition_file, prefixes=None):
+    """Load the lookup index of a composition file, once per process.
+
+    Args:
+        composition_file (str): Path to the composition.json file.
+        prefixes (dict, optional): prefix -> alias, to resolve the ``alias:local`` names of a composition file that has no index yet.
+
+    Returns:
+        dict: spelling -> list of tp ids.
+    """
+    if prefixes is not None:
+        prefixes = tuple(sorted(prefixes.items()))
+    return _load_composition_index(os.path.realpath(composition_file), os.path.getmtime(composition_file), prefixes)
+
+def lookup_triple_pattern(composition_file, triple, prefixes=None):
+    """Find the tp ids of a triple pattern, as spelled by an engine.
+
+    Args:
+        composition_file (str): Path to the composition.json file.
+        triple (str): The triple pattern.
+        prefixes (dict, optional): prefix -> alias, to expand ``alias:local`` names.
+
+    Raises:
+        KeyError: the triple pattern is not in the composition.
+
+    Returns:
+        list: the tp ids.
+    """
+    index = load_composition_index(composition_file, prefixes=prefixes)
+    key = normalize_triple_string(triple)
+    if key not in index and prefixes is not None:
+        for prefix, alias in prefixes.items():
+            key = re.sub(rf"(?<![\w:/#<]){re.escape(alias)}:(\w+)", lambda m: f"<{prefix}{m.group(1)}>", key)
+    return index[key]
+
 def load_config(filename, saveAs=None):
     """Load configuration from a file. By default, attributes are interpolated at access time.
 
@@ -98,6 +98,13 @@ LOGGER = fedshop_logger(Path(__file__).name)
 # PIPELINE
 #=================
 
+# Warm engine hosts outlive the queries, stop them once the batch is evaluated, see EngineHost in fedshop/engines/TemplateEngine.py
+onsuccess:
+    shell(f"python fedshop/engines/TemplateEngine.py stop-engine-hosts {CONFIGFILE}")
+
+onerror:
+    shell(f"python fedshop/engines/TemplateEngine.py stop-engine-hosts {CONFIGFILE}")
+
 rule all:
     input: expand("{benchDir}/metrics.csv", benchDir=BENCH_DIR)
 
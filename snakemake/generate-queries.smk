@@ -72,6 +72,9 @@ INSTANCE_ID = str(config["instance"]).split(",") if config.get("instance") is no
 
 DEBUG = eval(str(config["debug"])) if config.get("explain") is not None else False
 
+# Set by benchmark.py generate queries --incremental, once the workloads are grown and new instances injected
+INCREMENTAL = eval(str(config["incremental"])) if config.get("incremental") is not None else False
+
 
 #=================
 # USEFUL FUNCTIONS
@@ -85,6 +88,11 @@ def ping(endpoint):
     except requests.exceptions.ConnectionError:
         return False
 
+def unless_incremental(path):
+    """In incremental mode, an input newer than existing outputs does not make them rerun.
+    """
+    return ancient(path) if INCREMENTAL else path
+
 def get_results_per_batch(wildcards):
     def combinator(benchDir, query, instance_id, batch_id):
         for batch_id_u, benchDir_u, query_u, instance_id_u in product(batch_id, benchDir, query, instance_id):
@@ -121,10 +129,11 @@ rule generate_batch:
     shell: "echo 'ok' > {output}"
         
 rule execute_instances:
-    input: "{benchDir}/{query}/instance_{instance_id}/injected.sparql"
+    input: unless_incremental("{benchDir}/{query}/instance_{instance_id}/injected.sparql")
     output: "{benchDir}/{query}/instance_{instance_id}/results-batch{batch_id}.csv"
     params:
-        endpoint_batch0 = SPARQL_DEFAULT_ENDPOINT
+        endpoint_batch0 = SPARQL_DEFAULT_ENDPOINT,
+        result_store = CONFIG_GEN["virtuoso"]["result_store"]
     run:
         SPARQL_CONTAINER_NAME = f"docker-{SPARQL_SERVICE_NAME}-{int(wildcards.batch_id)+1}"
         if USE_DOCKER and not docker_check_container_running(SPARQL_CONTAINER_NAME):
@@ -137,27 +146,30 @@ rule execute_instances:
         composition_file = f"{Path(str(input)).parent}/composition.json"
         if not os.path.exists(composition_file):
             shell("python fedshop/query.py decompose-query {input} {composition_file}")
-        shell("python fedshop/query.py execute-query {params.endpoint_batch0} --queryfile={input} --outfile={output}")
+        shell("python fedshop/query.py execute-query {params.endpoint_batch0} --queryfile={input} --outfile={output} --result-store={params.result_store} --batch-id={wildcards.batch_id} --configfile={CONFIGFILE}")
 
 rule instanciate_workload:
     threads: 1
     input: 
         queryfile=expand("{queryDir}/{{query}}.sparql", queryDir=QUERY_DIR),
-        workload_value_selection="{benchDir}/{query}/workload_value_selection.csv"
+        workload_value_selection=unless_incremental("{benchDir}/{query}/workload_value_selection.parquet")
     output:
-        injected_query="{benchDir}/{query}/instance_{instance_id}/injected.sparql",
+        injected_queries=expand("{{benchDir}}/{{query}}/instance_{instance_id}/injected.sparql", instance_id=INSTANCE_ID),
     params:
-        batch_id = 0
-    run:
-        shell("python fedshop/query.py instanciate-workload {input.queryfile} {input.workload_value_selection} {output.injected_query} {wildcards.instance_id}")
+        instance_ids = ",".join(map(str, INSTANCE_ID))
+    shell: "python fedshop/query.py instanciate-workload-all {input.queryfile} --bench-dir {wildcards.benchDir} --instance-ids {params.instance_ids}"
         
-rule create_workload_value_selection:
-    threads: 5
+rule generate_workloads:
+    threads: len(QUERY_PATH)
     input: 
-        value_selection_infos="{benchDir}/{query}/value_selection.json"
-    output: "{benchDir}/{query}/workload_value_selection.csv"
+        queryfiles = expand("{queryDir}/{query}.sparql", queryDir=QUERY_DIR, query=QUERY_PATH),
+        constfiles = expand("{queryDir}/{query}.const.json", queryDir=QUERY_DIR, query=QUERY_PATH)
+    output: 
+        value_selection_infos = expand("{{benchDir}}/{query}/value_selection.json", query=QUERY_PATH),
+        workload_value_selections = expand("{{benchDir}}/{query}/workload_value_selection.parquet", query=QUERY_PATH)
     params:
         n_query_instances = N_QUERY_INSTANCES,
+        incremental = "--incremental" if INCREMENTAL else ""
     run:
         SPARQL_CONTAINER_NAME = f"docker-{SPARQL_SERVICE_NAME}-1"
         if USE_DOCKER :
@@ -168,13 +180,5 @@ rule create_workload_value_selection:
                 LOGGER.debug(f"Waiting for {SPARQL_DEFAULT_ENDPOINT} to start...")
                 time.sleep(1)
 
-        constfile = f"{QUERY_DIR}/{wildcards.query}.const.json"
-        shell(f"python fedshop/query.py create-workload-value-selection {CONFIGFILE} {constfile} {input.value_selection_infos} {output} {params.n_query_instances}")
-
-rule build_value_selection_query:
-    threads: 5
-    input: 
-        constfile = expand("{queryDir}/{{query}}.const.json", queryDir=QUERY_DIR),
-        queryfile = expand("{queryDir}/{{query}}.sparql", queryDir=QUERY_DIR)
-    output: "{benchDir}/{query}/value_selection.json"
-    shell: "python fedshop/query.py build-value-selection-query {input.queryfile} {input.constfile} {output}"
+        # All templates from one process pool, sharing the endpoint's query slots, see generate-workloads
+        shell("python fedshop/query.py generate-workloads {CONFIGFILE} {input.queryfiles} --bench-dir {wildcards.benchDir} --n-instances {params.n_query_instances} --n-jobs {threads} --timings {wildcards.benchDir}/workload_timings.csv {params.incremental}")